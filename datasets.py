@@ -1,24 +1,68 @@
 
 from __future__ import print_function
+import os
 import h5py
 import numpy as np
 import time
+import struct
+import pickle
+import threading
 import multiprocessing as mp
 from multiprocessing import Queue
 from queue import Empty
 from queue import Full
+import queue
+from journal import Journal, FAILED, ioerrors_name
+import segments
 
 SIZE_INC = int(2048)
 CHUNK_SIZE = int(128)
 
+# what to do when the dataset buffer is full:
+#  raise -- raise Full (old behaviour)
+#  block -- wait up to `timeout` seconds for the writer, then raise Full
+#  spill -- append the row to a local overflow file, the writer reads it back
+#  drop  -- discard the row and count it
+OVERFLOW_POLICIES = ('raise', 'block', 'spill', 'drop')
+
+# per-column write statistics, shared with the parent process
+STAT_FIELDS = (
+        'rows',
+        'chunks',
+        'write_time',
+        'max_write_time',
+        'latency',
+        'max_latency',
+        'pending',
+        )
+
+# seconds to wait, after exit is set, for rows the producer saved but
+# that did not arrive yet
+DRAIN_TIMEOUT = 5.
+
+# number of filled chunks that may wait for the disk while the next
+# ones are being accumulated (2 -> double buffering)
+WRITE_BUFFERS = 2
+
+_rec_len = struct.Struct('<I')
+
+
+def _item(v):
+    ''' numpy scalar to python type (for json) '''
+    return v.item() if hasattr(v, 'item') else v
+
 
 class HDF5(mp.Process):
     '''
     Creates a hdf5 file with datasets of specified types.
     Provides an append method.
     '''
-    def __init__(self, filename='rec.hdf5', tables={}, bufsize=2048*64, chunksize=0, mode='w-', compression=None):
+    def __init__(self, filename='rec.hdf5', tables={}, bufsize=2048*64, chunksize=0, mode='w-', compression=None,
+                 overflow='raise', timeout=1., spill_file=None, journal=None, keep_journal=False,
+                 segment_size=0, segment_duration=0):
         super(HDF5, self).__init__()
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('unknown overflow policy %s' % overflow)
         self.compression = compression
         self.fname = filename
         self.datasets = {}
@@ -30,33 +74,193 @@ class HDF5(mp.Process):
         self.maxsize = self.q._maxsize
         self.exit = mp.Event()
         self.fmode = mode
+        self.overflow = overflow
+        self.timeout = timeout
+        self.spill_fname = spill_file or filename + '.spill'
+        self.columns = sorted(k.replace('/', '_') for k in tables)
+        self.col_index = {k: i for i, k in enumerate(self.columns)}
+        self.col_stats = mp.Array('d', len(self.columns) * len(STAT_FIELDS))
+        self.n_spilled = mp.Value('L', 0)
+        self.n_unspilled = mp.Value('L', 0)
+        self.n_dropped = mp.Value('L', 0)
+        # rows queued or spilled by the producer
+        self.n_saved = mp.Value('L', 0)
+        # with segments, each segment gets its own journals next to it
+        self.journal_fname = journal
+        self.keep_journal = keep_journal
+        self.ioerr_fname = ioerrors_name(filename)
+        # roll over to a new file after segment_size bytes or segment_duration seconds
+        self.segment_size = segment_size
+        self.segment_duration = segment_duration
+        self.segmented = bool(segment_size or segment_duration)
+        self.ts_cols = {k for k in self.columns
+                        if k == 'timestamp' or k.endswith('_timestamp')}
+        self._seq = 0
+        self._spill_f = None
         #self.daemon = True
         self.start()
 
     def init_ds(self):
-        self.f = h5py.File(self.fname, self.fmode)
+        fname = self.fname
+        if self.segmented:
+            fname = segments.segment_name(self.fname, len(self.segments))
+            if self.journal_fname:
+                self.journal_fname = fname + '.journal'
+            self.ioerr_fname = ioerrors_name(fname)
+        self.f = h5py.File(fname, self.fmode)
         self.create_datasets(self.tables, compression=self.compression)
         self.ptrs = {k: 0 for k in self.datasets}
+        # rows handed to the writer, whether they could be written or not
+        self.n_handed = {k: 0 for k in self.datasets}
         self.size = {k: SIZE_INC for k in self.datasets}
+        self.t_segment = time.time()
+        self.t_range = [None, None]
+        self.had_ioerror = False
+        if self.journal_fname:
+            self.journal = Journal(self.journal_fname, self.tables)
+        if self.segmented:
+            # listed right away, so a crash leaves the segment in the manifest
+            self.segments.append({'file': fname, 'complete': False})
+            segments.write_manifest(
+                    segments.manifest_name(self.fname), self.segments)
 
     def run(self):
+        self.segments = []
+        self.t_check = time.time()
+        self.journal = None
+        self.ioerr_journal = None
+        self.init_ds()
+        self.wq = queue.Queue(WRITE_BUFFERS)
+        self.write_error = None
+        self.writer = threading.Thread(target=self._write_loop)
+        self.writer.start()
+        self.spill_in = None
+        self.next_seq = 0
+        self.t_exit = None
+        self.pending = {'q': None, 'spill': None}
+        try:
+            while not self.exit.is_set() or not self._drained():
+                try:
+                    res = self._next()
+                    if res is not None:
+                        if self.journal is not None:
+                            self.journal.append(res[2])
+                        self._save(res)
+                    if self.segmented and time.time() - self.t_check > 1:
+                        self._check_roll()
+                except KeyboardInterrupt:
+                    #print('datasets.run got interrupt')
+                    self.exit.set()
+            self.close()
+        except BaseException:
+            if self.write_error is not None:
+                self._abort()
+            raise
+
+    def _check_roll(self):
+        self.t_check = time.time()
+        if (self.segment_duration and
+                time.time() - self.t_segment > self.segment_duration) or \
+                (self.segment_size and
+                 os.path.getsize(self.f.filename) > self.segment_size):
+            self._roll()
+
+    def _roll(self):
+        ''' finish current segment and continue in a new file '''
+        for col in self.outbuffers:
+            self._flush_outbuf(col)
+        self._join_writer()
+        self._finish_file()
+        self._close_journals()
+        print('\nstarted segment', len(self.segments))
+        self.datasets = {}
         self.init_ds()
-        f = open('datasets_ioerrors.txt', 'a')
-        while not self.exit.is_set() or not self.q.empty():
+
+    def _finish_file(self):
+        '''
+        close the current file, segments are trimmed to their
+        actual length and marked complete in the manifest. Each dataset gets its number
+        of rows written as `valid_length` attribute, so readers don't have to
+        look for the zero padding.
+        '''
+        for col, ptr in self.ptrs.items():
+            self[col].attrs['valid_length'] = ptr
+        if self.segmented:
+            for col, ptr in self.ptrs.items():
+                self[col].resize(ptr, axis=0)
+            self.segments[-1].update({
+                't_start': _item(self.t_range[0]),
+                't_stop': _item(self.t_range[1]),
+                'rows': dict(self.ptrs),
+                'complete': True,
+                })
+            segments.write_manifest(
+                    segments.manifest_name(self.fname), self.segments)
+        self.f.flush()
+        self.f.close()
+
+    def _close_journals(self):
+        ''' the journal of a file is kept if some rows could not be written '''
+        if self.ioerr_journal is not None:
+            self.ioerr_journal.close()
+            print('\nrows that could not be written are in', self.ioerr_fname)
+            self.ioerr_journal = None
+        if self.journal is not None:
+            self.journal.close()
+            if not self.keep_journal and not self.had_ioerror:
+                os.remove(self.journal_fname)
+            self.journal = None
+
+    def _drained(self):
+        if not (self.q.empty() and not any(self.pending.values()) and
+                self.n_unspilled.value == self.n_spilled.value):
+            return False
+        if self.next_seq >= self.n_saved.value:
+            return True
+        # the queue's feeder thread in the producer may still hold rows
+        if self.t_exit is None:
+            self.t_exit = time.time()
+        return time.time() - self.t_exit > DRAIN_TIMEOUT
+
+    def _next(self):
+        '''
+        get the next row in the order it was saved,
+        merging the queue and the spill file by sequence number
+        '''
+        if self.pending['q'] is None:
             try:
-                res = self.q.get(False, 1e-3)
-                self._save(res)
+                self.pending['q'] = self.q.get(True, 1e-3)
             except Empty:
                 pass
-            except IOError:
-                print('IOError, continuing')
-                f.write(str(res))
-                pass
-            except KeyboardInterrupt:
-                #print('datasets.run got interrupt')
-                self.exit.set()
-        f.close()
-        self.close()
+        if self.pending['spill'] is None and \
+                self.n_unspilled.value < self.n_spilled.value:
+            self.pending['spill'] = self._read_spill()
+        for src in ('q', 'spill'):
+            item = self.pending[src]
+            if item is not None and item[0] == self.next_seq:
+                self.pending[src] = None
+                self.next_seq += 1
+                return item
+        if self.exit.is_set() and self.q.empty() and \
+                self.n_unspilled.value == self.n_spilled.value:
+            # rows lost on the way, don't wait for them forever
+            items = [v for v in self.pending.values() if v is not None]
+            if items:
+                item = min(items, key=lambda v: v[0])
+                self.pending = {k: (None if v is item else v)
+                                for k, v in self.pending.items()}
+                self.next_seq = item[0] + 1
+                return item
+        return None
+
+    def _read_spill(self):
+        if self.spill_in is None:
+            self.spill_in = open(self.spill_fname, 'rb')
+        n, = _rec_len.unpack(self.spill_in.read(_rec_len.size))
+        item = pickle.loads(self.spill_in.read(n))
+        with self.n_unspilled.get_lock():
+            self.n_unspilled.value += 1
+        return item
 
     def create_datasets(self, tables, compression=None):
         for tname, ttype in tables.items():
@@ -88,22 +292,177 @@ class HDF5(mp.Process):
             self.outbuffers[tname] = []
 
     def save(self, data):
+        item = (self._seq, time.time(), data)
         try:
-            self.q.put_nowait(data)
+            if self.overflow == 'block':
+                self._put_blocking(item)
+            else:
+                self.q.put_nowait(item)
         except Full:
-            raise Full('dataset buffer overflow')
+            if self.overflow == 'spill':
+                self._spill(item)
+            elif self.overflow == 'drop':
+                with self.n_dropped.get_lock():
+                    self.n_dropped.value += 1
+                return
+            else:
+                raise Full('dataset buffer overflow')
+        self._seq += 1
+        self.n_saved.value = self._seq
+
+    def _put_blocking(self, item):
+        ''' wait for the writer, but give up if it died '''
+        t0 = time.time()
+        while True:
+            try:
+                return self.q.put(item, True, 0.1)
+            except Full:
+                if not self.is_alive():
+                    raise Full('dataset writer is not running')
+                if self.timeout is not None and time.time() - t0 > self.timeout:
+                    raise
 
-    def _save(self, data):
+    def _spill(self, item):
+        ''' append row to the overflow file (called from the producer) '''
+        if self._spill_f is None:
+            self._spill_f = open(self.spill_fname, 'wb')
+        p = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+        self._spill_f.write(_rec_len.pack(len(p)) + p)
+        self._spill_f.flush()
+        with self.n_spilled.get_lock():
+            self.n_spilled.value += 1
+
+    def _save(self, item):
+        seq, t_save, data = item
         for col,val in data.items():
             self.outbuffers[col].append(val)
+            self._add_stat(col, 'latency', time.time() - t_save, 'max_latency')
+            if col in self.ts_cols and val:
+                lo, hi = self.t_range
+                self.t_range = [val if lo is None else min(lo, val),
+                                val if hi is None else max(hi, val)]
             if len(self.outbuffers[col]) == self.chunk_size:
-                self[col][self.ptrs[col]:self.ptrs[col] + self.chunk_size] = \
-                        self._get_outbuf(col)
-                self.outbuffers[col] = []
-                self.ptrs[col] += self.chunk_size
-            if self.ptrs[col] == self.size[col]:
-                self.size[col] += SIZE_INC
-                self[col].resize(self.size[col], axis=0)
+                self._flush_outbuf(col)
+            self._set_stat(col, 'pending', len(self.outbuffers[col]))
+
+    def _flush_outbuf(self, col):
+        ''' hand buffered rows to the writer thread, start a new buffer '''
+        if not self.outbuffers[col]:
+            return
+        self._put_write((col, self._get_outbuf(col)))
+        self.outbuffers[col] = []
+
+    def _check_writer(self):
+        ''' re-raise what stopped the writer thread '''
+        if self.write_error is not None:
+            raise self.write_error
+        if not self.writer.is_alive():
+            raise RuntimeError('dataset writer thread is not running')
+
+    def _put_write(self, item):
+        ''' hand an item to the writer thread, unless it died '''
+        while True:
+            try:
+                return self.wq.put(item, True, 0.1)
+            except Full:
+                self._check_writer()
+
+    def _join_writer(self):
+        ''' wait until the writer thread wrote everything handed to it '''
+        with self.wq.all_tasks_done:
+            while self.wq.unfinished_tasks:
+                self._check_writer()
+                self.wq.all_tasks_done.wait(0.1)
+
+    def _abort(self):
+        ''' the writer thread failed, keep the journals for recover.py '''
+        print('\ndataset writer failed: %r' % self.write_error)
+        for j in (self.journal, self.ioerr_journal):
+            if j is not None:
+                j.close()
+                print('rebuild the recording from', j.fname)
+
+    def _write_loop(self):
+        while True:
+            item = self.wq.get()
+            if item is None:
+                self.wq.task_done()
+                break
+            col, rows = item
+            first, ptr = self.n_handed[col], self.ptrs[col]
+            self.n_handed[col] += len(rows)
+            try:
+                self._write(col, rows)
+            except IOError:
+                print('IOError while writing %s, continuing' % col)
+                if self.ptrs[col] == ptr:
+                    self._save_ioerror(col, rows, first)
+            except BaseException as e:
+                # anything else stops the writer, the main loop re-raises it
+                self.write_error = e
+                break
+            finally:
+                self.wq.task_done()
+
+    def _write(self, col, rows):
+        n = len(rows)
+        while self.ptrs[col] + n > self.size[col]:
+            self.size[col] += SIZE_INC
+            self[col].resize(self.size[col], axis=0)
+        t = time.time()
+        self[col][self.ptrs[col]:self.ptrs[col] + n] = rows
+        self._add_stat(col, 'write_time', time.time() - t, 'max_write_time')
+        self._add_stat(col, 'rows', n)
+        self._add_stat(col, 'chunks', 1)
+        self.ptrs[col] += n
+        if self.ptrs[col] == self.size[col]:
+            self.size[col] += SIZE_INC
+            self[col].resize(self.size[col], axis=0)
+
+    def _save_ioerror(self, col, rows, first):
+        '''
+        keep rows that could not be written in a binary journal, with their
+        position among the rows of the column (the next rows take their
+        place in the file). They are merged back with recover.py, also when
+        the main journal holds them.
+        '''
+        self.had_ioerror = True
+        if self.ioerr_journal is None:
+            self.ioerr_journal = Journal(self.ioerr_fname, self.tables)
+        self.ioerr_journal.append({FAILED: (col, first, rows)})
+
+    def _stat_pos(self, col, field):
+        return self.col_index[col] * len(STAT_FIELDS) + STAT_FIELDS.index(field)
+
+    def _add_stat(self, col, field, val, max_field=None):
+        self.col_stats[self._stat_pos(col, field)] += val
+        if max_field is not None:
+            i = self._stat_pos(col, max_field)
+            self.col_stats[i] = max(self.col_stats[i], val)
+
+    def _set_stat(self, col, field, val):
+        self.col_stats[self._stat_pos(col, field)] = val
+
+    def metrics(self):
+        '''
+        return per-column write latency and backlog,
+        can be called from the producer process
+        '''
+        n = len(STAT_FIELDS)
+        vals = self.col_stats[:]
+        cols = {}
+        for i, col in enumerate(self.columns):
+            s = dict(zip(STAT_FIELDS, vals[i*n:(i+1)*n]))
+            s['mean_write_time'] = s['write_time'] / max(s['chunks'], 1)
+            s['mean_latency'] = s['latency'] / max(s['rows'] + s['pending'], 1)
+            cols[col] = s
+        return {
+            'columns': cols,
+            'backlog': self.q.qsize(),
+            'spilled': self.n_spilled.value,
+            'spill_backlog': self.n_spilled.value - self.n_unspilled.value,
+            'dropped': self.n_dropped.value,
+            }
 
     def _get_outbuf(self, col):
         if self.ndims[col] > 1:
@@ -116,9 +475,27 @@ class HDF5(mp.Process):
 
     def close(self):
         self.exit.set()
-        self.f.flush()
-        self.f.close()
+        for col in self.outbuffers:
+            self._flush_outbuf(col)
+        self._put_write(None)
+        self.writer.join()
+        if self.write_error is not None:
+            raise self.write_error
+        self._finish_file()
+        if self.segmented:
+            print('\nwrote %d segments, see %s' % (
+                len(self.segments), segments.manifest_name(self.fname)))
+        self._close_journals()
         self.q.close()
         self.q.join_thread()
+        if self.spill_in is not None:
+            self.spill_in.close()
+            if self.n_unspilled.value == self.n_spilled.value:
+                os.remove(self.spill_fname)
+        if self.n_spilled.value:
+            print('\n%d rows went through overflow file %s' % (
+                self.n_spilled.value, self.spill_fname))
+        if self.n_dropped.value:
+            print('\nWARNING: dropped %d rows (dataset buffer full)' %
+                  self.n_dropped.value)
         print('\nclosed output file')
-
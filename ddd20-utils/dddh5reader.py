@@ -14,6 +14,8 @@ import h5py
 from tqdm import tqdm
 
 from view import HDF5Stream, MergedStream
+from index import open_index, TimeCorrection
+from segments import open_recording
 from interfaces.caer import unpack_data
 from interfaces import caer
 
@@ -40,7 +42,7 @@ class DDD20SimpleReader(object):
         stopTimeS: float
             stop time of the stream in seconds from start of recording.
         """
-        self.f_in =h5py.File(fname, 'r')
+        self.f_in = open_recording(fname)
         # self.m = MergedStream(self.f_in)
         # self.start = int(self.m.tmin + 1e6 * startTimeS) if startTimeS else 0
         # self.stop = (self.m.tmin + 1e6 * stopTimeS) if stopTimeS else self.m.tmax
@@ -177,6 +179,9 @@ class DDD20ReaderMultiProcessing(object):
         stopTimeS: float
             stop time of the stream in seconds.
         """
+        idx = open_index(fname)
+        self.time = TimeCorrection(idx)
+        idx.close()
         self.f_in = HDF5Stream(fname, {'dvs'})
         self.m = MergedStream(self.f_in)
         self.start = int(self.m.tmin + 1e6 * startTimeS) if startTimeS else 0
@@ -197,8 +202,7 @@ class DDD20ReaderMultiProcessing(object):
             events, col names: ["ts", "y", "x", "polarity"], \
                 data types: ["<f8", "<i8", "<i8", "<i8"]
         """
-        sys_ts, t_offset, current = 0, 0, 0
-        timestamp = 0
+        sys_ts = 0
         frames, events = [], []
         while self.m.has_data and sys_ts <= self.stop * 1e-6:
             try:
@@ -211,13 +215,10 @@ class DDD20ReaderMultiProcessing(object):
                 # skip unused data
                 continue
             if d['etype'] == 'special_event':
-                unpack_data(d)
-                # this is a timestamp reset
-                if any(d['data'] == 0):
-                    print('ts reset detected, setting offset', timestamp)
-                    t_offset += current
-                    # NOTE the timestamp of this special event is not meaningful
+                # timestamp resets are taken care of by the time correction table
                 continue
+            # offset from the timestamp resets so far (s)
+            t_offset = self.time.offset_at(round(sys_ts * 1e6)) * 1e-6
             if d['etype'] == 'frame_event':
                 ts = d['timestamp'] + t_offset
                 frame = filter_frame(unpack_data(d))
@@ -229,7 +230,6 @@ class DDD20ReaderMultiProcessing(object):
                     )
                 )
                 frames.append(data)
-                current = ts
                 continue
             if d['etype'] == 'polarity_event':
                 unpack_data(d)
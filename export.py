@@ -17,7 +17,9 @@ import numpy as np
 import h5py
 from copy import deepcopy
 from view import HDF5Stream, MergedStream
+from index import open_index, TimeCorrection
 from datasets import HDF5
+from segments import base_name
 from interfaces.caer import DVS_SHAPE, unpack_data
 
 print("Found cpu cores:", mp.cpu_count())
@@ -127,6 +129,9 @@ if __name__ == '__main__':
     parser.add_argument('--timesteps', type=int, default=10)
     args = parser.parse_args()
 
+    idx = open_index(args.filename)
+    time_correction = TimeCorrection(idx)
+    idx.close()
     f_in = HDF5Stream(args.filename, export_data_vi.union({'dvs'}))
     m = MergedStream(f_in)
 
@@ -148,8 +153,9 @@ if __name__ == '__main__':
         dtypes['dvs_channels'] = (np.int16, (2, DVS_SHAPE[0], DVS_SHAPE[1]))
         dtypes['dvs_accum'] = (np.int16, DVS_SHAPE)
 
-    outfile = args.out_file or args.filename[:-5] + '_export.hdf5'
-    f_out = HDF5(outfile, dtypes, mode='w', chunksize=8, compression='gzip')
+    outfile = args.out_file or base_name(args.filename) + '_export.hdf5'
+    f_out = HDF5(outfile, dtypes, mode='w', chunksize=8, compression='gzip',
+                 overflow='block', timeout=60)
 
     current_row = {k: 0 for k in dtypes}
     if args.export_aps:
@@ -161,6 +167,8 @@ if __name__ == '__main__':
 
     pbar = get_progress_bar()
     sys_ts, t_pre, t_offset, ev_count, pbar_next = 0, 0, 0, 0, 0
+    # dvs row of the current packet, the stream reads all rows in order
+    dvs_row = -1
     while m.has_data and sys_ts <= tstop*1e-6:
         try:
             sys_ts, d = m.get()
@@ -168,19 +176,19 @@ if __name__ == '__main__':
             # wait for queue to fill up
             time.sleep(0.01)
             continue
+        if d and d['etype'] in export_data_vi:
+            current_row[d['etype']] = d['data']
+            continue
+        dvs_row += 1
         if not d:
             # skip unused data
             continue
         if d['etype'] == 'special_event':
-            unpack_data(d)
-            if any(d['data'] == 0): # this is a timestamp reset
-                print('ts reset detected, setting offset', current_row['timestamp'])
-                t_offset += current_row['timestamp']
-                #NOTE the timestamp of this special event is not meaningful
-                continue
-        if d['etype'] in export_data_vi:
-            current_row[d['etype']] = d['data']
+            # timestamp resets are taken care of by the time correction table
             continue
+        # offset from the timestamp resets before this row (s); packets of one
+        # recv batch share their system timestamp, so look it up by row
+        t_offset = time_correction.offset_at_row(dvs_row) * 1e-6
         if t_pre == 0 and d['etype'] in ['frame_event', 'polarity_event']:
             print('resetting t_pre (first %s)' % d['etype'])
             t_pre = d['timestamp'] + t_offset
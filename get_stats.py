@@ -5,6 +5,7 @@ import sys
 import h5py
 import numpy as np
 import scipy.interpolate as ip
+from segments import open_recording
 
 
 tstep = 1
@@ -18,7 +19,7 @@ if __name__ == '__main__':
 
     for fname in fnames:
         try:
-            f = h5py.File(fname, 'r')
+            f = open_recording(fname)
         except:
             print('could not open', fname)
             continue
@@ -1,54 +1,191 @@
+import os
+import hashlib
 import h5py
 import numpy as np
 #from scipy.misc import imresize
 from skimage.transform import resize
 from skimage.util import img_as_ubyte
 from skimage import img_as_bool
-from collections import defaultdict
-import sklearn
-import torch
-import Nets_Spiking_BNTT
+from collections import deque
+from functools import partial
+import threading
+import queue
+import multiprocessing as mp
+import cv2
+from valid_length import valid_length
 
 def get_real_endpoint(h5f):
-    if h5f['timestamp'][-1] != 0:
-        end_len = len(h5f['timestamp'])
-    else:
-        # Get the last index where it changes, before it becomes zero
-        end_len = np.where(abs(np.diff(h5f['timestamp']))>0)[0][-1]+1
-    return end_len
+    # Rows before the zero padding of the timestamps
+    return valid_length(h5f['timestamp'])
 
 def get_common_endpoint(h5f_aps, h5f_dvs):
     return min(get_real_endpoint(h5f_aps), get_real_endpoint(h5f_dvs))
 
+# Access patterns of derived datasets, see chunk_layout
+ACCESS_RANDOM = 'random'
+ACCESS_SEQUENTIAL = 'sequential'
+
+def chunk_layout(frame_shape, access=ACCESS_RANDOM, seq_length=1):
+    # HDF5 chunk shape for a dataset of frames read with the given access pattern:
+    #     shuffled batches read single frames, so each frame gets its own chunk, while a
+    #     sequence of seq_length frames starting anywhere touches at most two chunks
+    if access == ACCESS_RANDOM:
+        return (1,) + tuple(frame_shape)
+    elif access == ACCESS_SEQUENTIAL:
+        return (max(int(seq_length), 1),) + tuple(frame_shape)
+    raise ValueError('Unknown access pattern {}'.format(access))
+
+def create_frame_dataset(h5f, key, shape, dtype='uint8', access=ACCESS_RANDOM, seq_length=1, **kwargs):
+    # Fixed size dataset of frames chunked for its access pattern, which is stored in its attrs
+    chunks = chunk_layout(shape[1:], access, min(seq_length, max(shape[0], 1)))
+    dset = h5f.create_dataset(key, shape=shape, maxshape=shape, chunks=chunks, dtype=dtype, **kwargs)
+    dset.attrs['access'] = access
+    dset.attrs['seq_length'] = seq_length if access == ACCESS_SEQUENTIAL else 1
+    return dset
+
 def chunker(seq, size):
-    return (seq[pos:pos + size] for pos in xrange(0, len(seq), size))
+    return (seq[pos:pos + size] for pos in range(0, len(seq), size))
 
 def yield_chunker(seq, size):
     for pos in range(0, len(seq), size):
         yield seq[pos:pos + size]
 
-def check_and_fix_timestamps(h5f):
-    all_timestamps = np.array(h5f['timestamp']).copy()
-    if np.all(np.diff(all_timestamps) >= 0):
-        return
-    else:
-        print('Broken timestamps found! Fixing...')
-        curr_idx = 0
-        while curr_idx < len(all_timestamps):
-            loop_point = np.where(np.diff(all_timestamps)<0)[0]
-            if len(loop_point)==0:
-                orig_timestamps = np.array(h5f['timestamp']).copy()
-                if 'orig_timestamp' in h5f:
-                    del h5f['orig_timestamp']
-                h5f['orig_timestamp'] = orig_timestamps
-                if 'timestamp' in h5f:
-                    del h5f['timestamp']
-                h5f['timestamp'] = all_timestamps
+def _read_chunks(dset, chunk_size, todo, stop):
+    # Reader thread of run_chunk_pipeline: (row, chunk) in order, then None (or the exception)
+    try:
+        for pos in range(0, len(dset), chunk_size):
+            if stop.is_set():
                 return
+            todo.put((pos, dset[pos:pos + chunk_size]))
+        todo.put(None)
+    except Exception as e:
+        todo.put(e)
+
+def _write_chunks(dset, done, on_write, errors):
+    # Writer thread of run_chunk_pipeline: results (or AsyncResults) in row order, until None
+    while True:
+        item = done.get()
+        if item is None:
+            break
+        if errors:
+            # failed before, only drain
+            continue
+        pos, result = item
+        try:
+            out = result.get() if hasattr(result, 'get') else result
+            dset[pos:pos + len(out)] = out
+            if on_write is not None:
+                on_write(pos, out)
+        except Exception as e:
+            errors.append(e)
+
+def run_chunk_pipeline(dset_in, dset_out, transform, chunk_size=1024, workers=None, in_flight=None,
+                       initializer=None, initargs=(), on_write=None):
+    # Transforms dset_in chunk by chunk into the same rows of the preallocated dset_out:
+    #     a thread reads chunks, a pool of workers processes transforms them and a thread
+    #     writes the results, in order. At most in_flight chunks are transformed or waiting
+    #     to be written at a time, which bounds memory. transform (and initializer) must be
+    #     picklable, e.g. module level functions or partials of them. workers=0 transforms
+    #     in this process, still overlapping reads and writes with the work. on_write(row, out)
+    #     is called after each write, in row order.
+    workers = mp.cpu_count() if workers is None else workers
+    in_flight = in_flight or max(2 * workers, 2)
+    todo = queue.Queue(1)
+    done = queue.Queue(in_flight)
+    errors = []
+    stop = threading.Event()
+    # Fork the workers before starting the threads, a child must not inherit a thread
+    #     that holds a lock or is in the middle of an HDF5 call
+    if workers:
+        pool = mp.Pool(workers, initializer, initargs)
+    else:
+        pool = None
+        if initializer is not None:
+            initializer(*initargs)
+    reader = threading.Thread(target=_read_chunks, args=(dset_in, chunk_size, todo, stop))
+    reader.daemon = True
+    reader.start()
+    writer = threading.Thread(target=_write_chunks, args=(dset_out, done, on_write, errors))
+    writer.daemon = True
+    writer.start()
+    try:
+        while not errors:
+            item = todo.get()
+            if isinstance(item, Exception):
+                raise item
+            if item is None:
+                break
+            pos, chunk = item
+            if pool:
+                done.put((pos, pool.apply_async(transform, (chunk,))))
             else:
-                curr_idx = loop_point[0]
-                all_timestamps[curr_idx+1:] += abs(all_timestamps[curr_idx+1]-all_timestamps[curr_idx])
-
+                done.put((pos, transform(chunk)))
+            del item, chunk
+    finally:
+        done.put(None)
+        writer.join()
+        # unblock the reader if we stopped early
+        stop.set()
+        while reader.is_alive():
+            try:
+                todo.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        if pool:
+            pool.terminate()
+            pool.join()
+    if errors:
+        raise errors[0]
+
+def find_timestamp_resets(timestamps, chunk_size=1<<20, stop=None):
+    # Rows where the timestamp jumps back and the size of each jump, one chunk at a time
+    #     (timestamps can be a dataset, only chunk_size rows are read at once), up to row stop
+    stop = len(timestamps) if stop is None else min(stop, len(timestamps))
+    rows, jumps = [], []
+    prev = None
+    for pos in range(0, stop, chunk_size):
+        chunk = np.ravel(timestamps[pos:min(pos + chunk_size, stop)]).astype('float64')
+        steps = np.diff(chunk) if prev is None else np.diff(np.r_[prev, chunk])
+        back = np.flatnonzero(steps < 0)
+        rows.append(back + (pos + 1 if prev is None else pos))
+        jumps.append(-steps[back])
+        prev = chunk[-1]
+    if not rows:
+        return np.zeros(0, dtype='int64'), np.zeros(0)
+    return np.concatenate(rows).astype('int64'), np.concatenate(jumps)
+
+def check_and_fix_timestamps(h5f, chunk_size=1<<20):
+    # Makes the timestamps of the valid rows monotonic: each jump back is cancelled by an offset
+    #     on all later rows, so the first row after a reset repeats the timestamp before it.
+    #     The original timestamps are kept in orig_timestamp, the resets (row, jump) in
+    #     timestamp_resets.
+    ep = get_real_endpoint(h5f)
+    timestamps = h5f['timestamp']
+    rows, jumps = find_timestamp_resets(timestamps, chunk_size, stop=ep)
+    if not len(rows):
+        return
+    print('Broken timestamps found ({} resets)! Fixing...'.format(len(rows)))
+    if 'orig_timestamp' in h5f:
+        del h5f['orig_timestamp']
+    orig = h5f.create_dataset('orig_timestamp', shape=timestamps.shape, dtype=timestamps.dtype)
+    orig.attrs['valid_length'] = ep
+    if 'timestamp_resets' in h5f:
+        del h5f['timestamp_resets']
+    h5f.create_dataset('timestamp_resets', data=np.stack([rows, jumps], axis=1))
+    offsets = np.r_[0., np.cumsum(jumps)]
+    prev = -np.inf
+    for pos in range(0, len(timestamps), chunk_size):
+        chunk = timestamps[pos:pos + chunk_size]
+        orig[pos:pos + len(chunk)] = chunk
+        # Offset of each row: sum of the jumps at or before it
+        valid = max(min(ep - pos, len(chunk)), 0)
+        fixed = np.ravel(chunk).astype('float64')
+        fixed[:valid] += offsets[np.searchsorted(rows, np.arange(pos, pos + valid), side='right')]
+        # Rounding of the offsets must not leave tiny steps back, padding is left alone
+        fixed[:valid] = np.maximum.accumulate(np.r_[prev, fixed[:valid]])[1:]
+        if valid:
+            prev = fixed[valid - 1]
+        timestamps[pos:pos + len(chunk)] = fixed.reshape(chunk.shape)
 
 def get_start_stop_contigs(all_idxs):
     # Find where there are jumps
@@ -67,9 +204,9 @@ def calc_data_mean(h5f, group_key, chunksize=1024*10, axes=(0), force=False):
     #     Chunking on ranges (start:stop) is actually a fair bit faster than chunking on
     #     individual indices.
     new_mean = np.sum([np.sum([group.astype('double').sum(axis=axes)
-                       for group in chunker(h5f[group_key][start:stop], chunksize)], axis=0)
+                       for group in chunker(h5f[group_key][train_idxs[start]:train_idxs[stop-1]+1], chunksize)], axis=0)
                             for start, stop in zip(starts, stops)], axis=0)
-    new_mean = new_mean.astype('float64') / len(h5f[group_key][train_idxs])
+    new_mean = new_mean.astype('float64') / len(train_idxs)
     # Replace
     if force and group_key+'_mean' in h5f:
         del h5f[group_key+'_mean']
@@ -84,9 +221,9 @@ def calc_data_std(h5f, group_key, chunksize=1024*10, axes=(0), force=False):
 
     # Do it as parallel as possible, using the mean to upcast it to double
     sum_sq_val = np.sum([np.sum([np.sum((group-mean_val)**2,axis=axes)
-                                    for group in chunker(h5f[group_key][start:stop], chunksize)], axis=0)
+                                    for group in chunker(h5f[group_key][train_idxs[start]:train_idxs[stop-1]+1], chunksize)], axis=0)
                                         for start, stop in zip(starts, stops)], axis=0)
-    std_val = np.sqrt(sum_sq_val/len(h5f[group_key][train_idxs]))
+    std_val = np.sqrt(sum_sq_val/len(train_idxs))
     std_val[std_val==0] = 1.
     # Replace
     if force and group_key+'_std' in h5f:
@@ -94,99 +231,274 @@ def calc_data_std(h5f, group_key, chunksize=1024*10, axes=(0), force=False):
     h5f.create_dataset(group_key+'_std', data=np.array(std_val))
     return
 
+class RunningStats(object):
+    # Streaming mean and variance over the first axis, one chunk at a time (Welford/Chan),
+    #     mergeable across chunks and files. Saved like calc_data_mean/calc_data_std, plus
+    #     the count and the unclamped variance needed to merge saved stats.
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    # Bytes of float64 rows upcast at a time, a chunk of split_timesteps frames would take ~1 GB
+    UPDATE_BYTES = 1 << 26
+
+    def update(self, chunk):
+        if len(chunk) == 0:
+            return
+        rows = max(self.UPDATE_BYTES // (8 * max(int(np.prod(np.shape(chunk)[1:])), 1)), 1)
+        for pos in range(0, len(chunk), rows):
+            part = np.asarray(chunk[pos:pos + rows], dtype='float64')
+            mean = part.mean(axis=0)
+            self._merge(len(part), mean, ((part - mean)**2).sum(axis=0))
+
+    def merge(self, other):
+        if other.count:
+            self._merge(other.count, other.mean, other.m2)
+        return self
+
+    def _merge(self, count, mean, m2):
+        if not self.count:
+            self.count, self.mean, self.m2 = count, np.array(mean, dtype='float64'), np.array(m2, dtype='float64')
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (float(count) / total)
+        self.m2 = self.m2 + m2 + delta**2 * (float(self.count) * count / total)
+        self.count = total
+
+    @property
+    def var(self):
+        return self.m2 / max(self.count, 1)
+
+    @property
+    def std(self):
+        std_val = np.sqrt(self.var)
+        std_val[std_val==0] = 1.
+        return std_val
+
+    def save(self, h5f, group_key, force=False):
+        for suffix, data in (('_mean', self.mean), ('_std', self.std), ('_var', self.var), ('_count', self.count)):
+            if force and group_key+suffix in h5f:
+                del h5f[group_key+suffix]
+            h5f.create_dataset(group_key+suffix, data=np.array(data))
+
+    @classmethod
+    def load(cls, h5f, group_key):
+        stats = cls()
+        stats._merge(int(h5f[group_key+'_count'][()]), h5f[group_key+'_mean'][:],
+                     h5f[group_key+'_var'][:] * int(h5f[group_key+'_count'][()]))
+        return stats
+
+def merge_stats(h5fs, group_keys):
+    # Global statistics of a dataset split over several files, from the saved per-file stats
+    stats = RunningStats()
+    for h5f, group_key in zip(h5fs, group_keys):
+        stats.merge(RunningStats.load(h5f, group_key))
+    return stats
+
+def split_ranges(timestamps, t_start, train_div=5*60, test_div=1*60):
+    # (start, stop) row ranges of alternating train_div long train and test_div long test
+    #     periods, starting at t_start. A row belongs to the period its timestamp falls in,
+    #     rows after a timestamp jump back stay in the period of the latest timestamp.
+    timestamps = np.maximum.accumulate(np.ravel(timestamps))
+    if not len(timestamps):
+        empty = np.zeros((0, 2), dtype='int64')
+        return empty, empty
+    num_periods = int(max(timestamps[-1] - t_start, 0) // (train_div + test_div)) + 1
+    period_starts = t_start + np.arange(num_periods + 1) * (train_div + test_div)
+    # Period boundaries: train start, test start, next train start, ...
+    edges = np.empty(2 * num_periods + 1)
+    edges[0::2] = period_starts
+    edges[1::2] = period_starts[:-1] + train_div
+    rows = np.searchsorted(timestamps, edges, side='right')
+    rows[0] = 0
+    rows[-1] = len(timestamps)
+    ranges = np.stack([rows[:-1], rows[1:]], axis=1).astype('int64')
+    train_ranges, test_ranges = ranges[0::2], ranges[1::2]
+    return train_ranges[train_ranges[:, 1] > train_ranges[:, 0]], test_ranges[test_ranges[:, 1] > test_ranges[:, 0]]
+
+def ranges_to_idxs(ranges):
+    if not len(ranges):
+        return np.zeros(0, dtype='int64')
+    return np.concatenate([np.arange(start, stop) for start, stop in ranges])
+
+def save_split(h5fs, train_ranges, test_ranges, force=False):
+    # Write the split into each file, as ranges and (for older readers) as index lists
+    data = {'train_ranges': train_ranges, 'test_ranges': test_ranges,
+            'train_idxs': ranges_to_idxs(train_ranges), 'test_idxs': ranges_to_idxs(test_ranges)}
+    for h5f in h5fs:
+        for key, value in data.items():
+            # Replace as necessary
+            if force and key in h5f:
+                del h5f[key]
+            h5f.create_dataset(key, data=value)
+
 def build_simul_train_test_split(h5f_aps, h5f_dvs_accum, h5f_dvs_split, train_div=5*60, test_div=1*60, force=False):
     ep = get_common_endpoint(h5f_aps, h5f_dvs_accum)
-    train_idxs, test_idxs = [], []
-    curr_idx = 0
-    curr_ts_aps = h5f_aps['timestamp'][0]
-    curr_ts_dvs_accum = h5f_dvs_accum['timestamp'][0]
-    curr_ts_dvs_split = h5f_dvs_split['timestamp'][0]
-    curr_ts = max(curr_ts_aps, curr_ts_dvs_accum, curr_ts_dvs_split)
-
-    while curr_idx < len(h5f_aps['timestamp'][:ep]) and curr_idx < len(h5f_dvs_accum['timestamp'][:ep]) and curr_idx < len(h5f_dvs_split['timestamp'][:ep]):
-        # Get train indexes
-        stop_idx = np.where(h5f_aps['timestamp'][curr_idx:ep] > curr_ts+train_div)[0]
-        stop_idx = stop_idx[0] if np.any(stop_idx) else ep-curr_idx
-        train_idxs.extend(range(curr_idx, curr_idx+stop_idx))
-        curr_ts = curr_ts+train_div
-        curr_idx = curr_idx+stop_idx
-        # Get test indexes
-        stop_idx = np.where(h5f_aps['timestamp'][curr_idx:ep] > curr_ts+test_div)[0]
-        stop_idx = stop_idx[0] if np.any(stop_idx) else ep-curr_idx
-        test_idxs.extend(range(curr_idx, curr_idx+stop_idx))
-        curr_ts = curr_ts+test_div
-        curr_idx = curr_idx+stop_idx
-    # Replace as necessary
-    if force and (('train_idxs' in h5f_aps) or ('train_idxs' in h5f_dvs_accum) or ('train_idxs' in h5f_dvs_split)):
-        del h5f_aps['train_idxs']
-        del h5f_dvs_accum['train_idxs']
-        del h5f_dvs_split['train_idxs']
-    h5f_aps.create_dataset('train_idxs', data=np.array(train_idxs))
-    h5f_dvs_accum.create_dataset('train_idxs', data=np.array(train_idxs))
-    h5f_dvs_split.create_dataset('train_idxs', data=np.array(train_idxs))
-    if force and (('test_idxs' in h5f_aps) or ('test_idxs' in h5f_dvs_accum) or ('test_idxs' in h5f_dvs_split)):
-        del h5f_aps['test_idxs']
-        del h5f_dvs_accum['test_idxs']
-        del h5f_dvs_split['test_idxs']
-    h5f_aps.create_dataset('test_idxs', data=np.array(test_idxs))
-    h5f_dvs_accum.create_dataset('test_idxs', data=np.array(test_idxs))
-    h5f_dvs_split.create_dataset('test_idxs', data=np.array(test_idxs))
+    curr_ts = max(h5f_aps['timestamp'][0], h5f_dvs_accum['timestamp'][0], h5f_dvs_split['timestamp'][0])
+    train_ranges, test_ranges = split_ranges(h5f_aps['timestamp'][:ep], curr_ts, train_div, test_div)
+    save_split([h5f_aps, h5f_dvs_accum, h5f_dvs_split], train_ranges, test_ranges, force=force)
     return
 
 def build_train_test_split(h5f, train_div=5*60, test_div=1*60, force=False):
     ep = get_real_endpoint(h5f)
-    train_idxs, test_idxs = [], []
-    curr_idx, curr_ts = 0, h5f['timestamp'][0]
-    while curr_idx < len(h5f['timestamp'][:ep]):
-        # Get train indexes
-        stop_idx = np.where(h5f['timestamp'][curr_idx:ep] > curr_ts+train_div)[0]
-        stop_idx = stop_idx[0] if np.any(stop_idx) else ep-curr_idx
-        train_idxs.extend(range(curr_idx, curr_idx+stop_idx))
-        curr_ts = curr_ts+train_div
-        curr_idx = curr_idx+stop_idx
-        # Get test indexes
-        stop_idx = np.where(h5f['timestamp'][curr_idx:ep] > curr_ts+test_div)[0]
-        stop_idx = stop_idx[0] if np.any(stop_idx) else ep-curr_idx
-        test_idxs.extend(range(curr_idx, curr_idx+stop_idx))
-        curr_ts = curr_ts+test_div
-        curr_idx = curr_idx+stop_idx
-    # Replace as necessary
-    if force and 'train_idxs' in h5f:
-        del h5f['train_idxs']
-    h5f.create_dataset('train_idxs', data=np.array(train_idxs))
-    if force and 'test_idxs' in h5f:
-        del h5f['test_idxs']
-    h5f.create_dataset('test_idxs', data=np.array(test_idxs))
+    timestamps = h5f['timestamp'][:ep]
+    train_ranges, test_ranges = split_ranges(timestamps, timestamps[0], train_div, test_div)
+    save_split([h5f], train_ranges, test_ranges, force=force)
     return
 
-class MultiHDF5SeqVisualIterator(object):
+def build_train_test_splits(h5fs, train_div=5*60, test_div=1*60, force=False):
+    # Split of every file on its own
+    for h5f in h5fs:
+        build_train_test_split(h5f, train_div=train_div, test_div=test_div, force=force)
+
+# Bits of the flags of SampleIndex samples
+FLAG_TRAIN = 1
+FLAG_TEST = 2
+# a sequence of seq_length rows can start here, see SampleIndex.file_samples
+FLAG_SEQ = 4
+SPLIT_FLAGS = {'train_idxs': FLAG_TRAIN, 'test_idxs': FLAG_TEST}
+SAMPLE_DTYPE = np.dtype([('file_id', 'int32'), ('row', 'int64'), ('timestamp', 'float64'),
+                         ('label', 'float32'), ('flags', 'uint8')])
+
+class SampleIndex(object):
+    # Train and test samples of a list of files as one structured array of SAMPLE_DTYPE,
+    #     in file and row order. file_id is the position of the file in the list, label the
+    #     steering wheel angle. Built once per run (and with cache_dir once per file list),
+    #     shuffled by permuting the array.
+    VERSION = 1
+
+    def __init__(self, samples, fnames, seq_length=None, speed_gt=0):
+        self.samples = samples
+        self.fnames = list(fnames)
+        self.seq_length = seq_length
+        self.speed_gt = speed_gt
+
+    def __len__(self):
+        return len(self.samples)
+
+    def select(self, indexes_key, seq=False):
+        # Samples of the train_idxs or test_idxs split, with seq only the sequence starts
+        mask = (self.samples['flags'] & SPLIT_FLAGS[indexes_key]) != 0
+        if seq:
+            mask &= (self.samples['flags'] & FLAG_SEQ) != 0
+        return self.samples[mask]
+
+    @staticmethod
+    def file_samples(h5f, file_id=0, seq_length=None, speed_gt=0):
+        # With seq_length, FLAG_SEQ marks the rows whose row + seq_length is in the same split,
+        #     with the vehicle speed above speed_gt in between (MultiHDF5SeqVisualIterator)
+        timestamps = np.ravel(h5f['timestamp'][:])
+        flags = np.zeros(len(timestamps), dtype='uint8')
+        for key, flag in SPLIT_FLAGS.items():
+            if key in h5f:
+                flags[np.array(h5f[key], dtype='int64')] |= flag
+        if seq_length:
+            start = np.arange(max(len(flags) - seq_length, 0))
+            slow = np.r_[0, np.cumsum(~(np.ravel(h5f['vehicle_speed'][:]) > speed_gt))]
+            ok = ((flags[start + seq_length] & flags[start]) != 0) & (slow[start + seq_length] == slow[start])
+            flags[start[ok]] |= FLAG_SEQ
+        rows = np.flatnonzero(flags & (FLAG_TRAIN | FLAG_TEST))
+        samples = np.zeros(len(rows), dtype=SAMPLE_DTYPE)
+        samples['file_id'] = file_id
+        samples['row'] = rows
+        samples['timestamp'] = timestamps[rows]
+        if 'steering_wheel_angle' in h5f:
+            samples['label'] = np.ravel(h5f['steering_wheel_angle'][:])[rows]
+        else:
+            samples['label'] = np.nan
+        samples['flags'] = flags[rows]
+        return samples
+
+    @classmethod
+    def build(cls, h5fs, seq_length=None, speed_gt=0):
+        samples = [cls.file_samples(h5f, i, seq_length, speed_gt) for i, h5f in enumerate(h5fs)]
+        samples = np.concatenate(samples) if samples else np.zeros(0, dtype=SAMPLE_DTYPE)
+        return cls(samples, [h5f.filename for h5f in h5fs], seq_length, speed_gt)
+
+    @classmethod
+    def cache_name(cls, h5fs, seq_length=None, speed_gt=0):
+        # Cache file of a config: the files (path, size, mtime) and the sequence filter
+        config = [cls.VERSION, seq_length, speed_gt]
+        for h5f in h5fs:
+            st = os.stat(h5f.filename)
+            config.append((os.path.abspath(h5f.filename), st.st_size, st.st_mtime))
+        return 'samples_{}.npz'.format(hashlib.sha1(repr(config).encode()).hexdigest()[:16])
+
+    def save(self, fname):
+        tmp = fname + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, samples=self.samples, fnames=np.array(self.fnames),
+                     seq_length=self.seq_length or 0, speed_gt=self.speed_gt)
+        os.replace(tmp, fname)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as d:
+            return cls(d['samples'], [str(f) for f in d['fnames']],
+                       int(d['seq_length']) or None, d['speed_gt'].item())
+
+    @classmethod
+    def cached(cls, h5fs, cache_dir=None, seq_length=None, speed_gt=0):
+        # Loads the index from cache_dir if the files didn't change, otherwise builds (and saves) it
+        if not cache_dir:
+            return cls.build(h5fs, seq_length, speed_gt)
+        fname = os.path.join(cache_dir, cls.cache_name(h5fs, seq_length, speed_gt))
+        if os.path.exists(fname):
+            return cls.load(fname)
+        index = cls.build(h5fs, seq_length, speed_gt)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        index.save(fname)
+        return index
+
+def read_samples(h5fs, dataset_keys, samples):
+    # Frames of a batch of SampleIndex samples, in batch order. Read sorted by file and row,
+    #     one read per file.
+    order = np.lexsort((samples['row'], samples['file_id']))
+    file_ids, rows = samples['file_id'][order], samples['row'][order]
+    starts = np.flatnonzero(np.diff(file_ids)) + 1
+    frames = np.concatenate([h5fs[f[0]][dataset_keys[f[0]]][r]
+                             for f, r in zip(np.split(file_ids, starts), np.split(rows, starts))])
+    out = np.empty_like(frames)
+    out[order] = frames
+    return out
+
+class SampleIndexCache(object):
+    # Base of the Multi* iterators: keeps the SampleIndex of every file list it is asked for,
+    #     so flow doesn't rebuild it every epoch. cache_dir keeps them across runs.
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.indexes = {}
+
+    def sample_index(self, h5fs, seq_length=None, speed_gt=0):
+        key = (tuple(h5f.filename for h5f in h5fs), seq_length, speed_gt)
+        if key not in self.indexes:
+            self.indexes[key] = SampleIndex.cached(h5fs, self.cache_dir, seq_length, speed_gt)
+        return self.indexes[key]
+
+class MultiHDF5SeqVisualIterator(SampleIndexCache):
     def flow(self, h5fs, dataset_keys, indexes_key, batch_size, seq_length=30, shuffle=True, return_time=False, speed_gt=0):
         # Get some constants
-        all_data_idxs = []
-        dataset_lookup = {h5f:dataset_key for h5f, dataset_key in zip(h5fs, dataset_keys)}
-        for h5f in h5fs:
-            avail_idxs = set(np.array(h5f[indexes_key]))
-            for idx in np.array(h5f[indexes_key]):
-                # Check to make sure whole sequence is in the same train/test, and filter on speed
-                above_speed = np.all(np.array(h5f['vehicle_speed'][idx:idx+seq_length]) > speed_gt)
-                if (idx+seq_length in avail_idxs) and above_speed:
-                    all_data_idxs.append((h5f, idx))
-        num_examples = len(all_data_idxs)
+        # Sequences that stay in the same train/test split, filtered on speed
+        all_samples = self.sample_index(h5fs, seq_length=seq_length, speed_gt=speed_gt).select(indexes_key, seq=True)
+        num_examples = len(all_samples)
         num_batches = int(np.ceil(float(num_examples)/batch_size))
         # Shuffle the data
         if shuffle:
-            np.random.shuffle(all_data_idxs)
+            all_samples = all_samples[np.random.permutation(num_examples)]
         b = 0
         while b < num_batches:
-            curr_idxs = all_data_idxs[b*batch_size:(b+1)*batch_size]
-            todo_dict = defaultdict(list)
-            for (h5f, idx) in curr_idxs:
-                todo_dict[h5f].append(idx)
+            curr_samples = all_samples[b*batch_size:(b+1)*batch_size]
+            # Read file by file, in row order
+            curr_samples = curr_samples[np.lexsort((curr_samples['row'], curr_samples['file_id']))]
             vids, bY, times = [], [], []
-            for h5f, idxs in todo_dict.items():
-                vids.extend([np.array(h5f[dataset_lookup[h5f]][curr_idx:curr_idx+seq_length]) for curr_idx in idxs])
-                bY.extend([h5f['steering_wheel_angle'][curr_idx:curr_idx+seq_length] for curr_idx in idxs])
-                times.extend([h5f['timestamp'][curr_idx:curr_idx+seq_length] for curr_idx in idxs])
+            for file_id, curr_idx in zip(curr_samples['file_id'], curr_samples['row']):
+                h5f = h5fs[file_id]
+                vids.append(np.array(h5f[dataset_keys[file_id]][curr_idx:curr_idx+seq_length]))
+                bY.append(h5f['steering_wheel_angle'][curr_idx:curr_idx+seq_length])
+                times.append(h5f['timestamp'][curr_idx:curr_idx+seq_length])
 
             # Add a single-dimensional color channel for grayscale
             vids = np.expand_dims(vids, axis=2).astype('float32')/255.-0.5
@@ -251,41 +563,25 @@ class HDF5VisualIterator(object):
             yield [vid.astype('float32'), bY.astype('float32')]
             b += 1
 
-class MultiHDF5EncoderDecoderVisualIterator(object):
+class MultiHDF5EncoderDecoderVisualIterator(SampleIndexCache):
     def flow(self, h5fs_aps, h5fs_dvs, dataset_keys_aps, dataset_keys_dvs, indexes_key, batch_size, shuffle=True, seperate_dvs_channels=False):
         # Get some constants
-        all_data_idxs_aps = []
-        dataset_lookup_aps = {h5f:dataset_key for h5f, dataset_key in zip(h5fs_aps, dataset_keys_aps)}
-        for h5f in h5fs_aps:
-            for idx in np.array(h5f[indexes_key]):
-                all_data_idxs_aps.append((h5f, idx))
-        all_data_idxs_dvs = []
-        dataset_lookup_dvs = {h5f:dataset_key for h5f, dataset_key in zip(h5fs_dvs, dataset_keys_dvs)}
-        for h5f in h5fs_dvs:
-            for idx in np.array(h5f[indexes_key]):
-                all_data_idxs_dvs.append((h5f, idx))
-        num_examples_aps = len(all_data_idxs_aps)
-        num_examples_dvs = len(all_data_idxs_dvs)
+        # APS and DVS samples are paired by their position in the two indexes
+        all_samples_aps = self.sample_index(h5fs_aps).select(indexes_key)
+        all_samples_dvs = self.sample_index(h5fs_dvs).select(indexes_key)
+        num_examples_aps = len(all_samples_aps)
+        num_examples_dvs = len(all_samples_dvs)
         num_examples = min(num_examples_aps, num_examples_dvs)
         num_batches = int(np.ceil(float(num_examples)/batch_size))
-        # Shuffle the data
+        all_samples_aps, all_samples_dvs = all_samples_aps[:num_examples], all_samples_dvs[:num_examples]
+        # Shuffle the data, both with the same permutation
         if shuffle:
-            all_data_idxs_aps, all_data_idxs_dvs = sklearn.utils.shuffle(all_data_idxs_aps[:num_examples], all_data_idxs_dvs[:num_examples])
-            # np.random.shuffle(all_data_idxs)
+            perm = np.random.permutation(num_examples)
+            all_samples_aps, all_samples_dvs = all_samples_aps[perm], all_samples_dvs[perm]
         b = 0
         while b < num_batches:
-            curr_idxs_aps = all_data_idxs_aps[b*batch_size:(b+1)*batch_size]
-            curr_idxs_dvs = all_data_idxs_dvs[b*batch_size:(b+1)*batch_size]
-            todo_dict_aps = defaultdict(list)
-            todo_dict_dvs = defaultdict(list)
-            for (h5f_aps, idx_aps), (h5f_dvs, idx_dvs) in zip(curr_idxs_aps, curr_idxs_dvs):
-                todo_dict_aps[h5f_aps].append(idx_aps)
-                todo_dict_dvs[h5f_dvs].append(idx_dvs)
-            vids_aps = []
-            vids_dvs = []
-            for (h5f_aps, idxs_aps), (h5f_dvs, idxs_dvs) in zip(todo_dict_aps.items(), todo_dict_dvs.items()):
-                vids_aps.extend(h5f_aps[dataset_lookup_aps[h5f_aps]][sorted(idxs_aps)])
-                vids_dvs.extend(h5f_dvs[dataset_lookup_dvs[h5f_dvs]][sorted(idxs_dvs)])
+            vids_aps = read_samples(h5fs_aps, dataset_keys_aps, all_samples_aps[b*batch_size:(b+1)*batch_size])
+            vids_dvs = read_samples(h5fs_dvs, dataset_keys_dvs, all_samples_dvs[b*batch_size:(b+1)*batch_size])
 
             # Add a single-dimensional color channel for grayscale
             vids_aps = np.expand_dims(vids_aps, axis=1).astype('float32')/255.-0.5
@@ -301,30 +597,20 @@ class MultiHDF5EncoderDecoderVisualIterator(object):
             b += 1
 
 
-class MultiHDF5VisualIterator(object):
+class MultiHDF5VisualIterator(SampleIndexCache):
     def flow(self, h5fs, dataset_keys, indexes_key, batch_size, shuffle=True, seperate_dvs_channels=False):
         # Get some constants
-        all_data_idxs = []
-        dataset_lookup = {h5f:dataset_key for h5f, dataset_key in zip(h5fs, dataset_keys)}
-        for h5f in h5fs:
-            for idx in np.array(h5f[indexes_key]):
-                all_data_idxs.append((h5f, idx))
-        num_examples = len(all_data_idxs)
+        all_samples = self.sample_index(h5fs).select(indexes_key)
+        num_examples = len(all_samples)
         num_batches = int(np.ceil(float(num_examples)/batch_size))
         # Shuffle the data
         if shuffle:
-            np.random.shuffle(all_data_idxs)
+            all_samples = all_samples[np.random.permutation(num_examples)]
         b = 0
         while b < num_batches:
-            curr_idxs = all_data_idxs[b*batch_size:(b+1)*batch_size]
-            todo_dict = defaultdict(list)
-            for (h5f, idx) in curr_idxs:
-                todo_dict[h5f].append(idx)
-            vids = []
-            bY = []
-            for h5f, idxs in todo_dict.items():
-                vids.extend(h5f[dataset_lookup[h5f]][sorted(idxs)])
-                bY.extend(h5f['steering_wheel_angle'][sorted(idxs)])
+            curr_samples = all_samples[b*batch_size:(b+1)*batch_size]
+            vids = read_samples(h5fs, dataset_keys, curr_samples)
+            bY = curr_samples['label']
 
             # Add a single-dimensional color channel for grayscale
             if seperate_dvs_channels:
@@ -353,15 +639,78 @@ def resize_int16(frame, size=(60,80), method='bilinear', climit=[-15,15], sepera
         out_frame = img_as_ubyte(resize(np.clip(frame, climit[0], climit[1]), (size[0], size[1])))
     return out_frame
 
+def ubyte_scale(dtype):
+    # Factor skimage's img_as_float -> img_as_ubyte round trip applies to values of this dtype
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'ui':
+        return 255. / np.iinfo(dtype).max
+    return 255.
+
+def area_weights(n_in, n_out):
+    # (n_out, n_in) matrix averaging the input pixels each output pixel covers,
+    #     the weights cv2.INTER_AREA uses when shrinking
+    edges = np.arange(n_out + 1) * (float(n_in) / n_out)
+    pix = np.arange(n_in)
+    overlap = np.minimum(pix[None, :] + 1, edges[1:, None]) - np.maximum(pix[None, :], edges[:-1, None])
+    return (overlap.clip(0) * (float(n_out) / n_in)).astype('float32')
+
+def area_resize(frames, size, group_size=1024):
+    # Area resize of the last two axes of a stack of frames, as float32,
+    #     group_size frames at a time to bound the float32 copies
+    lead, (h, w) = frames.shape[:-2], frames.shape[-2:]
+    frames = frames.reshape((-1, h, w))
+    out = np.empty((len(frames),) + tuple(size), dtype='float32')
+    if h % size[0] == 0 and w % size[1] == 0:
+        # Integer factors, plain average pooling
+        fh, fw = h // size[0], w // size[1]
+        for pos in range(0, len(frames), group_size):
+            group = frames[pos:pos + group_size]
+            out[pos:pos + group_size] = group.reshape(-1, size[0], fh, size[1], fw).mean(axis=(2, 4), dtype='float32')
+    elif h >= size[0] and w >= size[1]:
+        # Separable area weights, applied to all frames with two matrix products
+        #     (cv2.resize only does INTER_AREA on up to 4 channels for fractional factors)
+        wy, wx = area_weights(h, size[0]), area_weights(w, size[1]).T
+        for pos in range(0, len(frames), group_size):
+            group = frames[pos:pos + group_size].astype('float32')
+            out[pos:pos + group_size] = np.matmul(np.matmul(wy, group), wx)
+    else:
+        for i, frame in enumerate(frames):
+            out[i] = cv2.resize(frame.astype('float32'), (size[1], size[0]), interpolation=cv2.INTER_AREA)
+    return out.reshape(lead + tuple(size))
+
+def resize_batch(frames, size, climit=None):
+    # Batched version of resize_int8 / resize_int16: resizes all frames of a chunk
+    #     (..., H, W) at once and scales to uint8 the way img_as_ubyte does for the input dtype
+    scale = ubyte_scale(frames.dtype)
+    if climit is not None:
+        frames = np.clip(frames, climit[0], climit[1])
+    out = area_resize(frames, size)
+    out *= scale
+    np.rint(out, out=out)
+    np.clip(out, 0, 255, out=out)
+    return out.astype('uint8')
+
 def dvs_to_aps(dvs_image, model, device):
+    # torch is only needed for the encoder, the rest of the module works without it
+    import torch
     dvs_batch = dvs_image[None, ...] # Create batch of size 1
     with torch.no_grad():
         aps_batch = model(torch.from_numpy(dvs_batch).to(device=device, dtype=torch.float))
     aps_image = aps_batch[0, 0, ...]
     return aps_image
 
-def run_dvs_to_aps_into_new_key(h5f, key, new_key, new_size, pretrained_model_path, chunk_size=1024, timesteps = 20):
+# Encoder of the current (worker) process, see init_encoder
+_encoder = None
+# Frames per forward pass of the encoder
+ENCODER_BATCH = 32
+
+def init_encoder(pretrained_model_path, timesteps=20, num_threads=None):
+    global _encoder
+    import torch
+    import Nets_Spiking_BNTT
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    if num_threads:
+        torch.set_num_threads(num_threads)
     model_args = {'timesteps': timesteps,
                   'img_size': 80,
                   'inp_maps': 2,
@@ -369,13 +718,37 @@ def run_dvs_to_aps_into_new_key(h5f, key, new_key, new_size, pretrained_model_pa
                   'inp_type': 'dvs',
                   'encoder_decoder': True}
     encoder_network = Nets_Spiking_BNTT.SNN_VGG9_TBN(**model_args)
-    encoder_network.load_state_dict(torch.load(pretrained_model_path))
+    encoder_network.load_state_dict(torch.load(pretrained_model_path, map_location=device))
     encoder_network.eval()
     encoder_network.to(device)
-    chunk_generator = yield_chunker(h5f[key], chunk_size)
+    _encoder = (encoder_network, device)
+
+def encode_chunk(chunk, batch_size=ENCODER_BATCH):
+    # Same as dvs_to_aps on every frame, batch_size frames per forward pass. In eval mode
+    #     SNN_VGG9_TBN doesn't mix frames of a batch (batchnorm uses its running statistics,
+    #     dropout is off), so batching doesn't change the output.
+    import torch
+    encoder_network, device = _encoder
+    # inference_mode is faster where available (torch >= 1.9)
+    inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+    out = None
+    with inference_mode():
+        for pos in range(0, len(chunk), batch_size):
+            batch = torch.from_numpy(np.ascontiguousarray(chunk[pos:pos + batch_size]))
+            aps_batch = encoder_network(batch.to(device=device, dtype=torch.float))[:, 0]
+            if out is None:
+                out = np.empty((len(chunk),) + tuple(aps_batch.shape[1:]), dtype='float32')
+            out[pos:pos + len(aps_batch)] = aps_batch.cpu().numpy()
+    return out
+
+def run_dvs_to_aps_into_new_key(h5f, key, new_key, new_size, pretrained_model_path, chunk_size=1024, timesteps = 20, workers=0,
+                                batch_size=ENCODER_BATCH, num_threads=None, access=ACCESS_RANDOM, seq_length=1):
+    # Every worker loads its own copy of the model, keep workers=0 when running on the GPU.
+    #     num_threads: torch CPU threads per process, by default the cores are shared by the workers
+    #     access, seq_length: how the new key will be read, see chunk_layout
+    if num_threads is None and workers:
+        num_threads = max(mp.cpu_count() // workers, 1)
     # Set some basics
-    dtype = h5f[key].dtype
-    row_idx = 0
     resized_shape = (chunk_size,) + new_size
     print(resized_shape)
     max_shape = (h5f[key].shape[0],) + resized_shape[1:]
@@ -383,29 +756,21 @@ def run_dvs_to_aps_into_new_key(h5f, key, new_key, new_size, pretrained_model_pa
     if new_key in h5f:
         dset = h5f[new_key]
     else:
-        dset = h5f.create_dataset(new_key, shape=max_shape, maxshape=max_shape,
-                            chunks=resized_shape, dtype='uint8')
-    # Write all data out, one chunk at a time
-    for chunk in chunk_generator:
-        # Operate on the data
-        encoded_chunk = np.array([dvs_to_aps(frame, encoder_network, device).cpu().numpy() for frame in chunk])
-        print(encoded_chunk.shape)
-        # Write the next chunk
-        dset[row_idx:row_idx+chunk.shape[0]] = encoded_chunk
-        # Increment the row count
-        row_idx += chunk.shape[0]
-
-def resize_data_into_new_key(h5f, key, new_key, new_size, chunk_size=1024, seperate_dvs_channels=False, split_timesteps=False, timesteps = 10):
-    chunk_generator = yield_chunker(h5f[key], chunk_size)
-
-    # Set some basics
-    dtype = h5f[key].dtype
-    row_idx = 0
-
+        dset = create_frame_dataset(h5f, new_key, max_shape, access=access, seq_length=seq_length)
+    # Write all data out, chunks are encoded while the next ones are read
+    run_chunk_pipeline(h5f[key], dset, partial(encode_chunk, batch_size=batch_size),
+                       chunk_size=chunk_size, workers=workers,
+                       initializer=init_encoder, initargs=(pretrained_model_path, timesteps, num_threads))
+    dset.attrs['valid_length'] = get_real_endpoint(h5f)
+
+def resize_data_into_new_key(h5f, key, new_key, new_size, chunk_size=1024, seperate_dvs_channels=False, split_timesteps=False, timesteps = 10, workers=None, calc_stats=False,
+                             access=ACCESS_RANDOM, seq_length=1):
+    # With calc_stats, returns RunningStats of the resized train_idxs rows, computed on the way.
+    #     access, seq_length: how the new key will be read, see chunk_layout
     if key == 'aps_frame':
-        do_resize = resize_int8
+        climit = None
     elif key == 'dvs_accum' or key == 'dvs_split' or key == 'dvs_channels':
-        do_resize = resize_int16
+        climit = [-15, 15]
     else:
         raise AssertionError('Unknown data type')
     # Initialize a resizable dataset to hold the output
@@ -420,21 +785,18 @@ def resize_data_into_new_key(h5f, key, new_key, new_size, chunk_size=1024, seper
     if new_key in h5f:
         dset = h5f[new_key]
     else:
-        dset = h5f.create_dataset(new_key, shape=max_shape, maxshape=max_shape,
-                            chunks=resized_shape, dtype='uint8')
-    # Write all data out, one chunk at a time
-    for chunk in chunk_generator:
-        # Operate on the data
-        if split_timesteps:
-            resized_chunk = np.array([do_resize(frame, new_size, split_timesteps=split_timesteps, timesteps=timesteps) for frame in chunk])
-        elif seperate_dvs_channels:
-            resized_chunk = np.array([do_resize(frame, new_size, seperate_dvs_channels=seperate_dvs_channels) for frame in chunk])
-        else:
-            resized_chunk = np.array([do_resize(frame, new_size) for frame in chunk])
-        # Write the next chunk
-        dset[row_idx:row_idx+chunk.shape[0]] = resized_chunk
-        # Increment the row count
-        row_idx += chunk.shape[0]
+        dset = create_frame_dataset(h5f, new_key, max_shape, access=access, seq_length=seq_length)
+    stats, on_write = None, None
+    if calc_stats:
+        stats = RunningStats()
+        is_train = np.zeros(len(dset), dtype=bool)
+        is_train[np.array(h5f['train_idxs'], dtype='int64')] = True
+        on_write = lambda pos, out: stats.update(out[is_train[pos:pos+len(out)]])
+    # Write all data out, chunks are resized in parallel and written in order
+    run_chunk_pipeline(h5f[key], dset, partial(resize_batch, size=new_size, climit=climit),
+                       chunk_size=chunk_size, workers=workers, on_write=on_write)
+    dset.attrs['valid_length'] = get_real_endpoint(h5f)
+    return stats
 
 # def pad_datastreams(datastreams, rand_pad=10):
 #     num_streams = len(datastreams)
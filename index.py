@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+
+'''
+Sidecar index of a recording.
+
+Things that would otherwise need a full pass over the raw data on every
+launch are computed once and stored next to the recording, in
+<recording>.index.hdf5:
+
+ * timeline -- multi-resolution overview tracks: min/max/mean/count of
+   each VI channel, DVS event rate and APS frame rate per time bin,
+   from TIMELINE_DT bins down to MIN_BINS bins, halving at each level
+ * seek -- row timestamps of every table and the rows of all APS frames,
+   so a reader can jump to any point in time without touching the data
+ * time -- the device timestamp resets (special events) and the offset
+   that makes device time monotonic after each of them, so any packet can
+   be converted to recording time without reading what came before it
+
+The index is rebuilt automatically when the recording changes.
+
+This software is released under the
+GNU LESSER GENERAL PUBLIC LICENSE Version 3.
+
+Usage:
+ $ ./index.py <recording.hdf5|recording.manifest.json> [--force]
+'''
+
+from __future__ import print_function
+import os
+import json
+import argparse
+import numpy as np
+import h5py
+import segments
+from valid_length import valid_length
+from interfaces.caer import EVENT_TYPES, unpack_headers
+
+INDEX_EXT = '.index.hdf5'
+VERSION = 3
+
+TIMELINE_DT = 50000   # us, finest timeline bin
+MIN_BINS = 256        # coarsest timeline level
+READ_ROWS = 4096      # dvs rows read at once
+
+
+def index_name(fname):
+    return segments.base_name(fname) + INDEX_EXT
+
+
+def source_stamp(fname):
+    ''' identifies the state of the recording files '''
+    files = segments.segment_files(fname)
+    return json.dumps([(os.path.basename(f), os.path.getsize(f),
+                        int(os.path.getmtime(f))) for f in files])
+
+
+def vi_tables(rec):
+    return sorted(k for k in rec.keys() if k != 'dvs' and 'data' in rec[k])
+
+
+def read_dvs_headers(rec, n=None):
+    '''
+    Returns system timestamps (us) and packet headers (HEADER_DTYPE)
+    of the first n dvs rows.
+    '''
+    n = valid_length(rec['dvs']['timestamp']) if n is None else n
+    ts = rec['dvs']['timestamp'][:n]
+    ds = rec['dvs']['data']
+    headers = []
+    for a in range(0, n, READ_ROWS):
+        col = ds[a:min(a + READ_ROWS, n), 1]
+        headers.append(unpack_headers(b''.join(h.tobytes() for h in col)))
+    if not headers:
+        return ts[:0], unpack_headers(b'')
+    return ts[:n], np.concatenate(headers)
+
+
+# -- timeline --
+
+def _bin_stats(bins, vals, nbins):
+    '''
+    min, max, mean and count of vals per bin (bins sorted),
+    nan where a bin is empty
+    '''
+    out = np.full((nbins, 4), np.nan, dtype=np.float32)
+    out[:, 3] = 0
+    if not len(bins):
+        return out
+    starts = np.flatnonzero(np.r_[True, np.diff(bins) != 0])
+    ids = bins[starts]
+    count = np.diff(np.r_[starts, len(bins)])
+    out[ids, 0] = np.minimum.reduceat(vals, starts)
+    out[ids, 1] = np.maximum.reduceat(vals, starts)
+    out[ids, 2] = np.add.reduceat(vals, starts) / count
+    out[ids, 3] = count
+    return out
+
+
+def _rate_track(bins, weights, nbins, dt):
+    ''' per second rate, as a track with one sample per bin '''
+    rate = np.bincount(bins, weights=weights, minlength=nbins)[:nbins] / (dt * 1e-6)
+    out = np.empty((nbins, 4), dtype=np.float32)
+    out[:, 0] = out[:, 1] = out[:, 2] = rate
+    out[:, 3] = 1
+    return out
+
+
+def reduce_track(a):
+    ''' halve the resolution of a track '''
+    if len(a) % 2:
+        pad = np.full((1, 4), np.nan, dtype=a.dtype)
+        pad[0, 3] = 0
+        a = np.concatenate([a, pad])
+    a, b = a[0::2], a[1::2]
+    out = np.empty_like(a)
+    out[:, 0] = np.fmin(a[:, 0], b[:, 0])
+    out[:, 1] = np.fmax(a[:, 1], b[:, 1])
+    out[:, 3] = a[:, 3] + b[:, 3]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out[:, 2] = (np.nan_to_num(a[:, 2]) * a[:, 3] +
+                     np.nan_to_num(b[:, 2]) * b[:, 3]) / out[:, 3]
+    out[out[:, 3] == 0, 2] = np.nan
+    return out
+
+
+def build_timeline(rec, sys_ts, headers, dt=TIMELINE_DT):
+    ''' finest level tracks of a recording, returns t0, t1 (us) and tracks '''
+    t0, t1 = int(sys_ts[0]), int(sys_ts[-1])
+    nbins = (t1 - t0) // dt + 1
+    tracks = {}
+    bins = ((sys_ts - t0) // dt).astype(np.intp)
+    pol = headers['etype'] == EVENT_TYPES['polarity_event']
+    tracks['event_rate'] = _rate_track(
+        bins[pol], headers['ecapacity'][pol].astype(float), nbins, dt)
+    frm = headers['etype'] == EVENT_TYPES['frame_event']
+    tracks['frame_rate'] = _rate_track(bins[frm], None, nbins, dt)
+    for k in vi_tables(rec):
+        d = rec[k]['data'][:]
+        d = d[(d[:, 0] >= t0) & (d[:, 0] <= t1)]
+        d = d[np.argsort(d[:, 0], kind='mergesort')]
+        tracks[k] = _bin_stats(((d[:, 0] - t0) // dt).astype(np.intp),
+                               d[:, 1].astype(np.float32), nbins)
+    return t0, t1, tracks
+
+
+def write_timeline(idx, t0, t1, tracks, dt=TIMELINE_DT):
+    if 'timeline' in idx:
+        del idx['timeline']
+    g = idx.create_group('timeline')
+    g.attrs['t0'] = t0
+    g.attrs['t1'] = t1
+    g.attrs['dt'] = dt
+    level = 0
+    while True:
+        lg = g.create_group(str(level))
+        for k, a in tracks.items():
+            lg.create_dataset(k, data=a)
+        n = len(next(iter(tracks.values())))
+        if n <= MIN_BINS:
+            break
+        tracks = {k: reduce_track(a) for k, a in tracks.items()}
+        level += 1
+    g.attrs['levels'] = level + 1
+
+
+# -- seek --
+
+def write_seek(idx, rec, sys_ts, headers):
+    if 'seek' in idx:
+        del idx['seek']
+    g = idx.create_group('seek')
+    g.create_dataset('dvs', data=sys_ts)
+    g.create_dataset('dvs_frames', data=np.flatnonzero(
+        headers['etype'] == EVENT_TYPES['frame_event']))
+    for k in vi_tables(rec):
+        ts = rec[k]['timestamp']
+        g.create_dataset(k, data=ts[:valid_length(ts)].astype(np.int64))
+
+
+# -- time correction --
+
+def _device_time(payload, etype):
+    ''' device timestamp (us) at the end of a polarity or frame packet '''
+    words = np.frombuffer(payload.tobytes(), dtype=np.uint32)
+    if etype == EVENT_TYPES['polarity_event']:
+        return int(words[-1]) if len(words) else 0
+    return int(words[2]) if len(words) > 2 else 0
+
+
+def find_resets(rec, headers):
+    '''
+    Rows of the dvs packets that reset the device timestamp
+    (special events of type 0).
+    '''
+    ds = rec['dvs']['data']
+    special = np.flatnonzero(headers['etype'] == EVENT_TYPES['special_event'])
+    resets = []
+    for row in special:
+        data = np.frombuffer(ds[row, 2].tobytes(), dtype=np.uint32)[::2]
+        if np.any(data & 254 == 0):
+            resets.append(row)
+    return np.array(resets, dtype=np.int64)
+
+
+def write_time_correction(idx, rec, sys_ts, headers):
+    '''
+    Offsets (us) to add to the device timestamps of the packets from each
+    reset on: the device time of the last polarity/frame packet before the
+    reset, summed over all resets so far.
+    '''
+    if 'time' in idx:
+        del idx['time']
+    g = idx.create_group('time')
+    rows = find_resets(rec, headers)
+    timed = np.flatnonzero(np.isin(headers['etype'], [EVENT_TYPES['polarity_event'],
+                                                      EVENT_TYPES['frame_event']]))
+    ds = rec['dvs']['data']
+    last = np.zeros(len(rows), dtype=np.int64)
+    for i, row in enumerate(rows):
+        j = np.searchsorted(timed, row) - 1
+        if j >= 0:
+            last[i] = _device_time(ds[timed[j], 2], headers['etype'][timed[j]])
+    g.create_dataset('reset_rows', data=rows)
+    g.create_dataset('reset_ts', data=sys_ts[rows].astype(np.int64))
+    g.create_dataset('offset', data=np.cumsum(last))
+
+
+class TimeCorrection(object):
+    '''
+    Device to recording time, at any position in the recording.
+    Offsets are looked up by dvs row or by system timestamp (us).
+    '''
+    def __init__(self, idx):
+        g = idx['time']
+        self.rows = g['reset_rows'][:]
+        self.ts = g['reset_ts'][:]
+        self.offsets = np.r_[0, g['offset'][:]]
+
+    def offset_at_row(self, rows):
+        ''' offset (us) for dvs rows '''
+        return self.offsets[np.searchsorted(self.rows, rows, side='right')]
+
+    def offset_at(self, sys_ts):
+        ''' offset (us) for packets arriving at system time sys_ts (us) '''
+        return self.offsets[np.searchsorted(self.ts, sys_ts, side='right')]
+
+
+class SeekIndex(object):
+    '''
+    Row lookup by time, kept in memory.
+    * preroll -- us of DVS data to start before the APS frame we land on
+    '''
+    def __init__(self, idx, preroll=0):
+        g = idx['seek']
+        self.ts = {k: g[k][:] for k in g if k != 'dvs_frames'}
+        self.frame_rows = g['dvs_frames'][:]
+        self.frame_ts = self.ts['dvs'][self.frame_rows]
+        self.preroll = preroll
+
+    def length(self, k):
+        ''' number of valid rows of a table '''
+        return len(self.ts[k]) if k in self.ts else 0
+
+    def nearest_frame(self, t):
+        ''' row and timestamp of the APS frame closest to t, None if there are no frames '''
+        if not len(self.frame_rows):
+            return None, t
+        i = np.searchsorted(self.frame_ts, t)
+        if i == len(self.frame_ts) or \
+                (i > 0 and t - self.frame_ts[i - 1] < self.frame_ts[i] - t):
+            i -= 1
+        return int(self.frame_rows[i]), int(self.frame_ts[i])
+
+    def row(self, k, t):
+        '''
+        first row to read when seeking to t: for dvs the pre-roll before the
+        nearest frame, for VI tables the last value before that frame
+        '''
+        _, t = self.nearest_frame(t)
+        ts = self.ts.get(k)
+        if ts is None or not len(ts):
+            return 0
+        if k == 'dvs':
+            return int(np.searchsorted(ts, t - self.preroll))
+        return max(int(np.searchsorted(ts, t, side='right')) - 1, 0)
+
+
+# -- sidecar file --
+
+def _is_current(idx, fname):
+    return idx.attrs.get('version') == VERSION and \
+        idx.attrs.get('source') == source_stamp(fname)
+
+
+def build_index(fname, idx):
+    ''' (re)compute all parts of the index into the open file idx '''
+    rec = segments.open_recording(fname)
+    try:
+        print('indexing', fname)
+        sys_ts, headers = read_dvs_headers(rec)
+        write_timeline(idx, *build_timeline(rec, sys_ts, headers))
+        write_seek(idx, rec, sys_ts, headers)
+        write_time_correction(idx, rec, sys_ts, headers)
+    finally:
+        rec.close()
+    idx.attrs['version'] = VERSION
+    idx.attrs['source'] = source_stamp(fname)
+
+
+def open_index(fname, force=False):
+    '''
+    Returns the index of a recording (read only h5py.File),
+    building it first if it is missing or out of date. If the index can't
+    be written next to the recording, it is kept in memory.
+    '''
+    iname = index_name(fname)
+    if not force and os.path.exists(iname):
+        try:
+            idx = h5py.File(iname, 'r')
+            if _is_current(idx, fname):
+                return idx
+            idx.close()
+        except (IOError, OSError):
+            pass
+    try:
+        tmp = iname + '.tmp'
+        with h5py.File(tmp, 'w') as idx:
+            build_index(fname, idx)
+        os.rename(tmp, iname)
+        return h5py.File(iname, 'r')
+    except (IOError, OSError) as e:
+        print('could not write %s (%s), keeping index in memory' % (iname, e))
+        idx = h5py.File(iname, 'w', driver='core', backing_store=False)
+        build_index(fname, idx)
+        return idx
+
+
+class Timeline(object):
+    '''
+    Overview tracks from the index, at the resolution needed to draw
+    a time window into a given number of pixel columns.
+    '''
+    def __init__(self, idx):
+        self.g = idx['timeline']
+        self.t0 = int(self.g.attrs['t0'])
+        self.t1 = int(self.g.attrs['t1'])
+        self.dt = int(self.g.attrs['dt'])
+        self.levels = int(self.g.attrs['levels'])
+        self.names = list(self.g['0'].keys())
+
+    def track(self, name, t_start, t_stop, width):
+        '''
+        min, max and mean of a track per pixel column (arrays of length width)
+        for the time window [t_start, t_stop) in us, None if there is no such track
+        '''
+        if name not in self.g['0']:
+            return None
+        span = max(t_stop - t_start, 1)
+        # coarsest level that still has a bin per pixel
+        level = 0
+        while level + 1 < self.levels and \
+                span / (self.dt * 2 ** (level + 1)) >= width:
+            level += 1
+        dt = self.dt * 2 ** level
+        ds = self.g[str(level)][name]
+        a = max(int((t_start - self.t0) // dt), 0)
+        b = min(int(-(-(t_stop - self.t0) // dt)), len(ds))
+        if b <= a:
+            return np.full((3, width), np.nan)
+        d = ds[a:b]
+        # pixel column of each bin
+        cols = ((np.arange(a, b) * dt + self.t0 - t_start) * width // span)
+        cols = cols.clip(0, width - 1).astype(np.intp)
+        out = np.full((3, width), np.nan)
+        starts = np.flatnonzero(np.r_[True, np.diff(cols) != 0])
+        ids = cols[starts]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out[0, ids] = np.fmin.reduceat(d[:, 0], starts)
+            out[1, ids] = np.fmax.reduceat(d[:, 1], starts)
+            n = np.add.reduceat(d[:, 3], starts)
+            out[2, ids] = np.add.reduceat(np.nan_to_num(d[:, 2]) * d[:, 3], starts) / n
+        return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filenames', nargs='+')
+    parser.add_argument('--force', action='store_true', help='rebuild existing indexes')
+    args = parser.parse_args()
+    for fname in args.filenames:
+        open_index(fname, force=args.force).close()
+        print('wrote', index_name(fname))
@@ -12,8 +12,10 @@ from __future__ import print_function
 import time
 import numpy as np
 import socket, struct
+import collections
 import multiprocessing as mp
 from multiprocessing import Queue
+from queue import Empty, Full
 
 HOST = "127.0.0.1"
 PORT = 7777
@@ -46,6 +48,29 @@ EVENT_TYPES = {
 
 etype_by_id = {v: k for k,v in EVENT_TYPES.items()}
 
+HEADER_SIZE = 28
+_header = struct.Struct('hhiiiiii')
+# esize and ecapacity of a header, all it takes to find the next packet
+_sizes = struct.Struct('4xi8xi')
+
+# packet headers as a numpy record, for parsing many headers at once
+HEADER_DTYPE = np.dtype([
+        ('etype', np.int16),
+        ('esource', np.int16),
+        ('esize', np.int32),
+        ('eoffset', np.int32),
+        ('eoverflow', np.int32),
+        ('ecapacity', np.int32),
+        ('enumber', np.int32),
+        ('evalid', np.int32),
+        ])
+
+# header of a packet within a batch, plus its position and arrival time
+BATCH_DTYPE = np.dtype(HEADER_DTYPE.descr + [
+        ('offset', np.int64),
+        ('timestamp', np.int64),
+        ])
+
 
 def unpack_events(p):
     '''
@@ -72,6 +97,13 @@ def unpack_header(header_raw):
     obj['etype'] = etype_by_id.get(obj['etype'], obj['etype'])
     return obj
 
+def unpack_headers(raw):
+    '''
+    Extract many headers at once from concatenated binary headers,
+    returns record array with HEADER_DTYPE fields.
+    '''
+    return np.frombuffer(raw, dtype=HEADER_DTYPE)
+
 def unpack_frame(p):
     '''
     Extract image from binary data, returns timestamp and 2d np.array.
@@ -128,7 +160,7 @@ class Monitor(mp.Process):
         hdata = self.sock.recv(20, socket.MSG_WAITALL)  # header of aer stream
         self.hdata = struct.unpack('llbbh', hdata)
         print('opened connection:', self.hdata)
-        self.q = mp.queue(bufsize)
+        self.q = mp.Queue(bufsize)
         self.maxsize = self.q._maxsize
         self.qsize = 0
         self.exit = mp.Event()
@@ -140,7 +172,7 @@ class Monitor(mp.Process):
             try:
                 self.q.put_nowait(self._get())
                 self.qsize = max(self.qsize, self.q.qsize())
-            except Queue.Full:
+            except Full:
                 raise Full('caer buffer overflow')
             except KeyboardInterrupt:
                 self.exit.set()
@@ -165,35 +197,169 @@ class Monitor(mp.Process):
         self.exit.set()
 
 
+class Batch(object):
+    '''
+    Packets received in one go: the raw stream bytes
+    and a record array of their headers (BATCH_DTYPE).
+    '''
+    def __init__(self, data, headers):
+        self.data = data
+        self.headers = headers
+
+    def __len__(self):
+        return len(self.headers)
+
+    def packet(self, i):
+        ''' packet dict as returned by Monitor.get '''
+        h = self.headers[i]
+        start = int(h['offset'])
+        stop = start + HEADER_SIZE + int(h['ecapacity']) * int(h['esize'])
+        data = {'dvs_header': self.data[start:start + HEADER_SIZE],
+                'dvs_timestamp': int(h['timestamp']),
+                'dvs_data': self.data[start + HEADER_SIZE:stop]}
+        data.update(zip(HEADER_FIELDS, (int(h[k]) for k in HEADER_FIELDS)))
+        data['etype'] = etype_by_id.get(data['etype'], data['etype'])
+        return data
+
+    def __iter__(self):
+        return (self.packet(i) for i in range(len(self)))
+
+
+class BatchMonitor(mp.Process):
+    '''
+    Reads the caer stream into a large preallocated buffer with recv_into,
+    parses all complete packets in it and hands them to the consumer as a
+    single Batch. Batches that don't fit in the queue are counted in
+    `dropped` (number of packets).
+    '''
+    def __init__(self, bufsize=2048, recv_bytes=1 << 22):
+        super(BatchMonitor, self).__init__()
+        self.sock = socket.socket()
+        self.sock.connect((HOST, PORT))
+        hdata = self.sock.recv(20, socket.MSG_WAITALL)  # header of aer stream
+        self.hdata = struct.unpack('llbbh', hdata)
+        print('opened connection:', self.hdata)
+        self.recv_bytes = recv_bytes
+        self.q = mp.Queue(bufsize)
+        self.maxsize = self.q._maxsize
+        self.qsize = 0
+        self.dropped = mp.Value('L', 0)
+        self.exit = mp.Event()
+        self.pending = collections.deque()
+        #self.daemon = True
+        self.start()
+
+    def run(self):
+        buf = bytearray(self.recv_bytes)
+        fill = 0
+        while not self.exit.is_set():
+            try:
+                if fill == len(buf):
+                    # a single packet larger than the buffer
+                    buf.extend(bytearray(len(buf)))
+                n = self.sock.recv_into(memoryview(buf)[fill:])
+                if not n:
+                    break
+                fill += n
+                pos, headers = self._parse(buf, fill, int(time.time() * 1e6))
+                if len(headers):
+                    self._put(Batch(bytes(buf[:pos]), headers))
+                    buf[:fill - pos] = buf[pos:fill]
+                    fill -= pos
+            except KeyboardInterrupt:
+                self.exit.set()
+
+    def _parse(self, buf, fill, ts):
+        '''
+        find all complete packets in buf[:fill], returns the end of the last
+        one and their headers (BATCH_DTYPE). Only the sizes are read while
+        walking the packets, the headers are unpacked together afterwards.
+        '''
+        pos = 0
+        offsets = []
+        while fill - pos >= HEADER_SIZE:
+            esize, ecapacity = _sizes.unpack_from(buf, pos)
+            psize = ecapacity * esize
+            if fill - pos - HEADER_SIZE < psize:
+                break
+            offsets.append(pos)
+            pos += HEADER_SIZE + psize
+        headers = np.zeros(len(offsets), dtype=BATCH_DTYPE)
+        if offsets:
+            offsets = np.array(offsets)
+            raw = np.frombuffer(buf, dtype=np.uint8, count=pos)
+            found = unpack_headers(raw[offsets[:, None] + np.arange(HEADER_SIZE)].tobytes())
+            for k in HEADER_DTYPE.names:
+                headers[k] = found[k]
+            headers['offset'] = offsets
+            headers['timestamp'] = ts
+        return pos, headers
+
+    def _put(self, batch):
+        try:
+            self.q.put_nowait(batch)
+            self.qsize = max(self.qsize, self.q.qsize())
+        except Full:
+            with self.dropped.get_lock():
+                self.dropped.value += len(batch)
+
+    def get_batch(self, timeout=None):
+        ''' next batch of packets, False if there is none '''
+        try:
+            if timeout is None:
+                return self.q.get_nowait()
+            return self.q.get(True, timeout)
+        except Empty:
+            return False
+
+    def get(self):
+        ''' single packet dict, compatible with Monitor.get '''
+        if not self.pending:
+            batch = self.get_batch()
+            if not batch:
+                return False
+            self.pending.extend(batch)
+        return self.pending.popleft()
+
+    def get_events(self):
+        return unpack_events(self.get())
+
+    def shutdown(self):
+        self.exit.set()
+
+
 class Controller(object):
-    def __init__(self):
-        self.data_buffer_size = 4069 * 30
-        self.max_cmd_parts = 5
-        self.cmd_part_action = 0
-        self.NODE_EXISTS = 0
-        self.ATTR_EXISTS = 1
-        self.GET = 2
-        self.PUT = 3
-        self.cmd_part_node = 1
-        self.cmd_part_key = 2
-        self.cmd_part_type = 3
-        self.cmd_part_value = 4
-        self.type_action = {
-                'bool': 0,
-                'byte': 1,
-                'short': 2,
-                'int': 3,
-                'long': 4,
-                'float': 5,
-                'double': 6,
-                'string': 7
-                }
-        self.actions = [
-                ("node_exists", 11, self.NODE_EXISTS),
-                ("attr_exists", 11, self.ATTR_EXISTS),
-                ("get", 3, self.GET),
-                ("put", 3, self.PUT)
-                ]
+    '''
+    Sends configuration commands to caer.
+    Commands are assembled in a reusable buffer.
+    '''
+    NODE_EXISTS = 0
+    ATTR_EXISTS = 1
+    GET = 2
+    PUT = 3
+    actions = {
+            'node_exists': NODE_EXISTS,
+            'attr_exists': ATTR_EXISTS,
+            'get': GET,
+            'put': PUT,
+            }
+    type_action = {
+            'bool': 0,
+            'byte': 1,
+            'short': 2,
+            'int': 3,
+            'long': 4,
+            'float': 5,
+            'double': 6,
+            'string': 7
+            }
+    # action, type, extra length, node length, key length, value length
+    cmd_header = struct.Struct('<BBHHHH')
+    max_cmd_parts = 5
+
+    def __init__(self, bufsize=4096):
+        self.cmd_buf = bytearray(bufsize)
+        self.resp_buf = bytearray(bufsize)
         try:
             self.s_commands = socket.socket()
             self.s_commands.connect((HOST, PORT_CTL))
@@ -203,106 +369,163 @@ class Controller(object):
 
     def parse_command(self, command):
         '''
-        parse string command
+        parse string command into self.cmd_buf, returns a view of the command
         e.g. string: put /1/1-DAVISFX2/'+str(sensor)+'/aps/ Exposure int 10
-        (copied from https://svn.code.sf.net/p/jaer/code/scripts/python/cAER_utils/imagers_characterization/caer_communication.py)
+        (wire format of https://svn.code.sf.net/p/jaer/code/scripts/python/cAER_utils/imagers_characterization/caer_communication.py)
         '''
-        databuffer = bytearray(b'\x00' * self.data_buffer_size)
-        node_length = 0
-        key_length = 0
-        action_code = -1
         cmd_parts = command.split()
-        if(len(cmd_parts) > self.max_cmd_parts):
+        if len(cmd_parts) > self.max_cmd_parts:
             print('Error: command is made up of too many parts')
             return
-        else:
-            if(cmd_parts[self.cmd_part_action] != None):
-                for i in range(len(self.actions)):
-                    if(cmd_parts[self.cmd_part_action] == self.actions[i][0]):
-                        action_code = self.actions[i][2]
-                if(action_code == -1):
-                    print("Please specify an action to perform as: get/put..")
-                    return
-                #do action based on action_code
-                if(action_code == self.NODE_EXISTS):
-                    node_length = len(cmd_parts[self.cmd_part_node]) + 1
-                    databuffer[0] = action_code
-                    databuffer[1] = 0 #unused
-                    databuffer[10:10+node_length] = self.cmd_parts[self.cmd_part_node]
-                    databuffer_lenght = 10 + node_length
-                if(action_code == self.PUT):
-                    node_length  = len(cmd_parts[self.cmd_part_node]) + 1
-                    key_length = len(cmd_parts[self.cmd_part_key]) + 1
-                    value_length = len(cmd_parts[self.cmd_part_value]) + 1
-                    databuffer[0] = action_code
-                    databuffer[1] = self.type_action[cmd_parts[self.cmd_part_type]]
-                    databuffer[2:3] = struct.pack('H', 0)
-                    databuffer[4:5] = struct.pack('H', node_length)
-                    databuffer[6:7] = struct.pack('H', key_length)
-                    databuffer[8:9] = struct.pack('H', value_length)
-                    databuffer[10:10+node_length] = str(cmd_parts[self.cmd_part_node])
-                    databuffer[10+node_length:10+node_length+key_length] = str(cmd_parts[self.cmd_part_key])
-                    databuffer[10+node_length+key_length:10+node_length+key_length+value_length] = str(cmd_parts[self.cmd_part_value])
-                    databuffer_length = 10 + node_length + key_length + value_length
-                    #raise Exception
-        return databuffer[0:databuffer_length]
+        action_code = self.actions.get(cmd_parts[0], -1)
+        if action_code == -1:
+            print("Please specify an action to perform as: get/put..")
+            return
+        # node, key and value strings, each zero terminated
+        strings = [p.encode() + b'\x00' for p in cmd_parts[1:3]]
+        type_code = 0
+        if action_code == self.PUT:
+            strings.append(cmd_parts[4].encode() + b'\x00')
+            type_code = self.type_action[cmd_parts[3]]
+        elif action_code != self.NODE_EXISTS:
+            type_code = self.type_action.get(
+                    cmd_parts[3] if len(cmd_parts) > 3 else '', 0)
+        lengths = [len(v) for v in strings] + [0] * (3 - len(strings))
+        self.cmd_header.pack_into(
+                self.cmd_buf, 0, action_code, type_code, 0, *lengths)
+        pos = self.cmd_header.size
+        for v in strings:
+            self.cmd_buf[pos:pos + len(v)] = v
+            pos += len(v)
+        return memoryview(self.cmd_buf)[:pos]
 
     def send_command(self, string):
         '''
         parse input command and send it to the device
-        print the answer
         input string - ie. 'put /1/1-DAVISFX2/'+str(sensor)+'/aps/ Exposure int 100'
+        returns action, type and message of the answer
         '''
         cmd = self.parse_command(string)
+        if cmd is None:
+            return
         self.s_commands.sendall(cmd)
-        msg_header = self.s_commands.recv(4)
-        msg_packet = self.s_commands.recv(struct.unpack('H', msg_header[2:4])[0])
-        action = struct.unpack('B',msg_header[0])[0]
-        second = struct.unpack('B',msg_header[1])[0]
-        #print(string+' action='+str(action)+' type='+str(second)+' message='+msg_packet)
+        resp = memoryview(self.resp_buf)
+        self.s_commands.recv_into(resp[:4], 4, socket.MSG_WAITALL)
+        action, second, n = struct.unpack_from('<BBH', self.resp_buf)
+        if n > len(self.resp_buf):
+            self.resp_buf = bytearray(n)
+            resp = memoryview(self.resp_buf)
+        self.s_commands.recv_into(resp[:n], n, socket.MSG_WAITALL)
+        return action, second, bytes(resp[:n])
 
     def set_aps(self, name, dtype, value):
         self.send_command('put /1/1-DAVISFX3/%s/aps/ %s %s %s' % (SENSOR, name, dtype, value))
 
 
-class ExposureCtl(Controller):
+def frame_mean(packet, cutoff_top=0, cutoff_bot=0, step=4):
+    '''
+    Mean pixel value of a frame packet, computed on every step-th row and
+    column without unpacking or copying the frame.
+    '''
+    img = np.frombuffer(packet['dvs_data'], dtype=np.uint16, offset=36,
+                        count=DVS_SHAPE[0] * DVS_SHAPE[1]).reshape(DVS_SHAPE)
+    return img[cutoff_top:DVS_SHAPE[0] - cutoff_bot:step, ::step].mean()
+
+
+class ExposureWorker(mp.Process):
+    '''
+    Owns the control connection and adjusts exposure from the frame means
+    it receives, so control round trips never run in the record loop.
+    '''
+    def __init__(self, target, gain=0.5, smoothing=0.5, exp_init=1000, exp_min=100, exp_max=100000):
+        super(ExposureWorker, self).__init__()
+        self.target = target
+        self.gain = gain
+        self.smoothing = smoothing
+        self.exp_min = exp_min
+        self.exp_max = exp_max
+        self.exposure = mp.Value('i', exp_init)
+        self.q = mp.Queue(2)
+        self.exit = mp.Event()
+        self.daemon = True
+        self.start()
+
+    def run(self):
+        ctl = Controller()
+        m_smooth = None
+        while not self.exit.is_set():
+            try:
+                m = self.q.get(True, 0.1)
+            except Empty:
+                continue
+            except KeyboardInterrupt:
+                break
+            if m <= 0:
+                continue
+            m_smooth = m if m_smooth is None else \
+                    self.smoothing * m + (1 - self.smoothing) * m_smooth
+            upd = (self.target / m_smooth - m_smooth / self.target) / 2
+            exp_now = self.exposure.value
+            exp_new = int(np.clip(exp_now * (1 + self.gain * upd),
+                                  self.exp_min, self.exp_max))
+            if exp_new != exp_now:
+                ctl.set_aps('Exposure', 'int', exp_new)
+                self.exposure.value = exp_new
+
+    def post(self, m):
+        ''' hand over a new frame mean, dropped if the worker is busy '''
+        try:
+            self.q.put_nowait(m)
+        except Full:
+            pass
+
+
+class ExposureCtl(object):
     '''
     Automatic exposure control
     * fps -- update frequency
     * target -- target average pixel value (between 0 and 255)
     * cutoff_top -- number of pixels at the top of image to be ignored
     * cutoff_bot -- number of pixels at the bottom of image to be ignored
+    * step -- only every step-th row/column is used for the mean
+    * smoothing -- weight of the newest mean in the running average (1 = no smoothing)
+    * gain -- fraction of the correction applied per update
     
     We generally want to expose for road which is bottom of image. Therefore the default
     is to ignore the top 100 pixels (cutoff_top) and to ignore the bottom 50 (cutoff_bot) 
     which might be the hood. 
     Howvever, if sensor is mounted upside down, then we should ignore a lot of the bottom
     (sky) and maybe a bit of the top (hood).
+
+    update() only computes a subsampled mean, the camera is controlled by
+    an ExposureWorker process.
     '''
-    def __init__(self, fps=5, target=100, cutoff_top=10, cutoff_bot=200):
-        super(ExposureCtl, self).__init__()
+    def __init__(self, fps=5, target=100, cutoff_top=10, cutoff_bot=200, step=4, smoothing=0.5, gain=0.5):
         self.fps = fps
         self.dt = 1. / self.fps
         self.target = float(target * 255)
         self.t_pre = 0
         self.cutoff_top = cutoff_top
         self.cutoff_bot = cutoff_bot
-        self.exp_now = 1000 # dummy
+        self.step = step
+        self.worker = ExposureWorker(self.target, gain=gain, smoothing=smoothing)
+
+    @property
+    def exp_now(self):
+        return self.worker.exposure.value
 
     def update(self, packet):
         if time.time() - self.t_pre < self.dt:
             return
         if packet['etype'] != 'frame_event':
             return
-        ts, frame = unpack_frame(packet)
-        m = frame[self.cutoff_top:-self.cutoff_bot].mean()
-        upd = (self.target / m - m / self.target) / 2
-        exp_new = self.exp_now * (1 + 0.5 * upd)
-        exp_new = np.clip(exp_new, 100, 100000).astype(int)
-        self.set_aps('Exposure', 'int', int(exp_new))
-        self.exp_now = exp_new
+        self.worker.post(frame_mean(
+            packet, self.cutoff_top, self.cutoff_bot, self.step))
         self.t_pre = time.time()
 
+    def close(self):
+        self.worker.exit.set()
+
 
 
 if __name__ == '__main__':
@@ -1,4 +1,3 @@
-
 '''
 Recorder for DAVIS + OpenXC data
 Author: J. Binas <jbinas@gmail.com>, 2017
@@ -10,20 +9,159 @@ GNU LESSER GENERAL PUBLIC LICENSE Version 3.
 from __future__ import absolute_import, print_function
 
 import time, sys
+import threading
 import multiprocessing as mp
 import numpy as np
-from openxc.tools import dump as oxc
 from multiprocessing import Queue
+from queue import Full
+try:
+    from openxc.tools import dump as oxc
+except ImportError:
+    # only needed for the actual vehicle interface
+    oxc = None
+
+# messages per second of the synthetic source, roughly what the VI sends
+SYNTHETIC_RATES = {
+        'accelerator_pedal_position': 10,
+        'brake_pedal_status': 1,
+        'engine_speed': 10,
+        'fuel_consumed_since_restart': 10,
+        'fuel_level': 1,
+        'lateral_acceleration': 10,
+        'latitude': 1,
+        'longitude': 1,
+        'longitudinal_acceleration': 10,
+        'odometer': 10,
+        'steering_wheel_angle': 10,
+        'torque_at_transmission': 10,
+        'vehicle_speed': 10,
+        }
+
+
+class _Source(threading.Thread):
+    ''' common part of the stand-in sources, same interface as openxc's '''
+    def __init__(self, callback=None):
+        super(_Source, self).__init__()
+        self.daemon = True
+        self.callback = callback
+        self.sent = 0
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _send(self, name, value):
+        self.callback({'name': name, 'value': value})
+        self.sent += 1
+
+
+class ReplaySource(_Source):
+    '''
+    Sends the VI messages of an existing recording to callback.
+    * filename -- recording (.hdf5 or segment manifest)
+    * speed -- 1 for real time, N for N times real time, 0 for no pacing
+    * signals -- names of the tables to replay (default: all VI tables)
+    * conversions -- per signal function mapping recorded back to raw values
+    '''
+    def __init__(self, filename, speed=1., loop=False, signals=None, conversions={}, callback=None):
+        super(ReplaySource, self).__init__(callback)
+        self.speed = speed
+        self.loop = loop
+        self.conversions = conversions
+        self._load(filename, signals)
+
+    def _load(self, filename, signals):
+        from segments import open_recording
+        f = open_recording(filename)
+        self.signals = [k for k in (signals or f.keys())
+                        if k != 'dvs' and 'data' in f[k]]
+        ids, ts, vals = [], [], []
+        for i, k in enumerate(self.signals):
+            d = f[k]['data'][:]
+            d = d[f[k]['timestamp'][:] > 0]
+            ids.append(np.full(len(d), i, dtype=np.int32))
+            ts.append(d[:, 0])
+            vals.append(d[:, 1])
+        f.close()
+        if not ts:
+            raise ValueError('no VI data in %s' % filename)
+        # all messages in recording order
+        order = np.argsort(np.concatenate(ts), kind='mergesort')
+        self.ids = np.concatenate(ids)[order]
+        self.ts = np.concatenate(ts)[order]
+        self.vals = np.concatenate(vals)[order]
+
+    def run(self):
+        while not self.stopped.is_set():
+            t_wall0 = time.time()
+            for i in range(len(self.ts)):
+                if self.stopped.is_set():
+                    return
+                if self.speed:
+                    wait = t_wall0 + (self.ts[i] - self.ts[0]) * 1e-6 / self.speed - time.time()
+                    if wait > 0:
+                        self.stopped.wait(wait)
+                name = self.signals[self.ids[i]]
+                conv = self.conversions.get(name)
+                val = self.vals[i].item()
+                self._send(name, conv(val) if conv else val)
+            if not self.loop:
+                return
+
+
+class SyntheticSource(_Source):
+    '''
+    Sends synthetic VI messages to callback.
+    * rates -- messages per second by signal name
+    * scale -- multiplies all rates, for stress tests
+    * duration -- seconds to run (None to run until stopped)
+    '''
+    def __init__(self, rates=SYNTHETIC_RATES, scale=1., duration=None, callback=None):
+        super(SyntheticSource, self).__init__(callback)
+        self.signals = sorted(rates)
+        self.rates = np.array([rates[k] * scale for k in self.signals], dtype=float)
+        self.duration = duration
+
+    def run(self):
+        t0 = time.time()
+        counts = np.zeros(len(self.signals), dtype=np.int64)
+        while not self.stopped.is_set():
+            dt = time.time() - t0
+            if self.duration is not None and dt > self.duration:
+                return
+            # send everything that is due, however late we are
+            due = (dt * self.rates).astype(np.int64)
+            for i in np.nonzero(due > counts)[0]:
+                for n in range(counts[i], due[i]):
+                    t = n / self.rates[i]
+                    self._send(self.signals[i], float(np.sin(t * 0.1 * (i + 1))))
+                counts[i] = due[i]
+            t_next = ((counts + 1) / self.rates).min()
+            self.stopped.wait(max(t_next - (time.time() - t0), 0))
+
 
 class Monitor(mp.Process):
-    def __init__(self, bufsize=256):
+    '''
+    Buffers vehicle interface messages.
+    * source -- a source with start/stop and a callback argument
+      (default: the openxc device given on the command line)
+    Messages that don't fit in the queue are counted in `dropped`.
+    '''
+    def __init__(self, bufsize=256, source=None):
         super(Monitor, self).__init__()
-        arguments = oxc.parse_options()
-        source_class, source_kwargs = oxc.select_device(arguments)
-        self.source = source_class(callback=self.receive, **source_kwargs)
+        if source is None:
+            if oxc is None:
+                raise ImportError('openxc is required to use the vehicle interface')
+            arguments = oxc.parse_options()
+            source_class, source_kwargs = oxc.select_device(arguments)
+            source = source_class(callback=self.receive, **source_kwargs)
+        else:
+            source.callback = self.receive
+        self.source = source
         self.q = mp.Queue(bufsize)
         self.qsize = 0
         self.maxsize = self.q._maxsize
+        self.dropped = mp.Value('L', 0)
         self.exit = mp.Event()
         #self.daemon = True
         self.start()
@@ -33,10 +171,10 @@ class Monitor(mp.Process):
         #self.source.join()
         while not self.exit.is_set():
             try:
-                time.sleep(1e-5)
+                self.exit.wait(0.1)
             except KeyboardInterrupt:
-                self.source.stop()
                 self.exit.set()
+        self.source.stop()
 
     def receive(self, message, **kwargs):
         ''' receive single message from interface '''
@@ -46,8 +184,9 @@ class Monitor(mp.Process):
         try:
             self.q.put_nowait(message)
             self.qsize = max(self.qsize, self.q.qsize())
-        except Queue.Full:
-            raise Queue.Full('vi buffer overflow')
+        except Full:
+            with self.dropped.get_lock():
+                self.dropped.value += 1
 
     def get(self):
         ''' get one message from buffer '''
@@ -65,8 +204,7 @@ if __name__ == '__main__':
         if res:
             print(res)
         if time.time() - t > 1:
-            print('\npolling at', i / (time.time() - t), 'Hz\n')
+            print('\npolling at', i / (time.time() - t), 'Hz,', vi.dropped.value, 'dropped\n')
             i = 0
             t = time.time()
         i += 1
-
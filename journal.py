@@ -0,0 +1,144 @@
+'''
+Append-only write-ahead journal for live recordings.
+
+Every row handed to the HDF5 writer is first appended to the journal as
+a length-prefixed, checksummed pickle record. The file is fsync'd in
+batches, so a power loss costs at most one batch. The first record
+describes the tables, which is all recover.py needs to rebuild a
+recording from the journal and whatever survived in the HDF5 file.
+
+This software is released under the
+GNU LESSER GENERAL PUBLIC LICENSE Version 3.
+'''
+
+from __future__ import print_function
+import os
+import time
+import struct
+import pickle
+import zlib
+import numpy as np
+import h5py
+
+MAGIC = b'DDDJ\x01'
+
+SYNC_EVERY = 256    # records between fsyncs
+SYNC_INTERVAL = 0.5 # max seconds between fsyncs
+
+# key of the records in an ioerrors journal: (column, first row, rows)
+FAILED = '__failed__'
+
+_rec_head = struct.Struct('<II')  # payload length, crc32
+
+
+def _pack_dtype(ttype):
+    ''' make a table type picklable (vlen dtypes lose their metadata) '''
+    if isinstance(ttype, (tuple, list)):
+        return (_pack_dtype(ttype[0]), tuple(ttype[1]))
+    dt = np.dtype(ttype)
+    vlen = h5py.check_dtype(vlen=dt)
+    if vlen is not None:
+        return ('vlen', 'str' if vlen in (str, bytes) else np.dtype(vlen).str)
+    return dt.str
+
+
+def _unpack_dtype(ttype):
+    if isinstance(ttype, tuple) and ttype and ttype[0] == 'vlen':
+        base = str if ttype[1] == 'str' else np.dtype(ttype[1])
+        return h5py.special_dtype(vlen=base)
+    if isinstance(ttype, tuple):
+        return (_unpack_dtype(ttype[0]), tuple(ttype[1]))
+    return np.dtype(ttype)
+
+
+class Journal(object):
+    '''
+    Appends rows to a binary journal file.
+    * fname -- journal file name
+    * tables -- table types as passed to datasets.HDF5
+    '''
+    def __init__(self, fname, tables, sync_every=SYNC_EVERY, sync_interval=SYNC_INTERVAL):
+        self.fname = fname
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.f = open(fname, 'wb')
+        self.f.write(MAGIC)
+        self.n_unsynced = 0
+        self.t_sync = time.time()
+        self.append({k: _pack_dtype(v) for k, v in tables.items()})
+        self.sync()
+
+    def append(self, row):
+        p = pickle.dumps(row, pickle.HIGHEST_PROTOCOL)
+        self.f.write(_rec_head.pack(len(p), zlib.crc32(p) & 0xffffffff))
+        self.f.write(p)
+        self.n_unsynced += 1
+        if self.n_unsynced >= self.sync_every or \
+                time.time() - self.t_sync > self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.n_unsynced = 0
+        self.t_sync = time.time()
+
+    def close(self):
+        self.sync()
+        self.f.close()
+
+
+def read_journal(fname):
+    '''
+    Returns table types and a generator over the journaled rows.
+    Stops silently at a torn or corrupted record at the end of the file.
+    '''
+    f = open(fname, 'rb')
+    if f.read(len(MAGIC)) != MAGIC:
+        f.close()
+        raise IOError('%s is not a journal file' % fname)
+
+    def records():
+        try:
+            while True:
+                head = f.read(_rec_head.size)
+                if len(head) < _rec_head.size:
+                    return
+                n, crc = _rec_head.unpack(head)
+                p = f.read(n)
+                if len(p) < n or zlib.crc32(p) & 0xffffffff != crc:
+                    print('journal %s: truncated record, stopping' % fname)
+                    return
+                yield pickle.loads(p)
+        finally:
+            f.close()
+
+    rows = records()
+    tables = {k: _unpack_dtype(v) for k, v in next(rows).items()}
+    return tables, rows
+
+
+def ioerrors_name(fname):
+    ''' journal of the rows that could not be written to fname '''
+    return fname + '.ioerrors.journal'
+
+
+def read_failures(fname):
+    '''
+    Returns table types and the failed chunks of an ioerrors journal,
+    {column: [(first row, rows), ...]} in row order. The first row is the
+    position of the chunk among all rows of the column, None for journals
+    that only hold the rows.
+    '''
+    tables, records = read_journal(fname)
+    failed = {}
+    for rec in records:
+        if FAILED in rec:
+            col, first, rows = rec[FAILED]
+            failed.setdefault(col, []).append((first, rows))
+        else:
+            for col, val in rec.items():
+                failed.setdefault(col, []).append((None, [val]))
+    for chunks in failed.values():
+        chunks.sort(key=lambda c: (c[0] is None, c[0]))
+    return tables, failed
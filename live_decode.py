@@ -0,0 +1,150 @@
+'''
+Decodes polarity and frame packets while recording.
+
+A LiveDecoder process writes the columnar event store produced by
+export_ddd20_hdf.py (event, frame and frame_ts) next to the raw
+recording, so a drive can be used without a separate export pass. The
+raw path is never held up: packets are handed over in small lists with
+put_nowait, and lists that don't fit in the queue are dropped and
+counted.
+
+This software is released under the
+GNU LESSER GENERAL PUBLIC LICENSE Version 3.
+'''
+
+from __future__ import print_function
+import time
+import multiprocessing as mp
+from queue import Empty, Full
+import numpy as np
+import h5py
+from interfaces.caer import DVS_SHAPE
+
+# packets per hand-over
+POST_EVERY = 64
+# events per write to the event table
+EVENT_CHUNK = 1 << 16
+
+
+def decoded_name(fname):
+    return fname + '.decoded.hdf5'
+
+
+def decode_polarity(payloads):
+    '''
+    Decode concatenated polarity packet payloads,
+    returns array of (timestamp, x, y, polarity) rows.
+    '''
+    raw = np.frombuffer(b''.join(payloads), dtype=np.uint32).reshape(-1, 2)
+    data, ts = raw[:, 0], raw[:, 1]
+    out = np.empty((len(raw), 4), dtype=np.uint32)
+    out[:, 0] = ts
+    out[:, 1] = data >> 17
+    out[:, 2] = data >> 2 & 0b111111111111111
+    out[:, 3] = data >> 1 & 0b1
+    return out
+
+
+def decode_frame(payload):
+    ''' returns timestamp in s and 8 bit image '''
+    head = np.frombuffer(payload, dtype=np.uint32, count=3)
+    img = np.frombuffer(payload, dtype=np.uint16, offset=36,
+                        count=DVS_SHAPE[0] * DVS_SHAPE[1])
+    return head[2] * 1e-6, (img >> 8).astype(np.uint8).reshape(DVS_SHAPE)
+
+
+class LiveDecoder(mp.Process):
+    '''
+    Decodes caer packets into <filename>.decoded.hdf5.
+    * filename -- name of the raw recording
+    * bufsize -- number of packet lists that can be waiting
+    '''
+    def __init__(self, filename, bufsize=256):
+        super(LiveDecoder, self).__init__()
+        self.fname = decoded_name(filename)
+        self.q = mp.Queue(bufsize)
+        self.maxsize = self.q._maxsize
+        self.dropped = mp.Value('L', 0)
+        self.decoded = mp.Value('L', 0)
+        self.exit = mp.Event()
+        self.pending = []
+        self.daemon = True
+        self.start()
+
+    def save(self, packet):
+        ''' queue a polarity or frame packet dict for decoding '''
+        if packet['etype'] not in ('polarity_event', 'frame_event'):
+            return
+        self.pending.append((packet['etype'] == 'frame_event', packet['dvs_data']))
+        if len(self.pending) >= POST_EVERY:
+            self.flush()
+
+    def flush(self):
+        ''' hand over pending packets, dropping them if the decoder lags '''
+        if not self.pending:
+            return
+        try:
+            self.q.put_nowait(self.pending)
+        except Full:
+            with self.dropped.get_lock():
+                self.dropped.value += len(self.pending)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.exit.set()
+        self.join()
+
+    def run(self):
+        self.f = h5py.File(self.fname, 'w')
+        self.frame = self.f.create_dataset(
+            'frame', shape=(0,) + DVS_SHAPE, maxshape=(None,) + DVS_SHAPE,
+            chunks=(1,) + DVS_SHAPE, dtype='uint8')
+        self.frame_ts = self.f.create_dataset(
+            'frame_ts', shape=(0, 1), maxshape=(None, 1), dtype='float32')
+        self.event = self.f.create_dataset(
+            'event', shape=(0, 4), maxshape=(None, 4),
+            chunks=(EVENT_CHUNK, 4), dtype='uint32')
+        self.events = []
+        self.n_events = 0
+        while True:
+            try:
+                packets = self.q.get(True, 0.1)
+            except Empty:
+                if self.exit.is_set():
+                    break
+                continue
+            except KeyboardInterrupt:
+                continue
+            self._decode(packets)
+        self._write_events()
+        self.f.close()
+
+    def _decode(self, packets):
+        pol = [p for is_frame, p in packets if not is_frame]
+        if pol:
+            ev = decode_polarity(pol)
+            self.events.append(ev)
+            self.n_events += len(ev)
+            if self.n_events >= EVENT_CHUNK:
+                self._write_events()
+        for is_frame, p in packets:
+            if is_frame:
+                ts, img = decode_frame(p)
+                n = len(self.frame)
+                self.frame.resize(n + 1, axis=0)
+                self.frame_ts.resize(n + 1, axis=0)
+                self.frame[n] = img
+                self.frame_ts[n, 0] = ts
+        with self.decoded.get_lock():
+            self.decoded.value += len(packets)
+
+    def _write_events(self):
+        if not self.events:
+            return
+        ev = np.concatenate(self.events)
+        n = len(self.event)
+        self.event.resize(n + len(ev), axis=0)
+        self.event[n:] = ev
+        self.events = []
+        self.n_events = 0
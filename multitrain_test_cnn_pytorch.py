@@ -40,6 +40,7 @@ if __name__ == '__main__':
     parser.add_argument('--checkpoint_dir',       default=None, help='Checkpoint file if we are resuming the training')
     parser.add_argument('--filename',     default='driving_cnn_19.4_multi', help='Filename to save model and log to.')
     parser.add_argument('--result_dir',     default='saved_models', help='Folder to save the model')
+    parser.add_argument('--index_cache',     default=None, help='Folder to cache the sample indexes of the h5files in')
     parser.add_argument('--optimizer',       default='Adam', help='Optimizer to use. Adam or  SGD')
     parser.add_argument('--lr',       default=0.1, type=float, help='Learning Rate')
     parser.add_argument('--img_size',         default=80, type=int, help='Dimension of image. Assumed to be square')
@@ -205,13 +206,13 @@ if __name__ == '__main__':
     # Dump some debug data if we like
     # print(network)
     if args.encoder_decoder:
-        temp = MultiHDF5EncoderDecoderVisualIterator()
+        temp = MultiHDF5EncoderDecoderVisualIterator(cache_dir=args.index_cache)
         for data in temp.flow(h5fs_aps, h5fs_dvs, args.dataset_keys_aps, args.dataset_keys_dvs, 'train_idxs', batch_size=args.batch_size, shuffle=True, seperate_dvs_channels = args.seperate_dvs_channels):
             vid_aps, vid_dvs = data
             break
         # print("Input Shape: {}, Output Shape: {}".format(vid_dvs.shape, vid_aps.shape))
     else:
-        temp = MultiHDF5VisualIterator()
+        temp = MultiHDF5VisualIterator(cache_dir=args.index_cache)
         for data in temp.flow(h5fs, args.dataset_keys, 'train_idxs', batch_size=args.batch_size, shuffle=True, seperate_dvs_channels = args.seperate_dvs_channels):
             vid_in_, bY = data
             if args.use_encoder:
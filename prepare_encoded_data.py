@@ -15,6 +15,12 @@ if __name__ == '__main__':
     parser.add_argument('--new_height', default=80, type=int)
     parser.add_argument('--new_width', default=80, type=int)
     parser.add_argument('--timesteps', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=0, help='encoder processes, 0 to encode in the main process (GPU)')
+    parser.add_argument('--batch_size', type=int, default=32, help='frames per encoder forward pass')
+    parser.add_argument('--threads', type=int, default=None, help='torch CPU threads per encoder process')
+    parser.add_argument('--access', default='random', choices=['random', 'sequential'],
+                        help='how the new keys are read for training, sets their HDF5 chunks')
+    parser.add_argument('--seq_length', type=int, default=30, help='frames per sequence, for sequential access')
     args = parser.parse_args()
 
 
@@ -32,7 +38,9 @@ if __name__ == '__main__':
         print('Encoding DVS frames to {}...'.format(new_dvs_key))
         sys.stdout.flush()
         start_time = time.time()
-        run_dvs_to_aps_into_new_key(dataset, args.dataset_key, new_dvs_key, new_size, args.pretrained_model_path)
+        run_dvs_to_aps_into_new_key(dataset, args.dataset_key, new_dvs_key, new_size, args.pretrained_model_path, workers=args.workers,
+                                    batch_size=args.batch_size, num_threads=args.threads,
+                                    access=args.access, seq_length=args.seq_length)
         print('Finished in {}s.'.format(time.time()-start_time))
 
     print('Done.  Preprocessing complete.')
@@ -2,7 +2,7 @@ from __future__ import print_function
 import numpy as np
 import h5py
 import os, sys, time, argparse
-from hdf5_deeplearn_utils import calc_data_mean, calc_data_std, build_train_test_split, build_simul_train_test_split, check_and_fix_timestamps, resize_data_into_new_key
+from hdf5_deeplearn_utils import build_train_test_split, build_simul_train_test_split, check_and_fix_timestamps, resize_data_into_new_key
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -18,6 +18,10 @@ if __name__ == '__main__':
     parser.add_argument('--seperate_dvs_channels', action="store_true")
     parser.add_argument('--split_timesteps', action='store_true')
     parser.add_argument('--timesteps', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=None, help='resize processes, default: one per core')
+    parser.add_argument('--access', default='random', choices=['random', 'sequential'],
+                        help='how the new keys are read for training, sets their HDF5 chunks')
+    parser.add_argument('--seq_length', type=int, default=30, help='frames per sequence, for sequential access')
     args = parser.parse_args()
 
     # Set new resize
@@ -26,8 +30,9 @@ if __name__ == '__main__':
     dataset_aps = h5py.File(args.filename_aps, 'a')
     dataset_dvs_accum = h5py.File(args.filename_dvs_accum, 'a')
     dataset_dvs_split = h5py.File(args.filename_dvs_split, 'a')
-    # print('Checking timestamps...')
-    # check_and_fix_timestamps(dataset)
+    print('Checking timestamps...')
+    for dataset in (dataset_aps, dataset_dvs_accum, dataset_dvs_split):
+        check_and_fix_timestamps(dataset)
 
     print('Calculating train/test split...')
     sys.stdout.flush()
@@ -38,65 +43,39 @@ if __name__ == '__main__':
         print('Resizing APS frames to {}...'.format(new_aps_key))
         sys.stdout.flush()
         start_time = time.time()
-        resize_data_into_new_key(dataset_aps, 'aps_frame', new_aps_key, new_size)
+        stats = resize_data_into_new_key(dataset_aps, 'aps_frame', new_aps_key, new_size, workers=args.workers, calc_stats=not args.skip_mean_std,
+                                         access=args.access, seq_length=args.seq_length)
         print('Finished in {}s.'.format(time.time()-start_time))
 
         if not args.skip_mean_std:
-            print('Calculating APS frame mean...')
-            sys.stdout.flush()
-            start_time = time.time()
-            calc_data_mean(dataset, new_aps_key, force=args.rewrite)
-            print('Finished in {}s.'.format(time.time()-start_time))
-
-            print('Calculating APS frame std...')
-            sys.stdout.flush()
-            start_time = time.time()
-            calc_data_std(dataset, new_aps_key, force=args.rewrite)
-            print('Finished in {}s.'.format(time.time()-start_time))
+            print('Saving APS frame mean/std...')
+            stats.save(dataset_aps, new_aps_key, force=args.rewrite)
 
     if np.any(dataset_dvs_accum['dvs_accum'][0]):
         new_dvs_key = '{}_{}x{}'.format('dvs_accum', new_size[0], new_size[1])
         print('Resizing DVS frames to {}...'.format(new_dvs_key))
         sys.stdout.flush()
         start_time = time.time()
-        resize_data_into_new_key(dataset_dvs_accum, 'dvs_accum', new_dvs_key, new_size)
+        stats = resize_data_into_new_key(dataset_dvs_accum, 'dvs_accum', new_dvs_key, new_size, workers=args.workers, calc_stats=not args.skip_mean_std,
+                                         access=args.access, seq_length=args.seq_length)
         print('Finished in {}s.'.format(time.time()-start_time))
 
         if not args.skip_mean_std:
-            print('Calculating DVS frame mean...')
-            sys.stdout.flush()
-            start_time = time.time()
-            calc_data_mean(dataset, new_dvs_key, force=args.rewrite)
-            print('Finished in {}s.'.format(time.time()-start_time))
-            sys.stdout.flush()
-
-            print('Calculating DVS frame std...')
-            sys.stdout.flush()
-            start_time = time.time()
-            calc_data_std(dataset, new_dvs_key, force=args.rewrite)
-            print('Finished in {}s.'.format(time.time()-start_time))
+            print('Saving DVS frame mean/std...')
+            stats.save(dataset_dvs_accum, new_dvs_key, force=args.rewrite)
 
     if np.any(dataset_dvs_split['dvs_split'][0]):
         new_dvs_key = '{}_{}x{}'.format('dvs_split', new_size[0], new_size[1])
         print('Resizing DVS frames to {}...'.format(new_dvs_key))
         sys.stdout.flush()
         start_time = time.time()
-        resize_data_into_new_key(dataset_dvs_split, 'dvs_split', new_dvs_key, new_size, seperate_dvs_channels=args.seperate_dvs_channels, split_timesteps = args.split_timesteps, timesteps = args.timesteps)
+        stats = resize_data_into_new_key(dataset_dvs_split, 'dvs_split', new_dvs_key, new_size, seperate_dvs_channels=args.seperate_dvs_channels, split_timesteps = args.split_timesteps, timesteps = args.timesteps, workers=args.workers, calc_stats=not args.skip_mean_std,
+                                         access=args.access, seq_length=args.seq_length)
         print('Finished in {}s.'.format(time.time()-start_time))
 
         if not args.skip_mean_std:
-            print('Calculating DVS frame mean...')
-            sys.stdout.flush()
-            start_time = time.time()
-            calc_data_mean(dataset, new_dvs_key, force=args.rewrite)
-            print('Finished in {}s.'.format(time.time()-start_time))
-            sys.stdout.flush()
-
-            print('Calculating DVS frame std...')
-            sys.stdout.flush()
-            start_time = time.time()
-            calc_data_std(dataset, new_dvs_key, force=args.rewrite)
-            print('Finished in {}s.'.format(time.time()-start_time))
+            print('Saving DVS frame mean/std...')
+            stats.save(dataset_dvs_split, new_dvs_key, force=args.rewrite)
 
     print('Done.  Preprocessing complete.')
     filesize = os.path.getsize(args.filename_aps)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+'''
+Rewrites the derived training datasets of preprocessed files with the
+chunk layout of their access pattern.
+
+resize_data_into_new_key and run_dvs_to_aps_into_new_key used to chunk
+their output by 1024 frames, so every frame of a shuffled batch reads a
+whole chunk. This rewrites such files the way the prepare scripts create
+them now: one chunk per frame for random access (MultiHDF5VisualIterator,
+MultiHDF5EncoderDecoderVisualIterator), seq_length frames per chunk for
+sequences (MultiHDF5SeqVisualIterator). Each file is copied into a
+temporary file next to it, which then replaces the original, so the space
+of the old chunks is given back.
+
+This software is released under the
+GNU LESSER GENERAL PUBLIC LICENSE Version 3.
+
+Usage:
+ $ ./rechunk.py <file.hdf5> [<file.hdf5> ...] [--access random|sequential] [--seq_length L]
+                [--keys KEY [KEY ...]] [--workers N]
+'''
+
+from __future__ import print_function
+import os
+import argparse
+import multiprocessing as mp
+import h5py
+from hdf5_deeplearn_utils import ACCESS_RANDOM, ACCESS_SEQUENTIAL, chunk_layout, create_frame_dataset
+
+# datasets that are read sequentially by the preprocessing, never rechunked by default
+SOURCE_KEYS = ('aps_frame', 'dvs_frame', 'dvs_accum', 'dvs_split', 'dvs_channels')
+# frames per copy
+COPY_ROWS = 1024
+
+
+def derived_keys(f):
+    ''' datasets of frames made by the preprocessing '''
+    return sorted(k for k, ds in f.items() if isinstance(ds, h5py.Dataset)
+                  and ds.ndim >= 3 and k not in SOURCE_KEYS)
+
+
+def copy_rechunked(ds, g, access, seq_length):
+    ''' copy dataset ds into group g with the chunk layout of the access pattern '''
+    new = create_frame_dataset(g, ds.name.split('/')[-1], ds.shape, ds.dtype, access, seq_length,
+                               compression=ds.compression, compression_opts=ds.compression_opts)
+    for pos in range(0, len(ds), COPY_ROWS):
+        new[pos:pos + COPY_ROWS] = ds[pos:pos + COPY_ROWS]
+    for k, v in ds.attrs.items():
+        if k not in new.attrs:
+            new.attrs[k] = v
+    return new
+
+
+def rechunk(fname, keys=None, access=ACCESS_RANDOM, seq_length=1):
+    ''' rewrite a file with new chunks for keys, returns {key: (old chunks, new chunks)} '''
+    with h5py.File(fname, 'r') as f:
+        keys = derived_keys(f) if keys is None else [k for k in keys if k in f]
+        out = {k: (f[k].chunks, chunk_layout(f[k].shape[1:], access, min(seq_length, max(len(f[k]), 1))))
+               for k in keys}
+    if all(old == new for old, new in out.values()):
+        return out
+    tmp = fname + '.rechunk.tmp'
+    try:
+        with h5py.File(fname, 'r') as f, h5py.File(tmp, 'w') as g:
+            for k, v in f.attrs.items():
+                g.attrs[k] = v
+            for k in f:
+                if k in out:
+                    copy_rechunked(f[k], g, access, seq_length)
+                else:
+                    f.copy(k, g)
+        os.replace(tmp, fname)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return out
+
+
+def _rechunk(job):
+    fname, keys, access, seq_length = job
+    try:
+        return fname, rechunk(fname, keys, access, seq_length), None
+    except (IOError, OSError, KeyError, ValueError) as e:
+        return fname, None, e
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filenames', nargs='+')
+    parser.add_argument('--access', default=ACCESS_RANDOM, choices=[ACCESS_RANDOM, ACCESS_SEQUENTIAL])
+    parser.add_argument('--seq_length', type=int, default=30, help='frames per sequence, for sequential access')
+    parser.add_argument('--keys', nargs='+', default=None, help='default: all datasets of frames but the sources')
+    parser.add_argument('--workers', type=int, default=None, help='default: one per core')
+    args = parser.parse_args()
+    seq_length = args.seq_length if args.access == ACCESS_SEQUENTIAL else 1
+    pool = mp.Pool(min(args.workers or mp.cpu_count(), len(args.filenames)))
+    try:
+        jobs = [(fname, args.keys, args.access, seq_length) for fname in args.filenames]
+        for fname, chunks, err in pool.imap_unordered(_rechunk, jobs):
+            if err is not None:
+                print('%s: failed (%s)' % (fname, err))
+            elif not chunks:
+                print('%s: nothing to rechunk' % fname)
+            else:
+                print('%s: %s' % (fname, ', '.join(
+                    '%s %s -> %s' % (k, old, new) for k, (old, new) in sorted(chunks.items()))))
+    finally:
+        pool.close()
+        pool.join()
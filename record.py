@@ -15,10 +15,11 @@ Usage:
  $ ./record.py <recording_file.hdf5>
 '''
 
-import time, sys, os, signal, thread
+import time, sys, os, signal, thread, select
 import numpy as np
 import interfaces, datasets
-from reporting import Stats
+from live_decode import LiveDecoder
+from reporting import Stats, JSONLinesSink, PrometheusSink
 from view import Viewer, unpack_data
 import queue
 
@@ -27,6 +28,36 @@ BUFSIZE_DS = 32384
 BUFSIZE_AER = 8192
 BUFSIZE_OXC = 1024
 
+# max. number of items taken from one source per wake-up
+MAX_DRAIN = 256
+# seconds between stats updates
+STATS_INTERVAL = 1.
+# recording metrics, written next to the recording (<recording>.metrics.jsonl)
+METRICS_JSONL = True
+# Prometheus textfile, e.g. for node_exporter's textfile collector (None for off)
+METRICS_PROM = None
+# print a status line per stats update
+DASHBOARD = True
+
+# write-ahead journal (one per segment), rebuild a crashed recording with
+# recover.py, for segments: ./recover.py rec<ts>.manifest.json
+JOURNAL = True
+
+# roll over to a new file every few minutes (0 for one monolithic file),
+# the segments are listed in rec<ts>.manifest.json
+SEGMENT_DURATION = 5 * 60
+SEGMENT_SIZE = 0
+
+# decode polarity events and frames while recording, into
+# <recording>.decoded.hdf5 (packets are dropped there if the decoder lags)
+LIVE_DECODE = False
+BUFSIZE_DECODE = 256
+
+# replay VI messages from a recording instead of the car (None for the live VI)
+VI_REPLAY = None
+# or send synthetic VI messages at this multiple of the usual rates (0 for off)
+VI_SYNTHETIC = 0
+
 dtypes = {
         'dvs/data': (datasets.h5py.special_dtype(vlen=np.uint8), (3,)),
         'dvs/timestamp': int,
@@ -95,6 +126,20 @@ conversions_vi = {
         'gear_lever_position': lambda v: gear_position.get(v, 99), # added defauult of 99 for unknown values rather than None
         }
 
+# recorded values back to what the VI sends, for VI_REPLAY
+ignition_names = {v: k for k, v in ignition_status.items()}
+gear_names = {v: k for k, v in gear_position.items()}
+replay_conversions_vi = {
+        'brake_pedal_status': bool,
+        'headlamp_status': bool,
+        'high_beam_status': bool,
+        'parking_brake_status': bool,
+        'windshield_wiper_status': bool,
+        'ignition_status': lambda v: ignition_names.get(int(v)),
+        'transmission_gear_position': lambda v: gear_names.get(int(v)),
+        'gear_lever_position': lambda v: gear_names.get(int(v)),
+        }
+
 # -- end of config --
 
 
@@ -122,6 +167,86 @@ def save_vi(ds, data):
     })
     return True
 
+class Ticker(object):
+    ''' fires at a fixed rate, no matter how often it is polled '''
+    def __init__(self, interval):
+        self.interval = interval
+        self.t_next = time.time()
+
+    def remaining(self):
+        return max(self.t_next - time.time(), 0)
+
+    def due(self):
+        t = time.time()
+        if t < self.t_next:
+            return False
+        self.t_next = max(self.t_next + self.interval, t)
+        return True
+
+
+def wait_for_data(sources, timeout):
+    ''' block until one of the monitor queues has data, returns ready sources '''
+    readers = {s.q._reader: s for s in sources}
+    try:
+        ready, _, _ = select.select(list(readers), [], [], timeout)
+    except select.error:
+        # interrupted
+        return []
+    return [readers[r] for r in ready]
+
+def drain_aer(aer, handle):
+    for _ in range(MAX_DRAIN):
+        batch = aer.get_batch()
+        if not batch:
+            break
+        for res in batch:
+            if res['etype'] in interfaces.caer.EVENT_TYPES and res['evalid']:
+                handle(res)
+
+def drain_vi(vi, handle):
+    for _ in range(MAX_DRAIN):
+        res = vi.get()
+        if not res:
+            break
+        handle(res)
+
+def pump(aer, vi, handle_aer, handle_vi, timeout):
+    ''' wait for aer or vi data and pass everything available to the handlers '''
+    for src in wait_for_data([aer, vi], timeout):
+        if src is aer:
+            drain_aer(aer, handle_aer)
+        else:
+            drain_vi(vi, handle_vi)
+
+def ignore(res):
+    pass
+
+def show_latest(viewer, latest):
+    '''
+    show the most recent packet of each type, and the polarity events
+    the viewer accumulated since the last call
+    '''
+    for k in sorted(latest, key=lambda k: k in interfaces.caer.EVENT_TYPES):
+        viewer.show(latest[k])
+    latest.clear()
+    viewer.show_polarity()
+
+def preview(viewer, latest, res):
+    ''' polarity packets all go to the viewer, of the others only the latest is shown '''
+    if res['etype'] == 'polarity_event':
+        viewer.accumulate(res)
+    else:
+        latest[res['etype']] = res
+
+def vi_source():
+    ''' stand-in VI source if configured, None for the live VI '''
+    if VI_REPLAY:
+        return interfaces.openxc.ReplaySource(
+                VI_REPLAY, loop=True, conversions=replay_conversions_vi)
+    if VI_SYNTHETIC:
+        return interfaces.openxc.SyntheticSource(scale=VI_SYNTHETIC)
+    return None
+
 def get_filename():
     ''' generate file name of the recording file '''
     filename = 'rec%s.hdf5' % int(time.time())
@@ -141,42 +266,56 @@ def input_thread(l):
 
 if __name__ == '__main__':
     filename = get_filename()
-    aer = interfaces.caer.Monitor(bufsize=BUFSIZE_AER)
-    vi = interfaces.openxc.Monitor(bufsize=BUFSIZE_OXC)
+    aer = interfaces.caer.BatchMonitor(bufsize=BUFSIZE_AER)
+    vi = interfaces.openxc.Monitor(bufsize=BUFSIZE_OXC, source=vi_source())
     exposure = interfaces.caer.ExposureCtl()
     # flush buffers
     t = time.time()
     while time.time() - t < 1:
-        aer.get()
-        vi.get()
-    
-    # pre-recording loop
+        pump(aer, vi, ignore, ignore, 0.1)
+
+    # pre-recording loop, the viewer only gets the latest packets at its own rate
     viewer = Viewer(zoom=1.41,rotate180=True)
+    latest = {}
+    def preview_aer(res):
+        preview(viewer, latest, res)
+        exposure.update(res)
+    def preview_vi(res):
+        latest[res['name']] = res
+    view_tick = Ticker(viewer.min_dt)
     inp_detect = []
     thread.start_new_thread(input_thread, (inp_detect,))
     while not inp_detect:
-        res = aer.get()
-        if res and res['etype'] in interfaces.caer.EVENT_TYPES and res['evalid']:
-            viewer.show(res)
-            exposure.update(res)
-        res = vi.get()
-        if res:
-            viewer.show(res)
+        pump(aer, vi, preview_aer, preview_vi, view_tick.remaining())
+        if view_tick.due():
+            show_latest(viewer, latest)
     # end of pre-recording loop
 
     # init recording file
-    dataset = datasets.HDF5(filename, dtypes, bufsize=BUFSIZE_DS)
+    dataset = datasets.HDF5(filename, dtypes, bufsize=BUFSIZE_DS, overflow='spill',
+            journal=filename + '.journal' if JOURNAL else None,
+            segment_duration=SEGMENT_DURATION, segment_size=SEGMENT_SIZE)
+    decoder = LiveDecoder(filename, bufsize=BUFSIZE_DECODE) if LIVE_DECODE else None
     count_aer = {k: 0 for k in interfaces.caer.EVENT_TYPES}
+    count_pkt = {k: 0 for k in interfaces.caer.EVENT_TYPES}
     count_vi = {k: 0 for k in dtypes_vi}
+    sinks = []
+    if METRICS_JSONL:
+        sinks.append(JSONLinesSink(filename + '.metrics.jsonl'))
+    if METRICS_PROM:
+        sinks.append(PrometheusSink(METRICS_PROM))
+    buffers = {'aer': aer, 'vi': vi, 'dataset': dataset}
+    if decoder:
+        buffers['decoder'] = decoder
     stats = Stats(filename,
-            counters={'aer': count_aer, 'vi': count_vi},
-            buffers={'aer': aer, 'vi': vi, 'dataset': dataset})
+            counters={'aer': count_aer, 'aer_packets': count_pkt, 'vi': count_vi},
+            buffers=buffers,
+            sinks=sinks, dashboard=DASHBOARD, interval=STATS_INTERVAL)
 
     # flush buffers
     t = time.time()
     while time.time() - t < 0.2:
-        aer.get()
-        vi.get()
+        pump(aer, vi, ignore, ignore, 0.1)
 
 
     # wait for keyboard input
@@ -184,29 +323,43 @@ if __name__ == '__main__':
         raw_input('hit enter to end recording...')
         list.append(None)
 
+    def record_aer(res):
+        save_aer(dataset, res)
+        count_aer[res['etype']] += res['ecapacity']
+        count_pkt[res['etype']] += 1
+        if decoder:
+            decoder.save(res)
+        preview(viewer, latest, res)
+        exposure.update(res)
+    def record_vi(res):
+        if save_vi(dataset, res):
+            count_vi[res['name']] += 1
+            latest[res['name']] = res
+
     #start recording
     raw_inp = []
     viewer.set_fps(5)
-    
-    
+    view_tick = Ticker(viewer.min_dt)
+    stats_tick = Ticker(STATS_INTERVAL)
+    latest.clear()
+
     thread.start_new_thread(end_thread, (raw_inp,))
     while not raw_inp:
 #    while not dataset.exit.is_set():
         try:
-            # get aer data
-            res = aer.get()
-            if res and res['etype'] in interfaces.caer.EVENT_TYPES and res['evalid']:
-                save_aer(dataset, res)
-                count_aer[res['etype']] += res['ecapacity']
-                viewer.show(res)
-                exposure.update(res)
-            # get vi data
-            res = vi.get()
-            if res:
-                if save_vi(dataset, res):
-                  count_vi[res['name']] += 1
-                  viewer.show(res)
-            stats.report()
+            # sleep until there is data or the viewer/stats are due
+            timeout = min(view_tick.remaining(), stats_tick.remaining())
+            pump(aer, vi, record_aer, record_vi, timeout)
+            if decoder:
+                decoder.flush()
+            stats.track()
+            if view_tick.due():
+                show_latest(viewer, latest)
+            if stats_tick.due():
+                stats.report(force=True)
+                if stats.failed:
+                    print('\nstopping, %s not running' % ', '.join(stats.failed))
+                    break
         except KeyboardInterrupt:
             print('\ninterrupt, exiting...')
             dataset.exit.set()
@@ -215,10 +368,22 @@ if __name__ == '__main__':
             print('queue full, ignoring')
             pass
 
+    m = dataset.metrics()
+    if m['spilled'] or m['dropped']:
+        print('\n%d rows spilled to disk, %d dropped' % (m['spilled'], m['dropped']))
+    if vi.dropped.value:
+        print('\n%d VI messages dropped (buffer full)' % vi.dropped.value)
+
     print('\nexiting...')
+    stats.close()
+    if decoder:
+        decoder.close()
+        if decoder.dropped.value:
+            print('%d packets not decoded' % decoder.dropped.value)
     dataset.exit.set()
     aer.exit.set()
     vi.exit.set()
+    exposure.close()
     viewer.close()
 
 
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+'''
+Rebuild a recording from its write-ahead journal
+and whatever survived in the (possibly corrupted) HDF5 file.
+Segmented recordings have a journal per segment, only the segments the
+manifest doesn't list as complete are rebuilt.
+
+This software is released under the
+GNU LESSER GENERAL PUBLIC LICENSE Version 3.
+
+Usage:
+ $ ./recover.py <recording.hdf5.journal> [--hdf5 <recording.hdf5>] [--out_file <out.hdf5>]
+ $ ./recover.py <recording.manifest.json>
+
+ Rows that failed to write are taken from <recording.hdf5>.ioerrors.journal
+ if it exists. Without a journal, put them back into the recording with
+ $ ./recover.py <recording.hdf5.ioerrors.journal> --hdf5 <recording.hdf5> --ioerrors
+'''
+
+from __future__ import print_function
+import os
+import argparse
+import h5py
+from journal import read_journal, read_failures, ioerrors_name
+from datasets import HDF5
+from valid_length import valid_length
+import segments
+
+
+def open_surviving(fname, tables):
+    '''
+    Returns surviving datasets by column name,
+    or an empty dict if the file can't be read at all.
+    '''
+    if not fname:
+        return None, {}
+    try:
+        f = h5py.File(fname, 'r')
+    except (IOError, OSError) as e:
+        print('could not open %s (%s), using journal only' % (fname, e))
+        return None, {}
+    found = {}
+    for tname in tables:
+        try:
+            found[tname.replace('/', '_')] = f[tname]
+        except (KeyError, IOError, OSError):
+            print('table %s did not survive' % tname)
+    return f, found
+
+
+def merge_failed(ds, failed, n):
+    '''
+    Returns the rows of a column in recording order: the first n rows
+    of the dataset with the failed chunks [(first row, rows), ...] put back
+    where they belong, and the chunks that come after the end of the dataset.
+    '''
+    rows, pos, h = [], 0, 0
+    chunks = list(failed)
+    while chunks and chunks[0][0] is not None and chunks[0][0] - pos <= n - h:
+        first, vals = chunks.pop(0)
+        rows.extend(ds[h:h + first - pos])
+        h += first - pos
+        rows.extend(vals)
+        pos = first + len(vals)
+    rows.extend(ds[h:n])
+    return rows, chunks
+
+
+def recover(journal_fname, hdf5_fname=None, out_file=None, ioerrors=False, ioerrors_fname=None):
+    '''
+    Without ioerrors, journal_fname holds all rows and the failed rows of
+    ioerrors_fname (default: the one of hdf5_fname) tell which of them are
+    missing from the HDF5 file. With ioerrors, journal_fname is the ioerrors
+    journal and only the rows it holds are added.
+    '''
+    if ioerrors:
+        tables, failed = read_failures(journal_fname)
+        rows = ()
+    else:
+        tables, rows = read_journal(journal_fname)
+        if ioerrors_fname is None and hdf5_fname:
+            ioerrors_fname = ioerrors_name(hdf5_fname)
+        failed = {}
+        if ioerrors_fname and os.path.exists(ioerrors_fname):
+            failed = read_failures(ioerrors_fname)[1]
+    f_in, survived = open_surviving(hdf5_fname, tables)
+    out_file = out_file or (hdf5_fname or journal_fname) + '.recovered.hdf5'
+    f_out = HDF5(out_file, tables, mode='w-', overflow='block', timeout=None)
+
+    # copy what survived in the HDF5 file, with the rows that failed to
+    # write put back at their position
+    skip = {}
+    for col in set(survived) | set(failed):
+        try:
+            ds = survived.get(col, ())
+            n = valid_length(ds) if col in survived else 0
+            merged, later = merge_failed(ds, failed.get(col, ()), n)
+        except (IOError, OSError):
+            print('read error in %s, relying on journal' % col)
+            merged, later = [], failed.get(col, [])
+        if ioerrors:
+            # no journal to take the rows after the file from
+            for first, vals in later:
+                merged.extend(vals)
+        for val in merged:
+            f_out.save({col: val})
+        skip[col] = len(merged)
+        print('%s: %d rows from hdf5 and ioerrors journal' % (col, len(merged)))
+    if f_in is not None:
+        f_in.close()
+
+    # the journal holds all rows in order, skip the ones already copied
+    seen = {}
+    n_journal = 0
+    for row in rows:
+        new = {}
+        for col, val in row.items():
+            seen[col] = seen.get(col, 0) + 1
+            if seen[col] > skip.get(col, 0):
+                new[col] = val
+        if new:
+            f_out.save(new)
+            n_journal += 1
+    print('%d rows from journal' % n_journal)
+    f_out.exit.set()
+    f_out.join()
+    print('recovered recording written to', out_file)
+    return out_file
+
+
+def recover_segments(manifest_fname):
+    '''
+    rebuild the incomplete segments of a manifest into <segment>.recovered.hdf5,
+    trimmed like complete segments, and list them in the manifest instead
+    '''
+    manifest = segments.read_manifest(manifest_fname)
+    for seg in manifest['segments']:
+        if seg.get('complete', True):
+            continue
+        journal_fname = seg['path'] + '.journal'
+        if not os.path.exists(journal_fname):
+            print('no journal for %s, leaving it out' % seg['file'])
+            continue
+        out_file = recover(journal_fname, seg['path'], seg['path'] + '.recovered.hdf5')
+        rows, t_lo, t_hi = {}, [], []
+        with h5py.File(out_file, 'a') as f:
+            def trim(name, ds):
+                if not isinstance(ds, h5py.Dataset):
+                    return
+                col = name.replace('/', '_')
+                n = rows[col] = valid_length(ds)
+                ds.resize(n, axis=0)
+                if col == 'timestamp' or col.endswith('_timestamp'):
+                    ts = ds[:n].ravel()
+                    ts = ts[ts != 0]
+                    if len(ts):
+                        t_lo.append(ts.min().item())
+                        t_hi.append(ts.max().item())
+            f.visititems(trim)
+        seg.update(file=out_file, rows=rows, complete=True,
+                   t_start=min(t_lo) if t_lo else None, t_stop=max(t_hi) if t_hi else None)
+    info = {k: v for k, v in manifest.items() if k not in ('version', 'segments')}
+    segments.write_manifest(manifest_fname, manifest['segments'], **info)
+    print('manifest updated:', manifest_fname)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('journal')
+    parser.add_argument('--hdf5', default=None)
+    parser.add_argument('--out_file', default=None)
+    parser.add_argument('--ioerrors', action='store_true',
+                        help='journal only contains rows that failed to write')
+    parser.add_argument('--ioerrors_journal', default=None,
+                        help='rows that failed to write, default: <hdf5>.ioerrors.journal')
+    args = parser.parse_args()
+    if segments.is_manifest(args.journal):
+        recover_segments(args.journal)
+    else:
+        recover(args.journal, args.hdf5, args.out_file, args.ioerrors, args.ioerrors_journal)
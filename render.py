@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+'''
+Headless movie renderer for exported recordings (export.py output),
+optionally comparing recorded and predicted steering angles.
+
+The recording is split into time shards that are composited and encoded
+by a process pool, each into its own segment, and the segments are
+concatenated at the end (with ffmpeg if available, otherwise with
+OpenCV). No display is needed.
+
+This software is released under the
+GNU LESSER GENERAL PUBLIC LICENSE Version 3.
+
+Usage:
+ $ ./render.py <recording_export.hdf5>
+ $ ./render.py <recording_export.hdf5> --predictions <pred.hdf5|.npy|.txt> --out_file movie.mp4
+'''
+
+from __future__ import print_function
+import os
+import shutil
+import argparse
+import subprocess
+import multiprocessing as mp
+import numpy as np
+import h5py
+import cv2
+from view import draw_steering_wheel, CV_AA
+from interfaces.caer import DVS_SHAPE
+from valid_length import valid_length
+
+# rows read from the recording at once
+READ_ROWS = 64
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+COLOR_TRUTH = (0, 0, 255)
+COLOR_PRED = (255, 255, 0)
+
+
+def load_predictions(fname, key='steering_wheel_angle'):
+    '''
+    Returns timestamps (s) and predicted angles (deg), from an hdf5 file
+    with `timestamp` and `key` datasets, or a 2 column .npy / text file.
+    '''
+    if fname.endswith(('.h5', '.hdf5')):
+        with h5py.File(fname, 'r') as f:
+            return f['timestamp'][:].ravel(), f[key][:].ravel()
+    d = np.load(fname) if fname.endswith('.npy') else np.loadtxt(fname, delimiter=None)
+    return d[:, 0], d[:, 1]
+
+
+def dvs_image(accum, contrast):
+    ''' signed event counts to 8 bit gray '''
+    img = 127.5 + accum.astype(np.float32) * (127.5 / contrast)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def compose(aps, dvs, angle, pred, speed, t, opts):
+    ''' APS and DVS panels side by side with steering and speed overlays '''
+    panels = []
+    for img in (aps, dvs):
+        if img is None:
+            continue
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        if opts['rotate']:
+            img = cv2.flip(img, -1)
+        draw_steering_wheel(img, angle, COLOR_TRUTH, opts['rotate'], label=False)
+        if pred is not None:
+            draw_steering_wheel(img, pred, COLOR_PRED, opts['rotate'], label=False)
+        panels.append(img)
+    out = np.hstack(panels)
+    info = '%7.1f s  %5.1f km/h  %6.1f deg' % (t, speed, angle)
+    if pred is not None:
+        info += '  (pred. %6.1f deg)' % pred
+    cv2.putText(out, info, (10, out.shape[0] - 10), FONT, 0.4, (255, 255, 255), 1, CV_AA)
+    if opts['zoom'] != 1:
+        out = cv2.resize(out, None, fx=opts['zoom'], fy=opts['zoom'],
+                         interpolation=cv2.INTER_AREA if opts['zoom'] < 1 else cv2.INTER_CUBIC)
+    return out
+
+
+def frame_size(opts):
+    n = int(opts['aps']) + int(opts['dvs'])
+    return int(round(DVS_SHAPE[1] * n * opts['zoom'])), int(round(DVS_SHAPE[0] * opts['zoom']))
+
+
+def render_shard(job):
+    ''' render rows [start, stop) of the recording into one segment '''
+    fname, start, stop, seg_fname, pred, opts = job
+    writer = cv2.VideoWriter(seg_fname, cv2.VideoWriter_fourcc(*opts['codec']),
+                             opts['fps'], frame_size(opts))
+    with h5py.File(fname, 'r') as f:
+        t0 = opts['t0']
+        for a in range(start, stop, READ_ROWS):
+            b = min(a + READ_ROWS, stop)
+            ts = f['timestamp'][a:b].ravel()
+            aps = f['aps_frame'][a:b] if opts['aps'] else [None] * (b - a)
+            dvs = f['dvs_accum'][a:b] if opts['dvs'] else [None] * (b - a)
+            angle = f['steering_wheel_angle'][a:b].ravel()
+            speed = f['vehicle_speed'][a:b].ravel() if 'vehicle_speed' in f else np.zeros(b - a)
+            p = np.interp(ts, *pred) if pred is not None else [None] * (b - a)
+            for i in range(b - a):
+                writer.write(compose(
+                    aps[i], dvs_image(dvs[i], opts['contrast']) if opts['dvs'] else None,
+                    angle[i], p[i], speed[i], ts[i] - t0, opts))
+    writer.release()
+    return seg_fname
+
+
+def concat_segments(segments, out_file, opts):
+    ''' join segments, losslessly with ffmpeg if it is installed '''
+    if shutil.which('ffmpeg'):
+        lst = out_file + '.segments.txt'
+        with open(lst, 'w') as f:
+            f.write(''.join("file '%s'\n" % os.path.abspath(s) for s in segments))
+        try:
+            subprocess.check_call(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat',
+                                   '-safe', '0', '-i', lst, '-c', 'copy', out_file])
+            return
+        except subprocess.CalledProcessError:
+            print('ffmpeg failed, concatenating with OpenCV')
+        finally:
+            os.remove(lst)
+    writer = cv2.VideoWriter(out_file, cv2.VideoWriter_fourcc(*opts['codec']),
+                             opts['fps'], frame_size(opts))
+    for s in segments:
+        cap = cv2.VideoCapture(s)
+        while True:
+            ok, img = cap.read()
+            if not ok:
+                break
+            writer.write(img)
+        cap.release()
+    writer.release()
+
+
+def render(fname, out_file, predictions=None, workers=None, shard_rows=None,
+           tstart=0, tstop=None, keep_segments=False, **opts):
+    with h5py.File(fname, 'r') as f:
+        n = valid_length(f['timestamp'])
+        ts = f['timestamp'][:n].ravel()
+        opts['aps'] = opts['aps'] and 'aps_frame' in f
+        opts['dvs'] = opts['dvs'] and 'dvs_accum' in f
+    if not (opts['aps'] or opts['dvs']):
+        raise ValueError('%s contains neither aps_frame nor dvs_accum' % fname)
+    opts['t0'] = ts[0]
+    if not opts.get('fps'):
+        # one movie frame per exported row, in real time
+        opts['fps'] = 1. / np.median(np.diff(ts)) if n > 1 else 10.
+    start = int(np.searchsorted(ts, ts[0] + tstart))
+    stop = int(np.searchsorted(ts, ts[0] + tstop)) if tstop is not None else n
+    pred = load_predictions(predictions) if predictions else None
+
+    workers = workers or mp.cpu_count()
+    shard_rows = shard_rows or max(-(-(stop - start) // (4 * workers)), 1)
+    base = os.path.splitext(out_file)[0]
+    jobs = [(fname, a, min(a + shard_rows, stop), '%s.part%04d%s' % (
+                base, i, os.path.splitext(out_file)[1]), pred, opts)
+            for i, a in enumerate(range(start, stop, shard_rows))]
+    print('rendering %d frames at %.1f fps in %d shards on %d workers' % (
+        stop - start, opts['fps'], len(jobs), workers))
+    pool = mp.Pool(workers)
+    try:
+        segments = []
+        for s in pool.imap(render_shard, jobs):
+            segments.append(s)
+            print('\r%d/%d shards done' % (len(segments), len(jobs)), end='')
+        print()
+    finally:
+        pool.close()
+        pool.join()
+    concat_segments(segments, out_file, opts)
+    if not keep_segments:
+        for s in segments:
+            os.remove(s)
+    print('movie written to', out_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', help='exported recording (export.py)')
+    parser.add_argument('--predictions', default=None,
+                        help='predicted steering angles (hdf5 with timestamp and '
+                             'steering_wheel_angle, or 2 column .npy/.txt)')
+    parser.add_argument('--out_file', default=None)
+    parser.add_argument('--tstart', type=float, default=0, help='start (s)')
+    parser.add_argument('--tstop', type=float, default=None, help='stop (s)')
+    parser.add_argument('--fps', type=float, default=0, help='default: real time')
+    parser.add_argument('--zoom', type=float, default=1.)
+    parser.add_argument('--contrast', type=float, default=2,
+                        help='DVS event count for full scale')
+    parser.add_argument('--rotate', action='store_true', help='rotate by 180 degrees')
+    parser.add_argument('--no_aps', dest='aps', action='store_false')
+    parser.add_argument('--no_dvs', dest='dvs', action='store_false')
+    parser.add_argument('--codec', default='mp4v', help='fourcc of the video codec')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--shard_rows', type=int, default=None, help='rows per segment')
+    parser.add_argument('--keep_segments', action='store_true')
+    args = parser.parse_args()
+
+    render(args.filename, args.out_file or os.path.splitext(args.filename)[0] + '.mp4',
+           predictions=args.predictions, workers=args.workers, shard_rows=args.shard_rows,
+           tstart=args.tstart, tstop=args.tstop, keep_segments=args.keep_segments,
+           fps=args.fps, zoom=args.zoom, contrast=args.contrast, rotate=args.rotate,
+           aps=args.aps, dvs=args.dvs, codec=args.codec)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+'''
+Stand-in for a caer server, serving a DDD20 recording over the caer
+network protocol, so record.py and interfaces.caer can be benchmarked
+without a camera.
+
+This software is released under the
+GNU LESSER GENERAL PUBLIC LICENSE Version 3.
+
+Usage:
+ Replay in real time
+ $ ./replay_caer.py <recording.hdf5>
+
+ Replay at 4x speed, or as fast as the client reads
+ $ ./replay_caer.py <recording.hdf5> --speed 4x
+ $ ./replay_caer.py <recording.hdf5> --speed max
+'''
+
+from __future__ import print_function
+import time
+import socket
+import struct
+import argparse
+import threading
+import numpy as np
+from segments import open_recording
+from interfaces.caer import HOST, PORT, PORT_CTL, _header
+
+# magic number, sequence number, version number, format number, source ID
+STREAM_MAGIC = 0x1D378BC90B9A6658
+_stream_header = struct.Struct('llbbh')
+
+# rows read from the recording at once
+READ_ROWS = 256
+# seconds between rate reports
+REPORT_INTERVAL = 1.
+
+
+def parse_speed(s):
+    ''' 'realtime' -> 1, '4x' -> 4, 'max' -> 0 (no pacing) '''
+    s = s.strip().lower()
+    if s == 'max':
+        return 0.
+    if s == 'realtime':
+        return 1.
+    return float(s.rstrip('x'))
+
+
+def read_packets(fname, loop=False):
+    ''' yields (recording timestamp in us, packet bytes) '''
+    f = open_recording(fname)
+    ds = f['dvs']['data']
+    n = len(ds)
+    try:
+        while True:
+            for i in range(0, n, READ_ROWS):
+                for sys_ts, head, body in ds[i:i + READ_ROWS]:
+                    if not len(sys_ts):
+                        # zero padding at the end of the file
+                        continue
+                    yield int(sys_ts.tobytes()), head.tobytes() + body.tobytes()
+            if not loop:
+                return
+    finally:
+        f.close()
+
+
+class Rate(object):
+    ''' packet/event/byte counters, printed every REPORT_INTERVAL '''
+    def __init__(self):
+        self.t_start = self.t_pre = time.time()
+        self.packets = self.events = self.bytes = 0
+        self.total = [0, 0, 0]
+
+    def add(self, p):
+        self.packets += 1
+        self.events += _header.unpack_from(p)[5]  # ecapacity
+        self.bytes += len(p)
+
+    def report(self, lag, force=False):
+        t = time.time()
+        dt = t - self.t_pre
+        if dt < REPORT_INTERVAL and not force:
+            return
+        print('%8.1f pkt/s %10.1f ev/s %7.2f MB/s  lag %6.3f s' % (
+            self.packets / dt, self.events / dt, self.bytes / dt * 1e-6, lag))
+        for i, v in enumerate((self.packets, self.events, self.bytes)):
+            self.total[i] += v
+        self.packets = self.events = self.bytes = 0
+        self.t_pre = t
+
+    def summary(self):
+        dt = time.time() - self.t_start
+        p, e, b = self.total
+        print('sent %d packets, %d events, %.1f MB in %.1f s (%.1f ev/s)' % (
+            p, e, b * 1e-6, dt, e / max(dt, 1e-9)))
+
+
+def serve_stream(conn, fname, speed=1., loop=False):
+    '''
+    Send the stream header, then the recorded packets, paced by their
+    recording timestamps divided by speed (no pacing if speed is 0).
+    '''
+    conn.sendall(_stream_header.pack(STREAM_MAGIC, 0, 1, 0, 1))
+    rate = Rate()
+    t_rec0 = t_wall0 = ts_pre = None
+    out, lag = [], 0.
+    for ts, p in read_packets(fname, loop):
+        if t_rec0 is None or ts < ts_pre:
+            # start, or the recording wrapped around (--loop): re-anchor the pacing
+            t_rec0, t_wall0 = ts, time.time()
+        ts_pre = ts
+        if speed:
+            due = t_wall0 + (ts - t_rec0) * 1e-6 / speed
+            wait = due - time.time()
+            if wait > 0:
+                # send what is due before sleeping
+                if out:
+                    conn.sendall(b''.join(out))
+                    out = []
+                time.sleep(wait)
+            lag = max(-wait, 0)
+        out.append(p)
+        rate.add(p)
+        if len(out) >= READ_ROWS:
+            conn.sendall(b''.join(out))
+            out = []
+        rate.report(lag)
+    if out:
+        conn.sendall(b''.join(out))
+    rate.report(lag, force=True)
+    rate.summary()
+
+
+class ControlServer(threading.Thread):
+    '''
+    Accepts caer configuration commands (see interfaces.caer.Controller),
+    keeps the values that are put and returns them on get.
+    '''
+    _cmd = struct.Struct('<BBHHHH')
+    _resp = struct.Struct('<BBH')
+
+    def __init__(self, host=HOST, port=PORT_CTL):
+        super(ControlServer, self).__init__()
+        self.daemon = True
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(4)
+        self.values = {}
+        self.commands = 0
+        self.start()
+
+    def run(self):
+        while True:
+            conn, _ = self.sock.accept()
+            t = threading.Thread(target=self._handle, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _recv(self, conn, n):
+        data = conn.recv(n, socket.MSG_WAITALL) if n else b''
+        if len(data) < n:
+            raise EOFError
+        return data
+
+    def _handle(self, conn):
+        try:
+            while True:
+                action, vtype, _, n_node, n_key, n_val = self._cmd.unpack(
+                    self._recv(conn, self._cmd.size))
+                node = self._recv(conn, n_node).rstrip(b'\x00')
+                key = self._recv(conn, n_key).rstrip(b'\x00')
+                val = self._recv(conn, n_val).rstrip(b'\x00')
+                self.commands += 1
+                if action == 3:  # put
+                    self.values[(node, key)] = val
+                    msg = b''
+                else:
+                    msg = self.values.get((node, key), b'')
+                msg += b'\x00'
+                conn.sendall(self._resp.pack(action, vtype, len(msg)) + msg)
+        except (EOFError, socket.error):
+            conn.close()
+
+
+def main(args):
+    speed = parse_speed(args.speed)
+    ctl = ControlServer(args.host, args.port_ctl)
+    srv = socket.socket()
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind((args.host, args.port))
+    srv.listen(1)
+    print('serving %s on %s:%d (control port %d), speed %s' % (
+        args.filename, args.host, args.port, args.port_ctl, args.speed))
+    while True:
+        conn, addr = srv.accept()
+        print('client connected:', addr)
+        try:
+            serve_stream(conn, args.filename, speed, args.loop)
+        except socket.error as e:
+            print('client disconnected (%s)' % e)
+        finally:
+            conn.close()
+        print('%d control commands received' % ctl.commands)
+        if args.once:
+            break
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', help='recording (.hdf5 or manifest)')
+    parser.add_argument('--speed', default='realtime',
+                        help='realtime, Nx (e.g. 4x) or max')
+    parser.add_argument('--loop', action='store_true',
+                        help='start over at the end of the recording')
+    parser.add_argument('--once', action='store_true',
+                        help='exit after the first client')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--port_ctl', type=int, default=PORT_CTL)
+    main(parser.parse_args())
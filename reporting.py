@@ -1,5 +1,20 @@
+'''
+Recording health metrics.
 
-import os, sys, time
+Stats collects per-source rates, buffer high-water marks, dropped
+packets, write latency and bytes on disk once per interval. Snapshots go
+to any number of sinks (rotating JSON-lines file, Prometheus textfile)
+and to an optional one-line terminal dashboard.
+
+This software is released under the
+GNU LESSER GENERAL PUBLIC LICENSE Version 3.
+'''
+
+from __future__ import print_function
+import os, time
+import glob
+import json
+import segments
 
 
 txt_norm = '\033[0;37m'
@@ -8,45 +23,208 @@ txt_grn = '\033[0;32m'
 txt_red = '\033[1;31m'
 
 
+def recording_files(filename):
+    ''' recording file or segments, manifest, journal and spill files '''
+    base = glob.escape(segments.base_name(filename))
+    files = set(glob.glob(glob.escape(filename) + '*'))
+    files.update(glob.glob(base + '.[0-9][0-9][0-9].hdf5*'))
+    files.update(glob.glob(base + segments.MANIFEST_EXT))
+    return sorted(files)
+
+
+def bytes_on_disk(filename):
+    n = 0
+    for f in recording_files(filename):
+        try:
+            n += os.path.getsize(f)
+        except OSError:
+            # rotated or removed in the meantime
+            pass
+    return n
+
+
+def _fmt_bytes(n):
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if n < 1024 or unit == 'GB':
+            return '%.1f %s' % (n, unit)
+        n /= 1024.
+
+
+class JSONLinesSink(object):
+    '''
+    Appends one json object per snapshot,
+    rotates to fname.1 .. fname.<backups> when max_bytes is exceeded.
+    '''
+    def __init__(self, fname, max_bytes=16 << 20, backups=3):
+        self.fname = fname
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.f = open(fname, 'a')
+
+    def _rotate(self):
+        self.f.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.fname, i)):
+                os.rename('%s.%d' % (self.fname, i), '%s.%d' % (self.fname, i + 1))
+        if self.backups:
+            os.rename(self.fname, self.fname + '.1')
+        self.f = open(self.fname, 'w')
+
+    def write(self, snapshot):
+        if self.f.tell() > self.max_bytes:
+            self._rotate()
+        self.f.write(json.dumps(snapshot, sort_keys=True) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class PrometheusSink(object):
+    '''
+    Writes the latest snapshot in Prometheus text format,
+    for the node_exporter textfile collector.
+    '''
+    prefix = 'ddd20_recording_'
+
+    def __init__(self, fname):
+        self.fname = fname
+
+    def _lines(self, snapshot):
+        p = self.prefix
+        yield '%selapsed_seconds %f' % (p, snapshot['elapsed'])
+        yield '%sbytes_on_disk %d' % (p, snapshot['bytes_on_disk'])
+        for src, rates in snapshot['rates'].items():
+            for k, v in rates.items():
+                yield '%srate{source="%s",type="%s"} %f' % (p, src, k, v)
+        for k, b in snapshot['buffers'].items():
+            yield '%sbuffer_high_water{buffer="%s"} %d' % (p, k, b['high_water'])
+            yield '%sbuffer_size{buffer="%s"} %d' % (p, k, b['maxsize'])
+            yield '%sbuffer_alive{buffer="%s"} %d' % (p, k, b['alive'])
+            yield '%sdropped_total{buffer="%s"} %d' % (p, k, b['dropped'])
+        for k, v in snapshot['writer'].items():
+            yield '%swriter_%s %f' % (p, k, v)
+
+    def write(self, snapshot):
+        tmp = self.fname + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(self._lines(snapshot)) + '\n')
+        os.rename(tmp, self.fname)
+
+    def close(self):
+        pass
+
+
 class Stats(object):
-    def __init__(self, filename, counters, buffers, cls=True):
+    '''
+    Recording metrics.
+    * counters -- dicts of counts by type, per source, reset at every report
+    * buffers -- modules with a queue (q), optionally `dropped` and `metrics()`
+    * sinks -- objects with write(snapshot) and close()
+    * dashboard -- print a compact status line per report
+    '''
+    def __init__(self, filename, counters, buffers, sinks=(), dashboard=True, interval=1.):
         self.buffers = buffers
         self.counters = counters
         self.filename = filename
+        self.sinks = list(sinks)
+        self.dashboard = dashboard
+        self.interval = interval
         self.max_qsize = {k: 0 for k in self.buffers}
-        self.cls = cls
+        self.failed = []
         self.t0 = time.time()
         self.t_pre = time.time()
+        self.pre_writer = {}
 
-    def report(self):
-        ''' print some stats '''
-        for k,o in self.buffers.iteritems():
+    def track(self):
+        ''' keep track of buffer high-water marks '''
+        for k, o in self.buffers.items():
             self.max_qsize[k] = max(self.max_qsize[k], o.q.qsize())
-        if time.time() - self.t_pre < 1:
-            return
-        self.t_pre = time.time()
-        if self.cls:
-            os.system('clear')
-        # print counter stats
-        for name, counter in self.counters.iteritems():
-            print txt_bold, '\nrecording', name, 'events:', txt_norm
+
+    def _writer_stats(self, metrics):
+        ''' write latency and backlog of a datasets.HDF5, over the last interval '''
+        cols = metrics['columns'].values()
+        tot = {k: sum(c[k] for c in cols) for k in ('rows', 'chunks', 'write_time', 'latency')}
+        pre = self.pre_writer or dict.fromkeys(tot, 0)
+        self.pre_writer = tot
+        d = {k: tot[k] - pre[k] for k in tot}
+        return {
+            'rows': tot['rows'],
+            'mean_latency': d['latency'] / max(d['rows'], 1),
+            'max_latency': max([c['max_latency'] for c in cols] or [0]),
+            'mean_write_time': d['write_time'] / max(d['chunks'], 1),
+            'max_write_time': max([c['max_write_time'] for c in cols] or [0]),
+            'backlog': metrics['backlog'],
+            'spilled': metrics['spilled'],
+            'spill_backlog': metrics['spill_backlog'],
+            'dropped': metrics['dropped'],
+            }
+
+    def collect(self, dt):
+        ''' snapshot of all metrics, resets counters and high-water marks '''
+        snapshot = {
+            'time': time.time(),
+            'elapsed': time.time() - self.t0,
+            'file': self.filename,
+            'rates': {},
+            'buffers': {},
+            'writer': {},
+            'bytes_on_disk': bytes_on_disk(self.filename),
+            }
+        for name, counter in self.counters.items():
+            snapshot['rates'][name] = {k: counter[k] / max(dt, 1e-9) for k in counter}
             for k in counter:
-                c = txt_red if counter[k] == 0 else txt_norm
-                print '%s  %s: %s Hz%s' % (c, k, counter[k], txt_norm)
                 counter[k] = 0
-        # print buffer stats
-        print txt_bold, '\nbuffer status:', txt_norm
-        for k,o in self.buffers.iteritems():
-            p = 100. * self.max_qsize[k] / o.q._maxsize
-            p60 = int(0.6 * p)
-            out = '  %s: %d/%d ' % (k, self.max_qsize[k], o.q._maxsize)
-            out = out.ljust(p60, '|').ljust(60, '.') + ' %0.2f %%' % p
-            out = txt_red + out[:p60] + txt_grn + out[p60:] + txt_norm
+        for k, o in self.buffers.items():
+            dropped = getattr(o, 'dropped', None)
+            snapshot['buffers'][k] = {
+                'high_water': self.max_qsize[k],
+                'maxsize': o.q._maxsize,
+                'alive': o.is_alive(),
+                'dropped': dropped.value if dropped is not None else 0,
+                }
             self.max_qsize[k] = 0
-            print out
-            if not o.is_alive():
-                print txt_red + \
-                        '\n  Problem encountered in %s module. Exiting.\n' % k \
-                        + txt_norm
-                sys.exit()
-        print '\n\nrecording into %s (%d s)\n' % (self.filename, time.time() - self.t0)
+            if hasattr(o, 'metrics'):
+                snapshot['writer'] = self._writer_stats(o.metrics())
+        return snapshot
+
+    def report(self, force=False):
+        ''' collect metrics once per interval, returns the snapshot or None '''
+        self.track()
+        dt = time.time() - self.t_pre
+        if dt < self.interval and not force:
+            return None
+        self.t_pre = time.time()
+        snapshot = self.collect(dt)
+        for sink in self.sinks:
+            sink.write(snapshot)
+        for k, b in snapshot['buffers'].items():
+            if not b['alive'] and k not in self.failed:
+                self.failed.append(k)
+                print(txt_red + '\nProblem encountered in %s module.' % k + txt_norm)
+        if self.dashboard:
+            print(self.status_line(snapshot))
+        return snapshot
+
+    def status_line(self, snapshot):
+        ''' compact one line summary '''
+        out = ['%s%5ds%s' % (txt_bold, snapshot['elapsed'], txt_norm)]
+        for name, rates in sorted(snapshot['rates'].items()):
+            quiet = [k for k, v in rates.items() if v == 0]
+            c = txt_red if len(quiet) == len(rates) else txt_norm
+            out.append('%s%s %.0f/s%s' % (c, name, sum(rates.values()), txt_norm))
+        for k, b in sorted(snapshot['buffers'].items()):
+            p = 100. * b['high_water'] / max(b['maxsize'], 1)
+            c = txt_red if p > 50 or b['dropped'] or not b['alive'] else txt_grn
+            out.append('%s%s %.0f%%%s' % (c, k, p, txt_norm))
+        w = snapshot['writer']
+        if w:
+            out.append('lat %.1f ms' % (w['mean_latency'] * 1e3))
+            if w['spilled'] or w['dropped']:
+                out.append(txt_red + 'spill %d drop %d' % (w['spilled'], w['dropped']) + txt_norm)
+        out.append(_fmt_bytes(snapshot['bytes_on_disk']))
+        return ' | '.join(out)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
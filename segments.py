@@ -0,0 +1,168 @@
+'''
+Segmented recordings.
+
+datasets.HDF5 can roll over to a new file after a given size or
+duration. The segments are listed, together with their time ranges, in
+a small json manifest. A segment is listed as soon as it is opened and
+marked complete when it is closed; segments left incomplete by a crash
+are rebuilt with recover.py. open_recording() returns an object that reads
+a manifest like a single h5py.File, so reader tools don't need to care.
+
+This software is released under the
+GNU LESSER GENERAL PUBLIC LICENSE Version 3.
+'''
+
+from __future__ import print_function
+import os
+import json
+import numpy as np
+import h5py
+
+MANIFEST_EXT = '.manifest.json'
+
+
+def is_manifest(fname):
+    return fname.endswith(MANIFEST_EXT)
+
+
+def base_name(fname):
+    ''' strip .hdf5 or manifest extension '''
+    if is_manifest(fname):
+        return fname[:-len(MANIFEST_EXT)]
+    return os.path.splitext(fname)[0]
+
+
+def manifest_name(fname):
+    return base_name(fname) + MANIFEST_EXT
+
+
+def segment_name(fname, i):
+    return '%s.%03d.hdf5' % (base_name(fname), i)
+
+
+def read_manifest(fname):
+    with open(fname) as f:
+        manifest = json.load(f)
+    path = os.path.dirname(os.path.abspath(fname))
+    for seg in manifest['segments']:
+        seg['path'] = os.path.join(path, seg['file'])
+    return manifest
+
+
+def complete_segments(manifest):
+    ''' segments that were closed properly (manifests before 'complete' only list those) '''
+    segs = [seg for seg in manifest['segments'] if seg.get('complete', True)]
+    if len(segs) < len(manifest['segments']):
+        print('skipping %d incomplete segments, rebuild them with recover.py' % (
+            len(manifest['segments']) - len(segs)))
+    return segs
+
+
+def write_manifest(fname, segments, **info):
+    ''' write manifest atomically, so readers never see half a file '''
+    manifest = dict(info, version=1, segments=[
+        dict([(k, v) for k, v in seg.items() if k != 'path'], file=os.path.basename(seg['file']))
+        for seg in segments])
+    tmp = fname + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.rename(tmp, fname)
+
+
+def segment_files(fname):
+    ''' list of hdf5 files making up a recording '''
+    if not is_manifest(fname):
+        return [fname]
+    return [seg['path'] for seg in complete_segments(read_manifest(fname))]
+
+
+def open_recording(fname, mode='r'):
+    ''' open a recording file or a segment manifest (read only) '''
+    if is_manifest(fname):
+        return SegmentedRecording(fname)
+    return h5py.File(fname, mode)
+
+
+class ConcatDataset(object):
+    ''' read only view of datasets concatenated along the first axis '''
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.lens = np.array([len(d) for d in datasets], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.lens)])
+        self.dtype = datasets[0].dtype
+        self.shape = (int(self.offsets[-1]),) + datasets[0].shape[1:]
+        self.attrs = datasets[-1].attrs
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+        if isinstance(key, (int, np.integer)):
+            i = key + len(self) if key < 0 else key
+            if not 0 <= i < len(self):
+                raise IndexError('index %d out of range' % key)
+            s = np.searchsorted(self.offsets, i, side='right') - 1
+            return self.datasets[s][(int(i - self.offsets[s]),) + rest]
+        if isinstance(key, slice) and key.step in (None, 1):
+            start, stop, _ = key.indices(len(self))
+            parts = []
+            for s, d in enumerate(self.datasets):
+                a = max(start - self.offsets[s], 0)
+                b = min(stop - self.offsets[s], self.lens[s])
+                if b > a:
+                    parts.append(d[(slice(int(a), int(b)),) + rest])
+            if not parts:
+                return self.datasets[0][(slice(0, 0),) + rest]
+            return np.concatenate(parts)
+        # fancy indexing, read everything
+        return self[(slice(None),) + rest][key]
+
+
+class SegmentedGroup(object):
+    def __init__(self, groups):
+        self.groups = groups
+
+    def __getitem__(self, key):
+        items = [g[key] for g in self.groups]
+        if isinstance(items[0], h5py.Dataset):
+            return ConcatDataset(items)
+        return SegmentedGroup(items)
+
+    def __contains__(self, key):
+        return key in self.groups[0]
+
+    def keys(self):
+        return self.groups[0].keys()
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    @property
+    def attrs(self):
+        return self.groups[0].attrs
+
+
+class SegmentedRecording(SegmentedGroup):
+    ''' behaves like a read only h5py.File for a segment manifest '''
+    def __init__(self, fname):
+        self.filename = fname
+        self.manifest = read_manifest(fname)
+        self.files = [h5py.File(seg['path'], 'r')
+                      for seg in complete_segments(self.manifest)]
+        super(SegmentedRecording, self).__init__(self.files)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,124 @@
+'''
+recover.py on recordings where some chunks failed to write:
+the rows of the failed chunks must come back at their place, once.
+And on a segmented recording killed in the middle of a segment.
+'''
+
+import os
+import time
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip('h5py')
+from datasets import HDF5
+from journal import ioerrors_name
+from recover import recover, recover_segments
+from valid_length import valid_length
+import segments
+
+TABLES = {'timestamp': 'int64', 'data': ('float32', (3,))}
+N_ROWS = 50
+CHUNK = 4
+# calls of _write that fail, by column
+FAIL = {'timestamp': (1, 5), 'data': (3,)}
+
+
+class FailingHDF5(HDF5):
+    ''' raises IOError on some writes, before anything reaches the file '''
+    def _write(self, col, rows):
+        self.n_writes = getattr(self, 'n_writes', {})
+        n = self.n_writes[col] = self.n_writes.get(col, 0) + 1
+        if n in FAIL[col]:
+            raise IOError('injected')
+        super(FailingHDF5, self)._write(col, rows)
+
+
+def record(fname, journal):
+    f = FailingHDF5(fname, TABLES, chunksize=CHUNK, journal=journal, overflow='block', timeout=None)
+    for i in range(N_ROWS):
+        f.save({'timestamp': i + 1, 'data': np.full(3, i, 'float32')})
+    f.exit.set()
+    f.join()
+
+
+def read(fname):
+    with h5py.File(fname, 'r') as f:
+        ts, data = f['timestamp'], f['data']
+        return ts[:valid_length(ts)], data[:valid_length(data)]
+
+
+def check(ts, data):
+    np.testing.assert_array_equal(ts, np.arange(1, N_ROWS + 1))
+    np.testing.assert_array_equal(data, np.repeat(np.arange(N_ROWS, dtype='float32')[:, None], 3, 1))
+
+
+def test_journal(tmp_path):
+    fname, journal = str(tmp_path / 'rec.hdf5'), str(tmp_path / 'rec.hdf5.journal')
+    record(fname, journal)
+    assert os.path.exists(journal) and os.path.exists(ioerrors_name(fname))
+    ts, data = read(fname)
+    assert len(ts) == N_ROWS - CHUNK * len(FAIL['timestamp'])
+    check(*read(recover(journal, fname)))
+
+
+def test_ioerrors_journal(tmp_path):
+    fname = str(tmp_path / 'rec.hdf5')
+    record(fname, None)
+    check(*read(recover(ioerrors_name(fname), fname, ioerrors=True)))
+
+
+def test_segments(tmp_path):
+    fname = str(tmp_path / 'rec.hdf5')
+    manifest = segments.manifest_name(fname)
+    f = HDF5(fname, TABLES, chunksize=CHUNK, journal=fname + '.journal',
+             segment_duration=1, overflow='block', timeout=None)
+    n, t_rolled = 0, None
+    while t_rolled is None or time.time() - t_rolled < 0.3:
+        n += 1
+        f.save({'timestamp': n, 'data': np.full(3, n - 1, 'float32')})
+        time.sleep(0.01)
+        if t_rolled is None and os.path.exists(manifest) and \
+                len(segments.read_manifest(manifest)['segments']) > 1:
+            t_rolled = time.time()
+    # the journal is synced when a row comes after a pause
+    time.sleep(0.6)
+    n += 1
+    f.save({'timestamp': n, 'data': np.full(3, n - 1, 'float32')})
+    time.sleep(0.5)
+    f.kill()
+    f.join()
+
+    segs = segments.read_manifest(manifest)['segments']
+    assert [seg['complete'] for seg in segs] == [True, False]
+    assert not os.path.exists(segs[0]['path'] + '.journal')
+    recover_segments(manifest)
+    segs = segments.read_manifest(manifest)['segments']
+    assert all(seg['complete'] for seg in segs)
+    assert segs[1]['file'].endswith('.recovered.hdf5')
+    assert segs[1]['t_start'] == segs[0]['t_stop'] + 1 and segs[1]['t_stop'] == n
+    with segments.open_recording(manifest) as rec:
+        np.testing.assert_array_equal(rec['timestamp'][:], np.arange(1, n + 1))
+        assert len(rec['data']) == n
+
+
+class BrokenHDF5(HDF5):
+    ''' fails on the second write with something else than an IOError '''
+    def _write(self, col, rows):
+        self.n_writes = getattr(self, 'n_writes', 0) + 1
+        if self.n_writes == 2:
+            raise ValueError('injected')
+        super(BrokenHDF5, self)._write(col, rows)
+
+
+def test_writer_error(tmp_path):
+    fname, journal = str(tmp_path / 'rec.hdf5'), str(tmp_path / 'rec.hdf5.journal')
+    f = BrokenHDF5(fname, TABLES, chunksize=CHUNK, journal=journal, overflow='block', timeout=None)
+    for i in range(N_ROWS):
+        f.save({'timestamp': i + 1, 'data': np.full(3, i, 'float32')})
+    f.join(30)
+    assert not f.is_alive() and f.exitcode != 0
+    # the journal holds every row the writer process took before it stopped
+    ts, data = read(recover(journal, fname, str(tmp_path / 'out.hdf5')))
+    assert len(ts) >= 2 * CHUNK
+    np.testing.assert_array_equal(ts, np.arange(1, len(ts) + 1))
+    np.testing.assert_array_equal(data[:, 0], np.arange(len(ts)))
@@ -0,0 +1,62 @@
+'''
+resize_batch against the per-frame skimage path it replaced
+(resize_int8 / resize_int16), for every key resize_data_into_new_key handles.
+'''
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+pytest.importorskip('skimage')
+u = pytest.importorskip('hdf5_deeplearn_utils')
+
+SHAPE = (260, 346)
+SIZE = (80, 80)
+CLIMIT = [-15, 15]
+# APS: area averaging vs skimage's Gaussian prefilter, in grey levels,
+# for camera-like frames (structure of ~20 px and up)
+APS_MAX_DIFF = 4
+APS_MEAN_DIFF = 0.5
+# DVS: identical
+DVS_MAX_DIFF = 0
+
+
+def smooth_frames(rng, n, cells=13):
+    ''' uint8 frames with smooth structure, upsampled from a coarse grid '''
+    coarse = rng.randint(0, 256, (n, cells, int(cells * SHAPE[1] / SHAPE[0])))
+    frames = [cv2.resize(c.astype('float32'), (SHAPE[1], SHAPE[0]), interpolation=cv2.INTER_CUBIC)
+              for c in coarse]
+    return np.clip(frames, 0, 255).astype('uint8')
+
+
+def event_counts(rng, shape):
+    ''' int16 signed event counts, partly outside the clip limits '''
+    return rng.randint(-20, 21, shape).astype('int16')
+
+
+def diff(a, b):
+    d = np.abs(a.astype('int16') - b.astype('int16'))
+    return d.max(), d.mean()
+
+
+def test_aps_frame():
+    frames = smooth_frames(np.random.RandomState(0), 6)
+    ref = np.array([u.resize_int8(frame, SIZE) for frame in frames])
+    out = u.resize_batch(frames, SIZE)
+    assert out.shape == ref.shape and out.dtype == np.uint8
+    max_diff, mean_diff = diff(out, ref)
+    assert max_diff <= APS_MAX_DIFF
+    assert mean_diff <= APS_MEAN_DIFF
+
+
+@pytest.mark.parametrize('shape, kwargs', [
+    ((4,) + SHAPE, {}),
+    ((3, 2) + SHAPE, {'seperate_dvs_channels': True}),
+    ((2, 10, 2) + SHAPE, {'split_timesteps': True, 'timesteps': 10}),
+], ids=['dvs_accum', 'seperate_dvs_channels', 'split_timesteps'])
+def test_dvs(shape, kwargs):
+    frames = event_counts(np.random.RandomState(1), shape)
+    ref = np.array([u.resize_int16(frame, SIZE, climit=CLIMIT, **kwargs) for frame in frames])
+    out = u.resize_batch(frames, SIZE, climit=CLIMIT)
+    assert out.shape == ref.shape and out.dtype == np.uint8
+    assert diff(out, ref)[0] <= DVS_MAX_DIFF
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+'''
+Stores the `valid_length` attribute in existing files.
+
+datasets.HDF5 writes the number of valid rows as `valid_length` attribute
+of each dataset when it closes a file, so readers don't have to scan the
+timestamps for the zero padding. This adds the attribute to files written
+before that: in every group with a `timestamp` dataset (the root group of
+exported files, dvs and VI groups of recordings), the timestamps are
+scanned once and all datasets with one row per timestamp get the result.
+
+valid_length() is what readers use to find the number of valid rows.
+
+This software is released under the
+GNU LESSER GENERAL PUBLIC LICENSE Version 3.
+
+Usage:
+ $ ./valid_length.py <file.hdf5> [<file.hdf5> ...] [--workers N] [--force]
+'''
+
+from __future__ import print_function
+import argparse
+import multiprocessing as mp
+import numpy as np
+import h5py
+
+
+# rows read at once when scanning back from the end
+SCAN_ROWS = 4096
+
+
+def _nonempty(rows):
+    ''' rows that aren't zero padding (empty, for variable length data) '''
+    if rows.dtype == object:
+        return np.array([any(len(v) for v in np.atleast_1d(r)) for r in rows], dtype=bool)
+    return np.any(np.reshape(rows, (len(rows), -1)) != 0, axis=1)
+
+
+def scan_valid_length(ds):
+    ''' number of rows before the zero padding of a dataset, scanning back from the end '''
+    n = len(ds)
+    while n > 0:
+        a = max(n - SCAN_ROWS, 0)
+        nz = np.flatnonzero(_nonempty(ds[a:n]))
+        if len(nz):
+            return a + int(nz[-1]) + 1
+        n = a
+    return 0
+
+
+def valid_length(ds):
+    '''
+    number of rows before the zero padding of a dataset (or a
+    segments.ConcatDataset), from the `valid_length` attribute(s)
+    if the writer stored them
+    '''
+    parts = getattr(ds, 'datasets', [ds])
+    if all('valid_length' in getattr(d, 'attrs', {}) for d in parts):
+        return sum(int(d.attrs['valid_length']) for d in parts)
+    return scan_valid_length(ds)
+
+
+def timestamp_groups(f):
+    ''' the file and its groups that have a timestamp dataset '''
+    groups = [f] + [g for g in f.values() if isinstance(g, h5py.Group)]
+    return [g for g in groups if isinstance(g.get('timestamp'), h5py.Dataset)]
+
+
+def backfill(fname, force=False):
+    ''' add valid_length attributes to a file, returns {group: length} '''
+    out = {}
+    with h5py.File(fname, 'a') as f:
+        for g in timestamp_groups(f):
+            ts = g['timestamp']
+            if 'valid_length' in ts.attrs and not force:
+                n = int(ts.attrs['valid_length'])
+            else:
+                n = scan_valid_length(ts)
+            for ds in g.values():
+                if isinstance(ds, h5py.Dataset) and ds.shape and len(ds) == len(ts):
+                    ds.attrs['valid_length'] = n
+            out[g.name] = n
+    return out
+
+
+def _backfill(job):
+    fname, force = job
+    try:
+        return fname, backfill(fname, force), None
+    except (IOError, OSError, KeyError) as e:
+        return fname, None, e
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filenames', nargs='+')
+    parser.add_argument('--workers', type=int, default=None, help='default: one per core')
+    parser.add_argument('--force', action='store_true', help='rescan files that have the attribute')
+    args = parser.parse_args()
+    pool = mp.Pool(min(args.workers or mp.cpu_count(), len(args.filenames)))
+    try:
+        jobs = [(fname, args.force) for fname in args.filenames]
+        for fname, lengths, err in pool.imap_unordered(_backfill, jobs):
+            if err is not None:
+                print('%s: failed (%s)' % (fname, err))
+            else:
+                print('%s: %s' % (fname, ', '.join(
+                    '%s %d' % (k, n) for k, n in sorted(lengths.items()))))
+    finally:
+        pool.close()
+        pool.join()
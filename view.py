@@ -16,6 +16,9 @@ Usage:
 
  Play a file starting at second X
  $ ./view.py <recorded_file.hdf5> -s Xs
+
+ Play a segmented recording
+ $ ./view.py <recording.manifest.json>
 '''
 
 from __future__ import print_function
@@ -31,6 +34,8 @@ import queue
 from queue import Empty
 from interfaces.caer import DVS_SHAPE, unpack_header, unpack_data
 from datasets import CHUNK_SIZE
+from segments import open_recording
+from index import open_index, Timeline, SeekIndex
 
 
 VIEW_DATA = {
@@ -43,10 +48,39 @@ VIEW_DATA = {
         }
 
 
+# seconds of DVS events shown before the frame we land on when seeking
+SEEK_PREROLL = 0.05
+# rows of each table read first after a search
+SEEK_ROWS = 16
+# seconds behind schedule after which playback jumps ahead instead of skipping packets
+JUMP_LAG = 1.
+
 # this changed in version 3
 CV_AA = cv2.LINE_AA if int(cv2.__version__[0]) > 2 else cv2.CV_AA
 
 
+def draw_steering_wheel(img, a, color, rotate180=False, c=(173, 130), r=65,
+                        font=cv2.FONT_HERSHEY_SIMPLEX, label=True):
+    '''
+    Draw a steering wheel at angle a (deg) into img,
+    c, r -- center and radius
+    '''
+    a_rad = + a / 180. * np.pi + np.pi / 2
+    if rotate180:
+        a_rad = np.pi-a_rad
+    t = (c[0] + int(np.cos(a_rad) * r), c[1] - int(np.sin(a_rad) * r))
+    cv2.line(img, c, t, color, 2, CV_AA)
+    cv2.circle(img, c, r, color, 1, CV_AA)
+    cv2.line(img, (c[0]-r+5, c[1]), (c[0]-r, c[1]), color, 1, CV_AA)
+    cv2.line(img, (c[0]+r-5, c[1]), (c[0]+r, c[1]), color, 1, CV_AA)
+    cv2.line(img, (c[0], c[1]-r+5), (c[0], c[1]-r), color, 1, CV_AA)
+    cv2.line(img, (c[0], c[1]+r-5), (c[0], c[1]+r), color, 1, CV_AA)
+    if label:
+        cv2.putText(
+            img, '%0.1f deg' % a,
+            (c[0]-35, c[1]+30), font, 0.4, color, 1, CV_AA)
+
+
 def _flush_q(q):
     ''' flush queue '''
     while True:
@@ -57,11 +91,31 @@ def _flush_q(q):
                 break
 
 
+def _pad_block(block):
+    '''
+    append an empty row (zero timestamp),
+    which the merger treats as end of data
+    '''
+    pad = np.zeros((1,) + block.shape[1:], dtype=block.dtype)
+    if block.dtype == object:
+        for i in np.ndindex(pad.shape):
+            pad[i] = np.zeros(0, dtype=np.uint8)
+    return np.concatenate([block, pad])
+
+
 class HDF5Stream(mp.Process):
-    def __init__(self, filename, tables, bufsize=64):
+    '''
+    Reads blocks of rows from the recording, one queue per table.
+    Seeking uses the row timestamps of the index.
+    * preroll -- seconds of DVS data to include before the frame we seek to
+    '''
+    def __init__(self, filename, tables, bufsize=8, preroll=0):
         super(HDF5Stream, self).__init__()
-        self.f = h5py.File(filename, 'r')
-        self.tables = tables
+        self.f = open_recording(filename)
+        idx = open_index(filename)
+        self.seek = SeekIndex(idx, int(preroll * 1e6))
+        idx.close()
+        self.tables = [k for k in tables if k in self.f]
         self.q = {k: mp.Queue(bufsize) for k in self.tables}
         self.run_search = mp.Event()
         self.exit = mp.Event()
@@ -73,28 +127,30 @@ class HDF5Stream(mp.Process):
         self.start()
 
     def run(self):
-        while self.blocks_rem and not self.exit.is_set():
+        self.epoch = 0
+        while not self.exit.is_set():
+            if self.run_search.is_set():
+                self._search()
             blocks_read = 0
-            for k in list(self.blocks_rem):
+            for k in list(self.active):
                 if self.q[k].full():
-                    time.sleep(1e-6)
                     continue
-                i = self.block_offset[k]
-                self.q[k].put(self.f[k]['data'][int(i*CHUNK_SIZE):int((i+1)*CHUNK_SIZE)])
-                self.block_offset[k] += 1
-                if self.blocks_rem[k].value:
-                    self.blocks_rem[k].value -= 1
-                else:
-                    self.blocks_rem.pop(k)
+                i, n = self.row_offset[k], self.next_rows[k]
+                stop = self.seek.length(k)
+                blk = self.f[k]['data'][i:min(i+n, stop)]
+                if i + n >= stop:
+                    # end the table with empty rows
+                    blk = _pad_block(blk)
+                    self.active.remove(k)
+                self.q[k].put((self.epoch, blk))
+                self.row_offset[k] = i + n
+                self.next_rows[k] = CHUNK_SIZE
                 blocks_read += 1
             if not blocks_read:
-                time.sleep(1e-6)
-            if self.run_search.is_set():
-                self._search()
+                # all read or queues full, wait for the merger or a search
+                time.sleep(1e-4)
         self.f.close()
         print('closed input file')
-        while not self.exit.is_set():
-            time.sleep(1e-3)
         # print('[DEBUG] flushing stream queues')
         for k in self.q:
             # print('[DEBUG] flushing', k)
@@ -105,33 +161,26 @@ class HDF5Stream(mp.Process):
         self.done.set()
         print('stream done')
 
-    def get(self, k, block=True, timeout=None):
-        return self.q[k].get(block, timeout)
+    def get(self, k, block=True, timeout=None, epoch=0):
+        ''' next block of table k, skipping blocks read before the last search '''
+        while True:
+            e, blk = self.q[k].get(block, timeout)
+            if e == epoch:
+                return blk
 
     def _init_count(self, offset={}):
-        self.block_offset = {k: offset.get(k, 0) / CHUNK_SIZE
-                             for k in self.tables}
-        self.size = {k: len(self.f[k]['data']) - v * CHUNK_SIZE
-                     for k, v in self.block_offset.items()}
-        self.blocks = {k: v / CHUNK_SIZE for k, v in self.size.items()}
-        self.blocks_rem = {
-            k: mp.Value(ctypes.c_double, v) for k, v in self.blocks.items() if v}
+        self.row_offset = {k: offset.get(k, 0) for k in self.tables}
+        # short first blocks, so data arrives quickly after a search
+        self.next_rows = {k: SEEK_ROWS for k in self.tables}
+        self.active = set(self.tables)
 
     def _init_time(self):
         self.ts_start = {}
         self.ts_stop = {}
-        self.ind_stop = {}
         for k in self.tables:
-            ts_start = self.f[k]['timestamp'][self.block_offset[k]*CHUNK_SIZE]
-            self.ts_start[k] = mp.Value('L', ts_start)
-            b = self.block_offset[k] + self.blocks_rem[k].value - 1
-            while b > self.block_offset[k] and \
-                    self.f[k]['timestamp'][b*CHUNK_SIZE] == 0:
-                b -= 1
-            print(k, 'final block:', b)
-            self.ts_stop[k] = mp.Value(
-                'L', self.f[k]['timestamp'][(b + 1) * CHUNK_SIZE - 1])
-            self.ind_stop[k] = b
+            ts = self.seek.ts.get(k, [])
+            self.ts_start[k] = mp.Value('L', int(ts[0]) if len(ts) else 0)
+            self.ts_stop[k] = mp.Value('L', int(ts[-1]) if len(ts) else 0)
 
     def init_search(self, t):
         ''' start streaming from given time point '''
@@ -142,26 +191,11 @@ class HDF5Stream(mp.Process):
 
     def _search(self):
         t = self.skip_to.value
-        offset = {k: self._bsearch_by_timestamp(k, t) for k in self.tables}
-        for k in self.tables:
-            _flush_q(self.q[k])
-        self._init_count(offset)
-        # self._init_time()
+        self._init_count({k: self.seek.row(k, t) for k in self.tables})
+        # the merger drops blocks of the previous epoch
+        self.epoch += 1
         self.run_search.clear()
 
-    def _bsearch_by_timestamp(self, k, t):
-        '''performs binary search on timestamp, returns closest block index'''
-        l, r = 0, self.ind_stop[k]
-        print('searching', k, t)
-        while True:
-            if r - l < 2:
-                print('selecting block', l)
-                return l * CHUNK_SIZE
-            if self.f[k]['timestamp'][(l + (r - l) / 2) * CHUNK_SIZE] > t:
-                r = l + (r - l) / 2
-            else:
-                l += (r - l) / 2
-
 
 class MergedStream(mp.Process):
     ''' Unpacks and merges data from HDF5 stream '''
@@ -173,6 +207,7 @@ class MergedStream(mp.Process):
         self.q = mp.Queue(bufsize)
         self.run_search = mp.Event()
         self.skip_to = mp.Value('L', 0)
+        self.epoch = 0
         self._init_state()
         self.done = mp.Event()
         self.fetched_all = mp.Event()
@@ -181,7 +216,15 @@ class MergedStream(mp.Process):
         self.start()
 
     def run(self):
-        while self.blocks_rem and not self.exit.is_set():
+        while not self.exit.is_set():
+            if self.run_search.is_set():
+                self._search()
+                continue
+            if not self.current_ts:
+                # end of recording, wait for a search or exit
+                self.fetched_all.set()
+                time.sleep(1e-3)
+                continue
             # find next event
             if self.q.full():
                 time.sleep(1e-4)
@@ -189,25 +232,16 @@ class MergedStream(mp.Process):
             next_k = min(self.current_ts, key=self.current_ts.get)
             self.q.put((self.current_ts[next_k], self.current_dat[next_k]))
             self._inc_current(next_k)
-            # get new blocks if necessary
-            for k in {k for k in self.blocks_rem if self.i[k] == CHUNK_SIZE}:
-                self.current_blk[k] = self.fbuf.get(k)
+            # get new blocks if necessary, tables end with an empty row
+            for k in {k for k in self.current_ts
+                      if self.i[k] == len(self.current_blk[k])}:
+                self.current_blk[k] = self.fbuf.get(k, epoch=self.epoch)
                 self.i[k] = 0
-                if self.blocks_rem[k]:
-                    self.blocks_rem[k] -= 1
-                else:
-                    self.blocks_rem.pop(k)
-                    self.current_ts.pop(k)
-            if self.run_search.is_set():
-                self._search()
         self.fetched_all.set()
         self.fbuf.exit.set()
         while not self.fbuf.done.is_set():
-            time.sleep(1)
+            time.sleep(1e-3)
             # print('[DEBUG] waiting for stream process')
-        while not self.exit.is_set():
-            time.sleep(1)
-            # print('[DEBUG] waiting for merger process')
         _flush_q(self.q)
         # print('[DEBUG] flushed merger q ->', self.q.qsize())
         self.q.close()
@@ -219,9 +253,8 @@ class MergedStream(mp.Process):
         self.exit.set()
 
     def _init_state(self):
-        keys = self.fbuf.blocks_rem.keys()
-        self.blocks_rem = {k: self.fbuf.blocks_rem[k].value for k in keys}
-        self.current_blk = {k: self.fbuf.get(k) for k in keys}
+        keys = self.fbuf.tables
+        self.current_blk = {k: self.fbuf.get(k, epoch=self.epoch) for k in keys}
         self.i = {k: 0 for k in keys}
         self.current_dat = {}
         self.current_ts = {}
@@ -236,15 +269,14 @@ class MergedStream(mp.Process):
         else:  # vi event
             ts = row[0] * 1e-6
             d = {'etype': k, 'timestamp': row[0], 'data': row[1]}
-        if not ts and k in self.current_ts:
-            self.current_ts.pop(k)
-            self.blocks_rem.pop(k)
+        if not ts:
+            self.current_ts.pop(k, None)
             return False
         self.current_ts[k], self.current_dat[k] = ts, d
         self.i[k] += 1
 
-    def get(self, block=False):
-        return self.q.get(block)
+    def get(self, block=False, timeout=None):
+        return self.q.get(block, timeout)
 
     @property
     def has_data(self):
@@ -266,14 +298,93 @@ class MergedStream(mp.Process):
 
     def _search(self):
         self.fbuf.init_search(self.skip_to.value)
-        while self.fbuf.run_search.is_set():
-            time.sleep(1e-6)
+        self.epoch += 1
+        self.fetched_all.clear()
         _flush_q(self.q)
+        while self.fbuf.run_search.is_set():
+            time.sleep(1e-4)
         self._init_state()
         self.q.put((0, {'etype': 'timestamp_reset'}))
         self.run_search.clear()
 
 
+class PlaybackScheduler(object):
+    '''
+    Paces playback of recording timestamps (s) at speed times real time.
+    * max_lag -- packets more than this (s) behind are skipped
+    * max_gap -- longer gaps in the recording are not waited for
+    '''
+    SPEEDS = (0.1, 0.25, 0.5, 1., 2., 4., 8., 16., 32.)
+
+    def __init__(self, speed=1., max_lag=0.1, max_gap=1.):
+        self.speed = min(max(speed, self.SPEEDS[0]), self.SPEEDS[-1])
+        self.max_lag = max_lag
+        self.max_gap = max_gap
+        self.t_last = None
+        self.skipped = 0
+        # effective speed, measured over about a second
+        self.effective = 0.
+        self.t_measure = time.time()
+        self.played = 0.
+        self.reset()
+
+    def reset(self):
+        ''' start over at the next packet, e.g. after a search '''
+        self.t_rec0 = None
+
+    def _anchor(self, t):
+        self.t_rec0, self.t_wall0 = t, time.time()
+
+    def set_speed(self, speed):
+        self.speed = min(max(speed, self.SPEEDS[0]), self.SPEEDS[-1])
+        if self.t_last is not None:
+            self._anchor(self.t_last)
+        print('playback speed x%g' % self.speed)
+
+    def faster(self):
+        self.set_speed(min([s for s in self.SPEEDS if s > self.speed] or [self.speed]))
+
+    def slower(self):
+        self.set_speed(max([s for s in self.SPEEDS if s < self.speed] or [self.speed]))
+
+    @property
+    def lag(self):
+        ''' seconds (wall clock) the last packet was behind schedule '''
+        if self.t_rec0 is None:
+            return 0.
+        return time.time() - self.t_wall0 - (self.t_last - self.t_rec0) / self.speed
+
+    def schedule(self, t):
+        '''
+        wait until recording time t is due,
+        returns False if it is too late and the packet should be skipped
+        '''
+        if self.t_rec0 is None or t < self.t_last:
+            # start, or timestamps jumped back
+            self._anchor(t)
+        else:
+            self.played += t - self.t_last
+        self.t_last = t
+        self._measure()
+        wait = -self.lag
+        if wait > self.max_gap:
+            # gap in the recording
+            self._anchor(t)
+        elif wait > 0:
+            time.sleep(wait)
+        elif -wait > self.max_lag:
+            self.skipped += 1
+            return False
+        return True
+
+    def _measure(self):
+        dt = time.time() - self.t_measure
+        if dt > 1:
+            self.effective = self.played / dt
+            self.played = 0.
+            self.t_measure = time.time()
+
+
 class Interface(object):
     def __init__(self,
                  tmin=0, tmax=0,
@@ -299,7 +410,7 @@ class Interface(object):
 
 class Viewer(Interface):
     ''' Simple visualizer for events '''
-    def __init__(self, max_fps=40, zoom=1, rotate180=False, **kwargs):
+    def __init__(self, max_fps=40, zoom=1, rotate180=False, pol_decay=0., scheduler=None, **kwargs):
         super(Viewer, self).__init__(**kwargs)
         self.zoom = zoom
         cv2.namedWindow('frame')
@@ -313,7 +424,11 @@ class Viewer(Interface):
         cv2.moveWindow('frame', ox, oy)
         cv2.moveWindow('polarity', ox + int(448*self.zoom), oy)
         self.set_fps(max_fps)
-        self.pol_img = 0.5 * np.ones(DVS_SHAPE)
+        # polarity histogram, flattened, kept at pol_decay per displayed image
+        self.pol_acc = np.zeros(DVS_SHAPE[0] * DVS_SHAPE[1])
+        # (pixel index, polarity) of the packets since, binned when displayed
+        self.pol_pending = []
+        self.pol_decay = pol_decay
         self.t_now = 0
         self.t_pre = {}
         self.count = {}
@@ -321,7 +436,8 @@ class Viewer(Interface):
         self.font = cv2.FONT_HERSHEY_SIMPLEX
         self.display_info = True
         self.display_color = 0
-        self.playback_speed = 1.  # seems to do nothing
+        # PlaybackScheduler, if playing back a recording
+        self.scheduler = scheduler
         self.rotate180 = rotate180
         # sets contrast for full scale event count for white/black
         self.dvs_contrast = 2
@@ -330,49 +446,65 @@ class Viewer(Interface):
     def set_fps(self, max_fps):
         self.min_dt = 1. / max_fps
 
-    def show(self, d, t=None):
-        # handle keyboad input
+    def _handle_keys(self):
+        ''' poll keyboard, called once per displayed image '''
         key_pressed = cv2.waitKey(1) & 0xFF  # http://www.asciitable.com/
-        if key_pressed != -1:
-            if key_pressed == ord('i'):  # 'i' pressed
-                if self.display_color == 0:
-                    self.display_color = 255
-                elif self.display_color == 255:
-                    self.display_color = 0
-                    self.display_info = not self.display_info
-                print('rotated car info display')
-            elif key_pressed == ord('x'):  # exit
-                print('exiting from x key')
-                raise SystemExit
-            elif key_pressed == ord('f'):  # f (faster) key pressed
-                self.min_dt = self.min_dt*1.2
-                print('increased min_dt to ', self.min_dt, ' s')
-                # self.playback_speed = min(self.playback_speed + 0.2, 5.0)
-                # print('increased playback speed to ',self.playback_speed)
-            elif key_pressed == ord('s'):  # s (slower) key pressed
-                self.min_dt = self.min_dt/1.2
-                print('decreased min_dt to ', self.min_dt, ' s')
-                # self.playback_speed = max(self.playback_speed - 0.2, 0.2)
-                # print('decreased playback speed to ',self.playback_speed)
-            elif key_pressed == ord('b'):  # brighter
-                self.dvs_contrast = max(1, self.dvs_contrast-1)
-                print('increased DVS contrast to ', self.dvs_contrast,
-                      ' full scale event count')
-            elif key_pressed == ord('d'):  # brighter
-                self.dvs_contrast = self.dvs_contrast+1
-                print('decreased DVS contrast to ', self.dvs_contrast,
-                      ' full scale event count')
-            elif key_pressed == ord(' '):  # toggle paused
-                self.paused = not self.paused
-                print('decreased DVS contrast to ', self.dvs_contrast,
-                      ' full scale event count')
-        if self.paused:
-            while True:
-                key_paused = cv2.waitKey(1) or 0xff
-                if key_paused == ord(' '):
-                    self.paused = False
-                    break
+        self._handle_key(key_pressed)
+        # don't spin while paused, just wait for the next key
+        while self.paused:
+            self._handle_key(cv2.waitKey(30) & 0xFF)
+
+    def _handle_key(self, key_pressed):
+        if key_pressed == 0xFF:
+            # no key pressed
+            return
+        if key_pressed == ord('i'):  # 'i' pressed
+            if self.display_color == 0:
+                self.display_color = 255
+            elif self.display_color == 255:
+                self.display_color = 0
+                self.display_info = not self.display_info
+            print('rotated car info display')
+        elif key_pressed == ord('x'):  # exit
+            print('exiting from x key')
+            raise SystemExit
+        elif key_pressed == ord('f'):  # f (faster) key pressed
+            if self.scheduler is not None:
+                self.scheduler.faster()
+            else:
+                self._change_min_dt(1.2)
+        elif key_pressed == ord('s'):  # s (slower) key pressed
+            if self.scheduler is not None:
+                self.scheduler.slower()
+            else:
+                self._change_min_dt(1 / 1.2)
+        elif key_pressed == ord('-'):  # lower display rate
+            self._change_min_dt(1.2)
+        elif key_pressed == ord('+'):  # higher display rate
+            self._change_min_dt(1 / 1.2)
+        elif key_pressed == ord('b'):  # brighter
+            self.dvs_contrast = max(1, self.dvs_contrast-1)
+            print('increased DVS contrast to ', self.dvs_contrast,
+                  ' full scale event count')
+        elif key_pressed == ord('d'):  # brighter
+            self.dvs_contrast = self.dvs_contrast+1
+            print('decreased DVS contrast to ', self.dvs_contrast,
+                  ' full scale event count')
+        elif key_pressed == ord(' '):  # toggle paused
+            self.paused = not self.paused
+            print('paused' if self.paused else 'resumed')
+
+    def _change_min_dt(self, factor):
+        self.min_dt = self.min_dt * factor
+        print('set min_dt to ', self.min_dt, ' s')
+
+    def _rotate(self, img):
+        if self.rotate180 is True:
+            # rotate the image by 180 degrees
+            return cv2.flip(img, -1)
+        return img
 
+    def show(self, d, t=None):
         ''' receive and handle single event '''
         if 'etype' not in d:
             d['etype'] = d['name']
@@ -384,16 +516,7 @@ class Viewer(Interface):
                 time.time() - self.t_pre[etype] > self.min_dt:
             if 'data' not in d:
                 unpack_data(d)
-            img = (d['data'] / 256).astype(np.uint8)
-            if self.rotate180 is True:
-                # grab the dimensions of the image and calculate the center
-                # of the image
-                (h, w) = img.shape[:2]
-                center = (w // 2, h // 2)
-
-                # rotate the image by 180 degrees
-                M = cv2.getRotationMatrix2D(center, 180, 1.0)
-                img = cv2.warpAffine(img, M, (w, h))
+            img = self._rotate((d['data'] >> 8).astype(np.uint8))
             if self.display_info:
                 self._plot_steering_wheel(img)
                 self._print(img, (50, 220), 'accelerator_pedal_position', '%')
@@ -408,37 +531,12 @@ class Viewer(Interface):
                     img, None, fx=self.zoom, fy=self.zoom,
                     interpolation=cv2.INTER_CUBIC)
             cv2.imshow('frame', img)
-            # cv2.waitKey(1)
+            self._handle_keys()
             self.t_pre[etype] = time.time()
         elif etype == 'polarity_event':
-            if 'data' not in d:
-                unpack_data(d)
-            # makes DVS image, but only from latest message
-            self.pol_img[d['data'][:, 2], d['data'][:, 1]] += \
-                (d['data'][:, 3]-.5)/self.dvs_contrast
+            self.accumulate(d)
             if time.time() - self.t_pre[etype] > self.min_dt:
-                if self.zoom != 1:
-                    self.pol_img = cv2.resize(
-                            self.pol_img, None,
-                            fx=self.zoom, fy=self.zoom,
-                            interpolation=cv2.INTER_CUBIC)
-                    if self.rotate180 is True:
-                        # grab the dimensions of the image and
-                        # calculate the center
-                        # of the image
-                        (h, w) = self.pol_img.shape[:2]
-                        center = (w // 2, h // 2)
-
-                        # rotate the image by 180 degrees
-                        M = cv2.getRotationMatrix2D(center, 180, 1.0)
-                        self.pol_img = cv2.warpAffine(self.pol_img, M, (w, h))
-                        if self.display_info:
-                            self._print_string(self.pol_img, (25, 25), "%.2fms"%(self.min_dt*1000))
-                cv2.imshow('polarity', self.pol_img)
-                # cv2.waitKey(1)
-                self.pol_img = 0.5 * np.ones(DVS_SHAPE)
-                
-                self.t_pre[etype] = time.time()
+                self.show_polarity()
         elif etype in VIEW_DATA:
             if 'data' not in d:
                 d['data'] = d['value']
@@ -447,28 +545,55 @@ class Viewer(Interface):
         if t is not None:
             self._set_t(t)
 
+    def accumulate(self, d):
+        ''' add the events of a polarity packet to the next polarity image '''
+        if 'data' in d:
+            ev = d['data']
+            idx = ev[:, 2].astype(np.intp) * DVS_SHAPE[1] + ev[:, 1].astype(np.intp)
+            pol = ev[:, 3]
+        else:
+            # decode straight from the packet, only the fields we need
+            raw = np.frombuffer(d['dvs_data'], dtype=np.uint32)[::2]
+            idx = (raw >> 2 & 0b111111111111111).astype(np.intp) * DVS_SHAPE[1] \
+                + (raw >> 17).astype(np.intp)
+            pol = raw >> 1 & 1
+        self.pol_pending.append((idx, pol))
+
+    def show_polarity(self):
+        ''' show the events accumulated since the last polarity image '''
+        self._show_polarity()
+        self._handle_keys()
+        self.t_pre['polarity_event'] = time.time()
+
+    def _show_polarity(self):
+        # more events per image when playing fast
+        contrast = self.dvs_contrast
+        if self.scheduler is not None:
+            contrast *= max(self.scheduler.speed, 1)
+        if self.pol_pending:
+            idx, pol = (np.concatenate(v) for v in zip(*self.pol_pending))
+            self.pol_acc += np.bincount(idx, weights=pol - .5, minlength=self.pol_acc.size)
+            self.pol_pending = []
+        img = 0.5 + self.pol_acc.reshape(DVS_SHAPE) / contrast
+        img = self._rotate(img)
+        if self.zoom != 1:
+            img = cv2.resize(
+                    img, None, fx=self.zoom, fy=self.zoom,
+                    interpolation=cv2.INTER_CUBIC)
+        if self.display_info:
+            info = "%.2fms" % (self.min_dt * 1000)
+            if self.scheduler is not None:
+                info += " x%g (x%.1f)" % (self.scheduler.speed, self.scheduler.effective)
+            self._print_string(img, (25, 25), info)
+        cv2.imshow('polarity', img)
+        # decay (or clear) the histogram for the next image
+        self.pol_acc *= self.pol_decay
+
     def _plot_steering_wheel(self, img):
         if 'steering_wheel_angle' not in self.cache:
             return
-        c, r = (173, 130), 65  # center, radius
-        a = self.cache['steering_wheel_angle']
-        a_rad = + a / 180. * np.pi + np.pi / 2
-        if self.rotate180:
-            a_rad = np.pi-a_rad
-        t = (c[0] + int(np.cos(a_rad) * r), c[1] - int(np.sin(a_rad) * r))
-        cv2.line(img, c, t, self.display_color, 2, CV_AA)
-        cv2.circle(img, c, r, self.display_color, 1, CV_AA)
-        cv2.line(img, (c[0]-r+5, c[1]), (c[0]-r, c[1]),
-                 self.display_color, 1, CV_AA)
-        cv2.line(img, (c[0]+r-5, c[1]), (c[0]+r, c[1]),
-                 self.display_color, 1, CV_AA)
-        cv2.line(img, (c[0], c[1]-r+5), (c[0], c[1]-r),
-                 self.display_color, 1, CV_AA)
-        cv2.line(img, (c[0], c[1]+r-5), (c[0], c[1]+r),
-                 self.display_color, 1, CV_AA)
-        cv2.putText(
-            img, '%0.1f deg' % a,
-            (c[0]-35, c[1]+30), self.font, 0.4, self.display_color, 1, CV_AA)
+        draw_steering_wheel(img, self.cache['steering_wheel_angle'],
+                            self.display_color, self.rotate180)
 
     def _print(self, img, pos, name, unit, autohide=False):
         if name not in self.cache:
@@ -499,76 +624,111 @@ class Viewer(Interface):
 
 
 class Controller(Interface):
+    '''
+    Timeline overview, drawn from the precomputed tracks of the index.
+    Click to seek, mouse wheel to zoom, right click to show everything.
+    '''
+    # track, row offset, height, style
+    TRACKS = (
+        ('headlamp_status', 0, 10, 'pixels'),
+        ('steering_wheel_angle', 20, 30, 'band'),
+        ('vehicle_speed', 69, 30, 'band'),
+        ('event_rate', 105, 12, 'band'),
+        ('frame_rate', 120, 8, 'band'),
+        )
+    height = 130
+
     def __init__(self, filename, **kwargs):
         super(Controller, self).__init__(**kwargs)
         cv2.namedWindow('control')
         cv2.moveWindow('control', 400, 698)
-        self.f = h5py.File(filename, 'r')
+        self.timeline = Timeline(open_index(filename))
         self.tmin, self.tmax = self._get_ts()
         self.len = int(self.tmax - self.tmin) + 1
-        img = np.zeros((100, self.len))
-        self.plot_pixels(img, 'headlamp_status', 0, 10)
-        self.plot_line(img, 'steering_wheel_angle', 20, 30)
-        self.plot_line(img, 'vehicle_speed', 69, 30)
         self.width = 978
-        self.img = cv2.resize(
-            img, (self.width, 100), interpolation=cv2.INTER_NEAREST)
+        self.window = (self.timeline.t0, self.timeline.t1)
+        self._render()
         cv2.setMouseCallback('control', self._set_search)
         self.t_pre = 0
         self.update(0)
-        self.f.close()
+
+    def _render(self):
+        img = np.zeros((self.height, self.width))
+        for name, offset, height, style in self.TRACKS:
+            d = self.timeline.track(name, self.window[0], self.window[1], self.width)
+            if d is None:
+                continue
+            if style == 'pixels':
+                self.plot_pixels(img, d, offset, height)
+            else:
+                self.plot_band(img, d, offset, height)
+        self.img = img
+
+    def zoom(self, x, factor):
+        ''' zoom the timeline by factor around pixel column x '''
+        t0, t1 = self.window
+        tc = t0 + (t1 - t0) * x / float(self.width)
+        span = min(max((t1 - t0) / factor, self.timeline.dt * 8),
+                   self.timeline.t1 - self.timeline.t0)
+        t0 = min(max(tc - span * x / float(self.width), self.timeline.t0),
+                 self.timeline.t1 - span)
+        self.window = (t0, t0 + span)
+        self._render()
+        self.t_pre = None
+        self.update(self.tmin + self.t_now)
 
     def update(self, t):
         self._set_t(t)
-        t = int(float(self.width) / self.len * (t - self.tmin))
+        t0, t1 = self.window
+        t = int(float(self.width) / (t1 - t0) * (t * 1e6 - t0))
         if t == self.t_pre:
             return
         self.t_pre = t
         img = self.img.copy()
-        img[:, :t+1] = img[:, :t+1] * 0.5 + 0.5
+        if t >= 0:
+            img[:, :t+1] = img[:, :t+1] * 0.5 + 0.5
         cv2.imshow('control', img)
         cv2.waitKey(1)
 
-    def plot_line(self, img, name, offset, height):
-        x, y = self.get_xy(name)
-        if x is None:
-            return
-        y -= y.min()
-        y = y / y.max() * height
-        x = x.clip(0, self.len - 1)
-        img[offset+height-y.astype(int), x] = 1
-
-    def plot_pixels(self, img, name, offset=0, height=1):
-        x, y = self.get_xy(name)
-        if x is None:
+    def plot_band(self, img, d, offset, height):
+        ''' min to max range per column, mean in full brightness '''
+        lo, hi, mean = d
+        valid = ~np.isnan(mean)
+        if not valid.any():
             return
-        img[offset:offset+height, x] = y
+        vmin, vmax = np.nanmin(lo), np.nanmax(hi)
+        scale = (height - 1) / (vmax - vmin) if vmax > vmin else 0
+        row = lambda v: (offset + height - 1 - (np.nan_to_num(v) - vmin) * scale).astype(int)
+        rows = np.arange(img.shape[0])[:, None]
+        band = (rows >= row(hi)) & (rows <= row(lo)) & valid
+        img[band] = 0.5
+        x = np.flatnonzero(valid)
+        img[row(mean[valid]), x] = 1
+
+    def plot_pixels(self, img, d, offset=0, height=1):
+        mean = np.nan_to_num(d[2])
+        img[offset:offset+height, :] = mean
 
     def _set_search(self, event, x, y, flags, param):
+        if event == cv2.EVENT_MOUSEWHEEL:
+            self.zoom(x, 2. if cv2.getMouseWheelDelta(flags) > 0 else .5)
+            return
+        if event == cv2.EVENT_RBUTTONDOWN:
+            self.window = (self.timeline.t0, self.timeline.t1)
+            self._render()
+            self.t_pre = None
+            return
         if event != cv2.EVENT_LBUTTONDOWN:
             return
-        t = self.len * 1e6 * x / float(self.width) + self.tmin * 1e6
+        t0, t1 = self.window
+        t = t0 + (t1 - t0) * x / float(self.width)
         self._search_callback(t)
 
     def _get_ts(self):
-        ts = self.f['dvs']['timestamp']
-        tmin = ts[0]
-        i = -1
-        while ts[i] == 0:
-            i -= 1
-        tmax = ts[i]
+        tmin, tmax = self.timeline.t0, self.timeline.t1
         print('tmin/tmax', tmin, tmax)
         return int(tmin * 1e-6), int(tmax * 1e-6)
 
-    def get_xy(self, name):
-        d = self.f[name]['data']
-        print('name', name)
-        gtz_ids = d[:, 0] > 0
-        if not gtz_ids.any():
-            return None, 0
-        gtz = d[gtz_ids, :]
-        return (gtz[:, 0] * 1e-6 - self.tmin).astype(int), gtz[:, 1]
-
 
 def caer_event_from_row(row):
     '''
@@ -594,15 +754,17 @@ if __name__ == '__main__':
     parser.add_argument('--rotate', '-r', type=bool, default=True,
                         help="Rotate the scene 180 degrees if True, "
                              "Otherwise False")
+    parser.add_argument('--speed', type=float, default=1.,
+                        help="playback speed, %g to %g times real time "
+                             "(keys f/s in the viewer)" % (
+                                 PlaybackScheduler.SPEEDS[0], PlaybackScheduler.SPEEDS[-1]))
     args = parser.parse_args()
 
     fname = args.filename
     c = Controller(fname,)
-    m = MergedStream(HDF5Stream(fname, VIEW_DATA))
+    m = MergedStream(HDF5Stream(fname, VIEW_DATA, preroll=SEEK_PREROLL))
     c._search_callback = m.search
     t = time.time()
-    t_pre = 0
-    t_offset = 0
     r180 = args.rotate
     #  r180arg = "-r180"
 
@@ -618,41 +780,35 @@ if __name__ == '__main__':
             m.search(float(n_) * 1e6 + m.tmin)
     except:
         pass
+    sched = PlaybackScheduler(args.speed)
     v = Viewer(tmin=m.tmin * 1e-6, tmax=m.tmax * 1e-6,
-               zoom=1.41, rotate180=r180, update_callback=c.update)
+               zoom=1.41, rotate180=r180, update_callback=c.update,
+               scheduler=sched)
     # run main loop
-    ts_reset = False
     while m.has_data:
         try:
-            sys_ts, d = m.get()
+            sys_ts, d = m.get(True, 0.1)
         #  except Queue.Empty:
         except Empty:
             continue
         if not d:
             continue
         if d['etype'] == 'timestamp_reset':
-            ts_reset = True
+            print('resetting timestamp')
+            sched.reset()
             continue
         if not d['etype'] in {'frame_event', 'polarity_event'}:
             v.show(d)
             continue
-        if d['timestamp'] < t_pre:
-            print('[WARN] negative dt detected!')
-        t_pre = d['timestamp']
-        if ts_reset:
-            print('resetting timestamp')
-            t_offset = 0
-            ts_reset = False
-        if not t_offset:
-            t_offset = time.time() - d['timestamp']
-            print('setting offset', t_offset)
-        t_sleep = max(d['timestamp'] - time.time() + t_offset, 0)
-        time.sleep(t_sleep)
+        if not sched.schedule(d['timestamp']):
+            # too late, drop the packet, or jump ahead if far behind
+            if sched.lag > JUMP_LAG:
+                m.search((sys_ts + sched.lag * sched.speed) * 1e6)
+                sched.reset()
+            continue
         v.show(d, sys_ts)
         if time.time() - t > 1:
-            print(chr(27) + "[2J")
             t = time.time()
-            print('fps:\n', '\n'.join(
-                ['  %s %s' % (
-                 k.ljust(20), v_) for k, v_ in v.count.items()]))
+            print('speed x%g, effective x%.2f, %d packets skipped' % (
+                sched.speed, sched.effective, sched.skipped))
             v.count = {k: 0 for k in v.count}